@@ -63,7 +63,14 @@ stop_service() {
         PID=$(cat "$PID_FILE")
         if ps -p $PID > /dev/null 2>&1; then
             kill $PID
-            sleep 2
+            # 等待进行中的请求、智能体调用和消息队列排空完成：
+            # run.py的--graceful-timeout + lifespan中的AGENT_DRAIN_TIMEOUT + MESSAGE_DRAIN_TIMEOUT，再留5秒余量
+            STOP_TIMEOUT=${STOP_TIMEOUT:-$(( ${GRACEFUL_TIMEOUT:-30} + ${AGENT_DRAIN_TIMEOUT:-10} + ${MESSAGE_DRAIN_TIMEOUT:-10} + 5 ))}
+            WAIT=0
+            while ps -p $PID > /dev/null 2>&1 && [ $WAIT -lt $STOP_TIMEOUT ]; do
+                sleep 1
+                WAIT=$((WAIT + 1))
+            done
             if ps -p $PID > /dev/null 2>&1; then
                 kill -9 $PID
                 echo "⚠️  强制终止 $SERVICE_NAME 服务 (PID: $PID)"
@@ -0,0 +1,18 @@
+"""基准测试：进程内替身 + 请求混合压测，运行方式见 __main__.py"""
+
+import os
+
+
+def configure_environment():
+    """必须在导入main之前调用：替身地址、测试密钥、降低日志量"""
+    os.environ.update({
+        "SUPABASE_URL": "http://supabase.bench",
+        "SUPABASE_KEY": "bench-key",
+        "DASHSCOPE_API_KEY": "bench-key",
+        "DASHSCOPE_APP_ID": "bench-app",
+        "DASHSCOPE_BASE_URL": "http://dashscope.bench/api/v1",
+        "DASHSCOPE_TRANSPORT": "http",
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # 压测用户的发送频率远高于真实用户，默认不做按用户限流（公平排队仍然生效）
+    os.environ.setdefault("AGENT_USER_RATE", "0")
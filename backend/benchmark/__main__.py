@@ -0,0 +1,374 @@
+"""
+压测与延迟基准测试
+
+在进程内运行FastAPI应用，Supabase与百炼替换为本地替身（见fakes.py），
+按权重混合登录、注册、发送消息、流式发送、历史记录和对话列表请求，
+在给定并发度下输出每个接口及每个上游调用/处理阶段的吞吐量与p50/p95/p99。
+
+用法（在backend目录下）:
+    python -m benchmark --concurrency 1,16,64 --duration 20
+    python -m benchmark --json results.json
+    python -m benchmark --baseline results.json --max-regression 20
+    python -m benchmark --storage sqlite
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+import httpx
+
+from benchmark import configure_environment
+from benchmark.fakes import FakeDashScope, FakePostgREST, Latency, install, load_sqlite
+
+configure_environment()
+
+# 默认请求混合权重
+DEFAULT_MIX = "login=10,register=2,send=20,stream=5,history=30,chats=33"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="DeepSeek Chat API 基准测试")
+    parser.add_argument("--concurrency", default="1,16,64", help="并发度列表，逗号分隔，依次运行")
+    parser.add_argument("--duration", type=float, default=10.0, help="每个并发度的运行时长（秒）")
+    parser.add_argument("--warmup", type=float, default=1.0, help="每轮正式计时前的预热时长（秒）")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="请求混合权重，如 login=10,send=20")
+    parser.add_argument("--users", type=int, default=200, help="预置用户数")
+    parser.add_argument("--chats-per-user", type=int, default=5, help="每个预置用户的对话数")
+    parser.add_argument("--messages-per-chat", type=int, default=20, help="每个预置对话的消息数")
+    parser.add_argument("--db-latency", type=Latency.parse, default=Latency(15, 5),
+                        help="Supabase单次请求延迟（毫秒），格式 均值[:抖动]")
+    parser.add_argument("--agent-first-token", type=Latency.parse, default=Latency(300, 100),
+                        help="智能体首包延迟（毫秒），格式 均值[:抖动]")
+    parser.add_argument("--agent-chunk-interval", type=Latency.parse, default=Latency(20, 5),
+                        help="智能体流式分块间隔（毫秒），格式 均值[:抖动]")
+    parser.add_argument("--agent-chunks", type=int, default=20, help="每次回复的分块数")
+    parser.add_argument("--agent-error-rate", type=float, default=0.0, help="智能体返回500的比例")
+    parser.add_argument("--db-max-connections", type=int, default=int(os.getenv("SUPABASE_MAX_CONNECTIONS", "100")),
+                        help="模拟的Supabase连接池大小")
+    parser.add_argument("--bcrypt-rounds", type=int, default=None,
+                        help="预置用户密码哈希的轮数，默认使用BCRYPT_ROUNDS配置")
+    parser.add_argument("--storage", choices=["supabase", "sqlite"], default="supabase",
+                        help="存储后端：supabase使用PostgREST替身（--db-latency生效），sqlite使用临时目录中的本地数据库")
+    parser.add_argument("--history-limit", type=int, default=50, help="历史记录请求的limit参数")
+    parser.add_argument("--conditional", action="store_true",
+                        help="历史记录和对话列表请求像浏览器一样携带上次返回的ETag（If-None-Match）")
+    parser.add_argument("--seed", type=int, default=42, help="随机种子，保证结果可复现")
+    parser.add_argument("--json", dest="json_path", help="将结果写入JSON文件")
+    parser.add_argument("--baseline", help="与之前保存的JSON结果对比p95")
+    parser.add_argument("--max-regression", type=float, default=20.0,
+                        help="p95相对基线的最大允许增幅（百分比），超出时以非零状态退出")
+    return parser.parse_args()
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in SCENARIOS:
+            raise SystemExit(f"未知的请求类型: {name}，可选: {', '.join(SCENARIOS)}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """最近秩法计算百分位"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class Recorder:
+    """按标签收集耗时样本与错误数"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.enabled = False
+
+    def record(self, label: str, elapsed_ms: float, ok: bool = True):
+        if not self.enabled:
+            return
+        self.samples[label].append(elapsed_ms)
+        if not ok:
+            self.errors[label] += 1
+
+    def record_stages(self, name: str, stages: dict, total: float):
+        for stage, elapsed in stages.items():
+            self.record(f"stage {name}.{stage}", elapsed)
+        self.record(f"stage {name}.total", total)
+
+    def summary(self, duration: float) -> Dict[str, dict]:
+        result = {}
+        for label in sorted(self.samples):
+            values = sorted(self.samples[label])
+            result[label] = {
+                "count": len(values),
+                "errors": self.errors.get(label, 0),
+                "rps": round(len(values) / duration, 2),
+                "p50": round(percentile(values, 50), 2),
+                "p95": round(percentile(values, 95), 2),
+                "p99": round(percentile(values, 99), 2),
+                "max": round(values[-1], 2)
+            }
+        return result
+
+
+class Workload:
+    """预置数据并生成各类请求"""
+
+    def __init__(self, client: httpx.AsyncClient, postgrest: FakePostgREST, args: argparse.Namespace,
+                 password_hash: str, rng: random.Random):
+        self.client = client
+        self.args = args
+        self.rng = rng
+        self.password = "bench-password"
+        self.users: List[dict] = []
+        self.chat_ids: Dict[str, List[str]] = defaultdict(list)
+        # 条件请求：请求标识 -> 上次返回的ETag
+        self.etags: Dict[str, str] = {}
+        self._register_seq = 0
+        self._seed(postgrest, password_hash)
+
+    def _seed(self, postgrest: FakePostgREST, password_hash: str):
+        now = int(time.time() * 1000)
+        tables = postgrest.tables
+        for u in range(self.args.users):
+            user = {
+                "id": f"user-{u}", "username": f"bench{u}", "email": f"bench{u}@example.com",
+                "password_hash": password_hash, "avatar": None, "plan": "个人版",
+                "created_at": "2024-01-01T00:00:00+00:00"
+            }
+            tables["users"].append(user)
+            self.users.append(user)
+            for c in range(self.args.chats_per_user):
+                chat_id = f"chat-{u}-{c}"
+                created = f"2024-01-{c + 1:02d}T00:00:00+00:00"
+                tables["chats"].append({
+                    "id": chat_id, "user_id": user["id"], "title": f"对话{c}",
+                    "color": "#000000", "icon_color": "#FFFFFF",
+                    "created_at": created, "updated_at": created
+                })
+                self.chat_ids[user["id"]].append(chat_id)
+                for m in range(self.args.messages_per_chat):
+                    tables["messages"].append({
+                        "id": f"msg-{u}-{c}-{m}", "chat_id": chat_id,
+                        "role": "user" if m % 2 == 0 else "assistant",
+                        "content": f"消息内容 {m} " * 8, "timestamp": now - (self.args.messages_per_chat - m) * 1000,
+                        "created_at": created
+                    })
+
+    def _user(self) -> dict:
+        return self.rng.choice(self.users)
+
+    async def login(self):
+        user = self._user()
+        identifier = user["email"] if self.rng.random() < 0.5 else user["username"]
+        return await self.client.post("/api/auth/login", json={"identifier": identifier, "password": self.password})
+
+    async def register(self):
+        self._register_seq += 1
+        name = f"new{self.args.seed}x{self._register_seq}"
+        return await self.client.post("/api/auth/register", json={
+            "username": name, "email": f"{name}@example.com", "password": self.password,
+            "confirm_password": self.password, "agree_terms": True
+        })
+
+    def _chat_request(self) -> dict:
+        user = self._user()
+        chat_ids = self.chat_ids[user["id"]]
+        payload = {"message": "请介绍一下今天的天气情况", "user_id": user["id"]}
+        # 七成请求在已有对话中继续，三成开启新对话
+        if chat_ids and self.rng.random() < 0.7:
+            payload["chat_id"] = self.rng.choice(chat_ids)
+        return payload
+
+    async def send(self):
+        payload = self._chat_request()
+        response = await self.client.post("/api/chat/send", json=payload)
+        if not payload.get("chat_id") and response.status_code == 200 and response.json().get("chat_id"):
+            self.chat_ids[payload["user_id"]].append(response.json()["chat_id"])
+        return response
+
+    async def stream(self):
+        payload = self._chat_request()
+        async with self.client.stream("POST", "/api/chat/stream", json=payload) as response:
+            async for _ in response.aiter_bytes():
+                pass
+        return response
+
+    async def _conditional(self, key: str, send):
+        """--conditional时携带该请求上次返回的ETag，并记录新的ETag"""
+        if not self.args.conditional:
+            return await send({})
+        etag = self.etags.get(key)
+        response = await send({"If-None-Match": etag} if etag else {})
+        if response.headers.get("etag"):
+            self.etags[key] = response.headers["etag"]
+        return response
+
+    async def history(self):
+        user = self._user()
+        chat_id = self.rng.choice(self.chat_ids[user["id"]])
+        return await self._conditional(f"history:{chat_id}", lambda headers: self.client.get(
+            f"/api/chat/history/{chat_id}", params={"limit": self.args.history_limit}, headers=headers
+        ))
+
+    async def chats(self):
+        user = self._user()
+        return await self._conditional(f"chats:{user['id']}", lambda headers: self.client.post(
+            "/api/auth/chats", json={"user_id": user["id"], "page_size": 10}, headers=headers
+        ))
+
+    async def bootstrap(self):
+        user = self._user()
+        return await self.client.get(f"/api/auth/bootstrap/{user['id']}",
+                                     params={"page_size": 10, "message_limit": self.args.history_limit})
+
+
+SCENARIOS = ("login", "register", "send", "stream", "history", "chats", "bootstrap")
+
+
+def is_success(response: httpx.Response) -> bool:
+    if response.status_code >= 400:
+        return False
+    if response.status_code == 304:
+        return True
+    if response.headers.get("content-type", "").startswith("application/json"):
+        body = response.json()
+        return not isinstance(body, dict) or body.get("success", True) is not False
+    return True
+
+
+async def run_level(workload: Workload, recorder: Recorder, mix: Dict[str, float],
+                    concurrency: int, duration: float, warmup: float) -> float:
+    """以固定并发度循环发送请求，返回实际计时时长"""
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    loop = asyncio.get_running_loop()
+    stop_at = loop.time() + warmup + duration
+
+    async def worker():
+        while loop.time() < stop_at:
+            name = workload.rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                response = await getattr(workload, name)()
+                ok = is_success(response)
+            except Exception:
+                ok = False
+            recorder.record(f"api {name}", (time.perf_counter() - started) * 1000, ok)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    await asyncio.sleep(warmup)
+    recorder.enabled = True
+    measured_from = loop.time()
+    await asyncio.gather(*workers)
+    recorder.enabled = False
+    return loop.time() - measured_from
+
+
+def print_report(concurrency: int, summary: Dict[str, dict]):
+    print(f"\n=== 并发度 {concurrency} ===")
+    print(f"{'label':<48}{'count':>8}{'err':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for label, row in summary.items():
+        print(f"{label:<48}{row['count']:>8}{row['errors']:>6}{row['rps']:>9.1f}"
+              f"{row['p50']:>9.1f}{row['p95']:>9.1f}{row['p99']:>9.1f}{row['max']:>9.1f}")
+
+
+def compare_with_baseline(results: dict, baseline_path: str, max_regression: float) -> bool:
+    """对比p95，返回是否全部在允许范围内"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    passed = True
+    print(f"\n=== 与基线对比（p95，允许增幅 {max_regression}%） ===")
+    for level, summary in results.items():
+        for label, row in summary.items():
+            base = baseline.get(level, {}).get(label)
+            if not base or not base["p95"]:
+                continue
+            change = (row["p95"] - base["p95"]) / base["p95"] * 100
+            regressed = change > max_regression
+            passed = passed and not regressed
+            marker = "❌" if regressed else "  "
+            print(f"{marker} c={level:<4} {label:<44} {base['p95']:>9.1f} -> {row['p95']:>9.1f} ({change:+.1f}%)")
+    return passed
+
+
+async def main_async(args: argparse.Namespace) -> int:
+    if args.bcrypt_rounds:
+        os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    sqlite_dir = None
+    if args.storage == "sqlite":
+        sqlite_dir = tempfile.mkdtemp(prefix="bench-sqlite-")
+        os.environ["STORAGE_BACKEND"] = "sqlite"
+        os.environ["SQLITE_PATH"] = os.path.join(sqlite_dir, "bench.db")
+
+    try:
+        return await run_benchmark(args)
+    finally:
+        if sqlite_dir:
+            shutil.rmtree(sqlite_dir, ignore_errors=True)
+
+
+async def run_benchmark(args: argparse.Namespace) -> int:
+    import main as app_module
+
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    recorder = Recorder()
+    postgrest = FakePostgREST(args.db_latency, rng)
+    dashscope = FakeDashScope(args.agent_first_token, args.agent_chunk_interval, args.agent_chunks,
+                              rng, args.agent_error_rate)
+    # SQLite存储时预置数据仍先生成到替身的表中，启动后再整体导入数据库
+    db_service = app_module.db_service if args.storage == "supabase" else None
+    install(db_service, app_module.agent_service, postgrest, dashscope,
+            args.db_max_connections, app_module.DASHSCOPE_MAX_CONCURRENCY, recorder.record)
+    app_module.StageTimer.observers.append(recorder.record_stages)
+
+    password_hash = await app_module.db_service.hash_password("bench-password")
+    levels = [int(level) for level in args.concurrency.split(",")]
+    results = {}
+
+    transport = httpx.ASGITransport(app=app_module.app)
+    async with app_module.lifespan(app_module.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://app.bench", timeout=None) as client:
+            workload = Workload(client, postgrest, args, password_hash, rng)
+            if db_service is None:
+                load_sqlite(app_module.db_service.path, postgrest.tables)
+            print(f"预置数据: {args.users}个用户, {len(postgrest.tables['chats'])}个对话, "
+                  f"{len(postgrest.tables['messages'])}条消息; 混合: {args.mix}")
+            for concurrency in levels:
+                recorder.samples.clear()
+                recorder.errors.clear()
+                elapsed = await run_level(workload, recorder, mix, concurrency, args.duration, args.warmup)
+                summary = recorder.summary(elapsed)
+                results[str(concurrency)] = summary
+                print_report(concurrency, summary)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"args": {k: str(v) for k, v in vars(args).items()}, "results": results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入 {args.json_path}")
+
+    if args.baseline:
+        return 0 if compare_with_baseline(results, args.baseline, args.max_regression) else 1
+    return 0
+
+
+def main():
+    sys.exit(asyncio.run(main_async(parse_args())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+"""
+Supabase(PostgREST) 与 百炼智能体 的本地替身
+
+两者都实现为httpx传输层，通过 http_transport 挂到 db_service / agent_service 上，
+请求不出进程；延迟按配置随机生成，连接数上限模拟真实连接池的排队。
+"""
+
+import asyncio
+import json
+import random
+import sqlite3
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qsl
+
+import httpx
+
+
+@dataclass
+class Latency:
+    """上游延迟模型：均值±抖动（毫秒，正态分布，截断到0）"""
+    mean_ms: float = 0.0
+    jitter_ms: float = 0.0
+
+    def sample(self, rng: random.Random) -> float:
+        if self.mean_ms <= 0 and self.jitter_ms <= 0:
+            return 0.0
+        return max(0.0, rng.gauss(self.mean_ms, self.jitter_ms)) / 1000
+
+    @classmethod
+    def parse(cls, value: str) -> "Latency":
+        """解析 "20" 或 "20:5" 形式的参数"""
+        mean, _, jitter = value.partition(":")
+        return cls(float(mean), float(jitter or 0))
+
+
+class UpstreamTransport(httpx.AsyncBaseTransport):
+    """
+    替身传输层：限制并发连接数，记录每次上游调用的耗时（含排队）
+
+    Args:
+        handler: 异步处理函数，接收httpx.Request返回httpx.Response
+        label: 根据请求生成统计标签
+        max_connections: 模拟连接池大小
+        record: 耗时回调 record(label, elapsed_ms)
+    """
+
+    def __init__(self, handler: Callable, label: Callable[[httpx.Request], str],
+                 max_connections: int, record: Callable[[str, float], None]):
+        self.handler = handler
+        self.label = label
+        self.record = record
+        self._slots = asyncio.Semaphore(max_connections)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        await self._slots.acquire()
+        try:
+            await request.aread()
+            response = await self.handler(request)
+        except BaseException:
+            self._slots.release()
+            raise
+        label = self.label(request)
+
+        if isinstance(response.stream, httpx.AsyncByteStream) and not hasattr(response, "_content"):
+            # 流式响应在读完后才释放连接并记录耗时
+            response.stream = _ReleasingStream(response.stream, self._slots, self.record, label, started)
+            return response
+
+        self._slots.release()
+        self.record(label, (time.perf_counter() - started) * 1000)
+        return response
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """包装流式响应体，读完或关闭时释放连接并记录耗时"""
+
+    def __init__(self, stream, slots: asyncio.Semaphore, record, label: str, started: float):
+        self._stream = stream
+        self._slots = slots
+        self._record = record
+        self._label = label
+        self._started = started
+        self._released = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        if not self._released:
+            self._released = True
+            self._slots.release()
+            self._record(self._label, (time.perf_counter() - self._started) * 1000)
+        await self._stream.aclose()
+
+
+def _split_top_level(body: str) -> List[str]:
+    """按顶层逗号拆分 or/and 条件，忽略括号和引号内的逗号"""
+    parts, current, depth, quoted = [], "", 0, False
+    for ch in body:
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted and ch == "(":
+            depth += 1
+        elif not quoted and ch == ")":
+            depth -= 1
+        if ch == "," and depth == 0 and not quoted:
+            parts.append(current)
+            current = ""
+        else:
+            current += ch
+    parts.append(current)
+    return parts
+
+
+def _compare(value, op: str, raw: str) -> bool:
+    if raw.startswith('"') and raw.endswith('"'):
+        raw = raw[1:-1]
+    if op == "in":
+        return str(value) in [item.strip('"') for item in _split_top_level(raw.strip("()"))]
+    if op == "eq":
+        return str(value) == raw
+    if op == "neq":
+        return str(value) != raw
+    if value is None:
+        return False
+    target = type(value)(raw) if isinstance(value, (int, float)) else raw
+    if op == "lt":
+        return value < target
+    if op == "gt":
+        return value > target
+    if op == "lte":
+        return value <= target
+    if op == "gte":
+        return value >= target
+    return True
+
+
+def _match_logic(row: dict, op: str, body: str) -> bool:
+    results = []
+    for part in _split_top_level(body[1:-1]):
+        if part.startswith("and("):
+            results.append(_match_logic(row, "and", part[3:]))
+        elif part.startswith("or("):
+            results.append(_match_logic(row, "or", part[2:]))
+        else:
+            column, operator, raw = part.split(".", 2)
+            results.append(_compare(row.get(column), operator, raw))
+    return any(results) if op == "or" else all(results)
+
+
+class FakePostgREST:
+    """
+    内存版PostgREST，覆盖main.py用到的子集：
+    eq/neq/in/lt/gt/lte/gte过滤、or/and组合、多列排序、limit/offset、
+    嵌入子表（含排序与条数限制）、count统计（Content-Range）、批量插入与ignore-duplicates、级联删除
+    """
+
+    RESERVED = {"select", "order", "limit", "offset", "or", "and", "on_conflict"}
+
+    def __init__(self, latency: Latency, rng: random.Random):
+        self.latency = latency
+        self.rng = rng
+        self.tables: Dict[str, List[dict]] = {"users": [], "chats": [], "messages": []}
+
+    @staticmethod
+    def label(request: httpx.Request) -> str:
+        return f"supabase {request.method} {request.url.path.rsplit('/', 1)[-1]}"
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        delay = self.latency.sample(self.rng)
+        if delay:
+            await asyncio.sleep(delay)
+
+        table = request.url.path.rsplit("/", 1)[-1]
+        if table not in self.tables:
+            return httpx.Response(404, json={"message": f"relation {table} does not exist"})
+        rows = self.tables[table]
+        params = parse_qsl(request.url.query.decode(), keep_blank_values=True)
+        selected = self._filter(rows, params)
+
+        if request.method in ("GET", "HEAD"):
+            return self._select(request, table, selected, dict(params))
+        if request.method == "POST":
+            return self._insert(request, rows)
+        if request.method == "PATCH":
+            changes = json.loads(request.content)
+            for row in selected:
+                row.update(changes)
+            return httpx.Response(200, json=selected)
+        if request.method == "DELETE":
+            deleted = {id(row) for row in selected}
+            rows[:] = [row for row in rows if id(row) not in deleted]
+            if table == "chats":
+                chat_ids = {row["id"] for row in selected}
+                messages = self.tables["messages"]
+                messages[:] = [m for m in messages if m["chat_id"] not in chat_ids]
+            return httpx.Response(200, json=selected)
+        return httpx.Response(405)
+
+    def _filter(self, rows: List[dict], params) -> List[dict]:
+        selected = rows
+        for key, value in params:
+            if key in ("or", "and"):
+                selected = [row for row in selected if _match_logic(row, key, value)]
+            elif key not in self.RESERVED and "." not in key:
+                operator, _, raw = value.partition(".")
+                selected = [row for row in selected if _compare(row.get(key), operator, raw)]
+        return list(selected)
+
+    def _select(self, request: httpx.Request, table: str, rows: List[dict], params: dict) -> httpx.Response:
+        for clause in reversed(params.get("order", "").split(",") if params.get("order") else []):
+            column, _, direction = clause.partition(".")
+            rows.sort(key=lambda row: (row.get(column) is None, row.get(column)),
+                      reverse=direction.startswith("desc"))
+
+        total = len(rows)
+        offset = int(params.get("offset", 0))
+        rows = rows[offset:]
+        if "limit" in params:
+            rows = rows[:int(params["limit"])]
+
+        select = params.get("select", "*")
+        if select != "*":
+            rows = [self._project(row, _split_top_level(select), params) for row in rows]
+
+        headers = {}
+        if "count=" in request.headers.get("prefer", ""):
+            end = offset + len(rows) - 1
+            headers["Content-Range"] = f"{offset}-{end}/{total}" if rows else f"*/{total}"
+        return httpx.Response(200, json=rows if request.method == "GET" else None, headers=headers)
+
+    def _project(self, row: dict, columns: List[str], params: dict) -> dict:
+        projected = {}
+        for column in columns:
+            if column.endswith(")"):
+                # 嵌入子表：child(col1,col2)，支持 child.order 与 child.limit
+                child, _, child_columns = column[:-1].partition("(")
+                children = [item for item in self.tables[child] if item.get("chat_id") == row["id"]]
+                for clause in reversed(params.get(f"{child}.order", "").split(",") if params.get(f"{child}.order") else []):
+                    key, _, direction = clause.partition(".")
+                    children.sort(key=lambda item: item.get(key), reverse=direction.startswith("desc"))
+                limit = int(params.get(f"{child}.limit", 1 << 30))
+                projected[child] = [{key: item.get(key) for key in child_columns.split(",")} for item in children[:limit]]
+            else:
+                projected[column] = row.get(column)
+        return projected
+
+    def _insert(self, request: httpx.Request, rows: List[dict]) -> httpx.Response:
+        body = json.loads(request.content)
+        items = body if isinstance(body, list) else [body]
+        ignore_duplicates = "resolution=ignore-duplicates" in request.headers.get("prefer", "")
+        existing = {row["id"] for row in rows}
+        now = time.strftime("%Y-%m-%dT%H:%M:%S.000000+00:00", time.gmtime())
+        inserted = []
+        for item in items:
+            row = {"created_at": now, "updated_at": now, **item}
+            row.setdefault("id", str(uuid.uuid4()))
+            if row["id"] in existing:
+                if ignore_duplicates:
+                    continue
+                return httpx.Response(409, json={"code": "23505", "message": "duplicate key value"})
+            existing.add(row["id"])
+            inserted.append(row)
+        rows.extend(inserted)
+        return httpx.Response(201, json=inserted)
+
+
+class FakeDashScope:
+    """
+    百炼应用接口替身：首包延迟 + 按间隔逐块返回
+
+    非流式调用等待全部分块时间后一次返回；流式调用按DashScope SSE格式逐块推送
+    """
+
+    def __init__(self, first_token: Latency, chunk_interval: Latency, chunks: int,
+                 rng: random.Random, error_rate: float = 0.0):
+        self.first_token = first_token
+        self.chunk_interval = chunk_interval
+        self.chunks = max(1, chunks)
+        self.rng = rng
+        self.error_rate = error_rate
+
+    @staticmethod
+    def label(request: httpx.Request) -> str:
+        if request.method == "HEAD":
+            return "dashscope warm_up"
+        streaming = request.headers.get("x-dashscope-sse") == "enable"
+        return "dashscope stream" if streaming else "dashscope completion"
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        if request.method == "HEAD":
+            return httpx.Response(200)
+
+        body = json.loads(request.content)
+        session_id = body["input"].get("session_id") or uuid.uuid4().hex
+        # 组装了上下文时请求中只有messages
+        prompt = body["input"].get("prompt") or "".join(m["content"] for m in body["input"].get("messages", []))
+        words = [f"w{i}" for i in range(self.chunks)]
+
+        if self.error_rate and self.rng.random() < self.error_rate:
+            await asyncio.sleep(self.first_token.sample(self.rng))
+            return httpx.Response(500, json={"code": "InternalError", "message": "fake upstream error"})
+
+        if request.headers.get("x-dashscope-sse") == "enable":
+            return httpx.Response(200, headers={"content-type": "text/event-stream"},
+                                  content=self._stream(words, session_id))
+
+        delay = self.first_token.sample(self.rng)
+        delay += sum(self.chunk_interval.sample(self.rng) for _ in words[1:])
+        await asyncio.sleep(delay)
+        return httpx.Response(200, json={
+            "output": {"text": " ".join(words), "session_id": session_id, "finish_reason": "stop"},
+            "usage": {"models": [{"input_tokens": len(prompt), "output_tokens": len(words)}]},
+            "request_id": uuid.uuid4().hex
+        })
+
+    async def _stream(self, words: List[str], session_id: str):
+        await asyncio.sleep(self.first_token.sample(self.rng))
+        for index, word in enumerate(words):
+            if index:
+                await asyncio.sleep(self.chunk_interval.sample(self.rng))
+            last = index == len(words) - 1
+            data = {
+                "output": {"text": word + " ", "session_id": session_id,
+                           "finish_reason": "stop" if last else "null"},
+                "usage": {"models": [{"input_tokens": 1, "output_tokens": index + 1}]}
+            }
+            yield f"id:{index}\nevent:result\n:HTTP_STATUS/200\ndata:{json.dumps(data)}\n\n".encode()
+
+
+def install(db_service, agent_service, postgrest: FakePostgREST, dashscope: Optional[FakeDashScope],
+            max_connections: int, agent_max_connections: int, record: Callable[[str, float], None]):
+    """把替身传输层挂到服务上（需在服务start之前调用）；db_service为None时只替换智能体（本地SQLite存储）"""
+    if db_service is not None:
+        db_service.http_transport = UpstreamTransport(postgrest.handle, postgrest.label, max_connections, record)
+    if agent_service and dashscope:
+        agent_service.http_transport = UpstreamTransport(dashscope.handle, dashscope.label,
+                                                         agent_max_connections, record)
+
+
+def load_sqlite(path: str, tables: Dict[str, List[dict]]):
+    """把替身中预置的数据写入SQLite存储（需在存储start建表之后调用），只导入两边都有的列"""
+    connection = sqlite3.connect(path)
+    try:
+        with connection:
+            for table in ("users", "chats", "messages"):
+                if not tables[table]:
+                    continue
+                columns = [row[1] for row in connection.execute(f"PRAGMA table_info({table})")
+                           if row[1] in tables[table][0]]
+                rows = [tuple(item.get(column) for column in columns) for item in tables[table]]
+                connection.executemany(
+                    f"INSERT INTO {table} ({','.join(columns)}) VALUES ({','.join('?' * len(columns))})", rows
+                )
+    finally:
+        connection.close()
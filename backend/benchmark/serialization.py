@@ -0,0 +1,96 @@
+"""
+JSON序列化微基准：对比 FAST_JSON 关闭/开启时获取聊天历史的单请求CPU耗时
+
+通过ASGI在进程内调用 /api/chat/history/{chat_id}，上游为零延迟的PostgREST替身，
+替身自身的查询开销在两种模式下相同，差值即为应用解析、校验和序列化节省的CPU时间。
+
+用法（在backend目录下）:
+    python -m benchmark.serialization --messages 100,1000,5000 --requests 200
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import httpx
+
+from benchmark import configure_environment
+from benchmark.fakes import FakePostgREST, Latency, install
+
+configure_environment()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="聊天历史JSON序列化微基准")
+    parser.add_argument("--messages", default="100,1000,5000", help="每个对话的消息数列表，逗号分隔")
+    parser.add_argument("--requests", type=int, default=200, help="每种模式的请求次数")
+    parser.add_argument("--content-length", type=int, default=200, help="每条消息的字符数")
+    parser.add_argument("--limit", type=int, default=None, help="历史请求的limit参数，默认不分页（透传路径）")
+    return parser.parse_args()
+
+
+def seed_chat(postgrest: FakePostgREST, chat_id: str, count: int, content_length: int):
+    now = int(time.time() * 1000)
+    content = ("你好，世界 hello world " * (content_length // 18 + 1))[:content_length]
+    postgrest.tables["chats"].append({"id": chat_id, "user_id": "bench-user", "title": chat_id})
+    postgrest.tables["messages"].extend({
+        "id": f"{chat_id}-{i:06d}", "chat_id": chat_id, "role": "user" if i % 2 == 0 else "assistant",
+        "content": content, "timestamp": now - (count - i) * 1000
+    } for i in range(count))
+
+
+async def measure(client: httpx.AsyncClient, url: str, params: dict, requests: int) -> dict:
+    """串行发送请求，返回单请求CPU与墙钟耗时（毫秒）及响应体"""
+    body = None
+    cpu_started, wall_started = time.process_time(), time.perf_counter()
+    for _ in range(requests):
+        response = await client.get(url, params=params)
+        body = response.content
+    return {
+        "cpu_ms": (time.process_time() - cpu_started) * 1000 / requests,
+        "wall_ms": (time.perf_counter() - wall_started) * 1000 / requests,
+        "body": body
+    }
+
+
+async def main_async(args: argparse.Namespace):
+    import main as app_module
+
+    if app_module.orjson is None:
+        raise SystemExit("未安装orjson，无法测试FAST_JSON模式")
+
+    postgrest = FakePostgREST(Latency(0, 0), random.Random(0))
+    install(app_module.db_service, None, postgrest, None, 100, 0, lambda label, elapsed: None)
+    sizes = [int(size) for size in args.messages.split(",")]
+    for size in sizes:
+        seed_chat(postgrest, f"chat-{size}", size, args.content_length)
+
+    params = {"limit": args.limit} if args.limit else {}
+    print(f"{'messages':>10}{'bytes':>12}{'default cpu':>14}{'fast cpu':>12}{'saved':>10}{'default wall':>15}{'fast wall':>12}")
+    transport = httpx.ASGITransport(app=app_module.app)
+    async with app_module.lifespan(app_module.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://app.bench") as client:
+            for size in sizes:
+                url = f"/api/chat/history/chat-{size}"
+                results = {}
+                for mode in (False, True):
+                    app_module.FAST_JSON = mode
+                    await measure(client, url, params, max(1, args.requests // 10))
+                    results[mode] = await measure(client, url, params, args.requests)
+
+                default, fast = results[False], results[True]
+                if json.loads(default["body"]) != json.loads(fast["body"]):
+                    raise SystemExit(f"两种模式的响应内容不一致: messages={size}")
+                saved = (1 - fast["cpu_ms"] / default["cpu_ms"]) * 100 if default["cpu_ms"] else 0.0
+                print(f"{size:>10}{len(fast['body']):>12}{default['cpu_ms']:>12.3f}ms{fast['cpu_ms']:>10.3f}ms"
+                      f"{saved:>9.1f}%{default['wall_ms']:>13.3f}ms{fast['wall_ms']:>10.3f}ms")
+
+
+def main():
+    asyncio.run(main_async(parse_args()))
+
+
+if __name__ == "__main__":
+    main()
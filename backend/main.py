@@ -1,36 +1,585 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager, aclosing
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import anyio
+import bisect
+import functools
+import random
+import time
 import uuid
 import os
 from dotenv import load_dotenv
 import bcrypt
 import logging
+import logging.handlers
+import atexit
+import contextvars
+import queue
+import re
 import httpx
 import json
-from datetime import datetime
+import base64
+import unicodedata
+import hashlib
+import math
+import signal
+import sqlite3
+import threading
+from datetime import datetime, timezone
 import dashscope
 from dashscope import Application
 
 # 加载环境变量
 load_dotenv()
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+# 日志配置
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text: 普通文本; json: 每行一条JSON
+LOG_ASYNC = os.getenv("LOG_ASYNC", "true").lower() == "true"  # 日志格式化和写出放到独立线程
+LOG_MAX_MESSAGE_LENGTH = int(os.getenv("LOG_MAX_MESSAGE_LENGTH", "2000"))
+SUPABASE_TRACE_SAMPLE_RATE = float(os.getenv("SUPABASE_TRACE_SAMPLE_RATE", "0.01"))
+
+# 当前请求的关联ID与链路日志采样标记
+request_id_var = contextvars.ContextVar("request_id", default="-")
+trace_sampled_var = contextvars.ContextVar("trace_sampled", default=None)
+
+# 日志脱敏规则
+LOG_REDACT_PATTERNS = [
+    (re.compile(r"\$2[aby]\$\d{2}\$[./A-Za-z0-9]{53}"), "[REDACTED_HASH]"),
+    (re.compile(r"eyJ[\w-]+\.[\w-]+\.[\w-]+"), "[REDACTED_JWT]"),
+    (re.compile(r"sk-[A-Za-z0-9]{16,}"), "[REDACTED_KEY]"),
+    (re.compile(r"(?i)(bearer\s+)[\w.-]+"), r"\1[REDACTED]"),
+    (re.compile(r"(?i)(apikey['\"]?\s*[=:]\s*['\"]?)[\w.-]+"), r"\1[REDACTED]"),
+]
+
+class RequestContextFilter(logging.Filter):
+    """为日志记录附加当前请求的关联ID"""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+class SafeFormatter(logging.Formatter):
+    """脱敏并截断日志内容，支持文本和JSON两种格式"""
+    
+    def __init__(self, json_format: bool = False):
+        super().__init__()
+        self.json_format = json_format
+    
+    @staticmethod
+    def redact(text: str) -> str:
+        for pattern, replacement in LOG_REDACT_PATTERNS:
+            text = pattern.sub(replacement, text)
+        return text
+    
+    def format_message(self, record: logging.LogRecord) -> str:
+        message = self.redact(record.getMessage())
+        if len(message) > LOG_MAX_MESSAGE_LENGTH:
+            message = f"{message[:LOG_MAX_MESSAGE_LENGTH]}...(已截断，共{len(message)}字符)"
+        return message
+    
+    def formatException(self, exc_info) -> str:
+        """异常堆栈同样脱敏（如httpx异常中携带的请求头或带密钥的URL）"""
+        return self.redact(super().formatException(exc_info))
+    
+    def format(self, record: logging.LogRecord) -> str:
+        message = self.format_message(record)
+        request_id = getattr(record, "request_id", "-")
+        exc_text = self.formatException(record.exc_info) if record.exc_info else None
+        
+        if self.json_format:
+            entry = {
+                "ts": self.formatTime(record),
+                "level": record.levelname,
+                "logger": record.name,
+                "request_id": request_id,
+                "message": message
+            }
+            if exc_text:
+                entry["exc_info"] = exc_text
+            return json.dumps(entry, ensure_ascii=False)
+        
+        line = f"{self.formatTime(record)} {record.levelname} [{request_id}] {record.name}: {message}"
+        return f"{line}\n{exc_text}" if exc_text else line
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """将日志记录原样放入队列，格式化推迟到日志线程执行"""
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+def setup_logging() -> Optional[logging.handlers.QueueListener]:
+    """配置根日志：异步模式下由后台线程负责格式化和写出"""
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(SafeFormatter(json_format=LOG_FORMAT == "json"))
+    
+    listener = None
+    if LOG_ASYNC:
+        log_queue = queue.SimpleQueue()
+        handler = DeferredQueueHandler(log_queue)
+        listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        listener.start()
+        # 进程退出时写完队列中剩余的日志
+        atexit.register(listener.stop)
+    else:
+        handler = stream_handler
+    handler.addFilter(RequestContextFilter())
+    
+    root_logger = logging.getLogger()
+    root_logger.handlers = [handler]
+    root_logger.setLevel(LOG_LEVEL)
+    # httpx每个请求一条INFO日志，高频且与Supabase链路日志重复
+    logging.getLogger("httpx").setLevel(os.getenv("HTTPX_LOG_LEVEL", "WARNING").upper())
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
+supabase_logger = logging.getLogger(f"{__name__}.supabase")
+
+class ResponseText:
+    """日志参数：格式化时才解码响应体"""
+    __slots__ = ("response",)
+    
+    def __init__(self, response):
+        self.response = response
+    
+    def __str__(self) -> str:
+        return self.response.text
+
+def supabase_trace(msg: str, *args):
+    """
+    输出Supabase请求/响应详情日志，按请求采样，参数延迟到日志线程格式化
+    
+    参数为httpx.Response时记录响应体，只在采样命中且实际格式化时解码。
+    """
+    sampled = trace_sampled_var.get()
+    if sampled is None:
+        sampled = random.random() < SUPABASE_TRACE_SAMPLE_RATE
+    if sampled:
+        supabase_logger.info(msg, *(ResponseText(arg) if isinstance(arg, httpx.Response) else arg for arg in args))
+
+# 指标配置
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _format_labels(names: Tuple[str, ...], values: tuple) -> str:
+    """格式化Prometheus标签，转义反斜杠、引号和换行"""
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    """单调递增计数器；只在事件循环线程中更新，无需加锁"""
+    kind = "counter"
+    
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+    
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+    
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+class Gauge(Counter):
+    """瞬时值；可传入collect回调在抓取时计算，回调返回数值或 {标签元组: 数值}"""
+    kind = "gauge"
+    
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (), collect=None):
+        super().__init__(name, help_text, labelnames)
+        self.collect = collect
+    
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+    
+    def samples(self):
+        if self.collect is None:
+            yield from super().samples()
+            return
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+class Histogram:
+    """分桶直方图：每次观测一次二分查找加两次累加，抓取时再计算累计值"""
+    kind = "histogram"
+    
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
+    
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+    
+    def samples(self):
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        for labels, (counts, total) in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield f"{self.name}_bucket", _format_labels(self.labelnames + ("le",), labels + (bound,)), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labelnames, labels), total
+            yield f"{self.name}_count", _format_labels(self.labelnames, labels), cumulative
+
+class MetricsRegistry:
+    """进程内指标注册表，按Prometheus文本格式输出（多进程部署时每个worker各自统计）"""
+    
+    def __init__(self):
+        self._metrics = []
+    
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                for name, labels, value in metric.samples():
+                    lines.append(f"{name}{labels} {value}")
+            except Exception as e:
+                logger.warning("采集指标%s失败: %r", metric.name, e)
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+HTTP_REQUESTS = metrics.register(Counter(
+    "http_requests_total", "HTTP请求数", ("method", "route", "status")))
+HTTP_LATENCY = metrics.register(Histogram(
+    "http_request_duration_seconds", "HTTP请求耗时（流式响应包含整个流）", ("method", "route")))
+HTTP_IN_FLIGHT = metrics.register(Gauge(
+    "http_requests_in_flight", "正在处理的HTTP请求数"))
+DB_LATENCY = metrics.register(Histogram(
+    "db_operation_duration_seconds", "DatabaseService方法耗时", ("method",)))
+UPSTREAM_REQUESTS = metrics.register(Counter(
+    "upstream_requests_total", "上游HTTP请求数", ("upstream", "status")))
+UPSTREAM_ERRORS = metrics.register(Counter(
+    "upstream_errors_total", "上游错误数（5xx、429与网络异常）", ("upstream", "kind")))
+DB_COALESCED_READS = metrics.register(Counter(
+    "supabase_coalesced_reads_total", "合并到进行中的相同读取、未发起上游调用的次数", ("table",)))
+AGENT_LATENCY = metrics.register(Histogram(
+    "agent_call_duration_seconds", "智能体调用耗时", ("mode", "outcome")))
+AGENT_RETRIES = metrics.register(Counter(
+    "agent_retries_total", "智能体调用重试次数"))
+AGENT_CIRCUIT_TRANSITIONS = metrics.register(Counter(
+    "agent_circuit_transitions_total", "智能体熔断器状态切换次数", ("state",)))
+AGENT_REPLY_CACHE_LOOKUPS = metrics.register(Counter(
+    "agent_reply_cache_lookups_total", "首条消息回复缓存查询次数", ("result",)))
+AGENT_FALLBACKS = metrics.register(Counter(
+    "agent_fallbacks_total", "使用备用回复的次数", ("mode",)))
+AGENT_ADMISSION_REJECTIONS = metrics.register(Counter(
+    "agent_admission_rejections_total", "智能体调用被准入控制拒绝的次数", ("reason",)))
+AGENT_QUEUE_WAIT = metrics.register(Histogram(
+    "agent_queue_wait_seconds", "智能体调用排队等待时间", ("outcome",)))
+AGENT_TOKENS = metrics.register(Counter(
+    "agent_tokens_total", "智能体调用消耗的token数（来自返回的usage）", ("kind",)))
+AGENT_CONTEXT_TRUNCATIONS = metrics.register(Counter(
+    "agent_context_truncated_messages_total", "超出上下文预算被丢弃的历史消息数"))
+WS_EVENTS = metrics.register(Counter(
+    "ws_events_total", "WebSocket通道发布的事件数", ("type",)))
+WS_DISCONNECTS = metrics.register(Counter(
+    "ws_disconnects_total", "WebSocket连接断开次数", ("reason",)))
+LOOP_LAG = metrics.register(Histogram(
+    "event_loop_lag_seconds", "事件循环调度延迟",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)))
+HTTP_IN_FLIGHT.set(0)
+
+class InstrumentedAsyncClient(httpx.AsyncClient):
+    """统计上游请求数和错误数的HTTP客户端"""
+    
+    def __init__(self, upstream: str, **kwargs):
+        super().__init__(**kwargs)
+        self.upstream = upstream
+    
+    async def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        try:
+            response = await super().send(request, **kwargs)
+        except httpx.HTTPError as e:
+            UPSTREAM_ERRORS.inc(self.upstream, type(e).__name__)
+            raise
+        UPSTREAM_REQUESTS.inc(self.upstream, f"{response.status_code // 100}xx")
+        if response.status_code >= 500 or response.status_code == 429:
+            UPSTREAM_ERRORS.inc(self.upstream, f"http_{response.status_code}")
+        return response
+
+def timed_db_method(func):
+    """记录DatabaseService方法耗时"""
+    name = func.__name__
+    
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - started, name)
+    return wrapper
+
+async def monitor_event_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    """定期休眠并测量实际唤醒延迟，反映事件循环是否被阻塞"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - started - interval))
+
+# 存储后端配置：supabase（默认，PostgREST接口）或 sqlite（本地文件，单机/边缘部署与离线基准测试）
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "deepseek_chat.db")
+SQLITE_READERS = int(os.getenv("SQLITE_READERS", "4"))  # 只读连接（线程）数，写入由单独的写线程串行执行
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))  # 毫秒
 
 # Supabase配置
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
-if not SUPABASE_URL or not SUPABASE_KEY:
+if STORAGE_BACKEND == "supabase" and (not SUPABASE_URL or not SUPABASE_KEY):
     raise ValueError("Supabase URL和API密钥必须在.env文件中配置")
 
+# Supabase HTTP连接池配置
+SUPABASE_HTTP2 = os.getenv("SUPABASE_HTTP2", "true").lower() == "true"
+SUPABASE_MAX_CONNECTIONS = int(os.getenv("SUPABASE_MAX_CONNECTIONS", "100"))
+SUPABASE_MAX_KEEPALIVE = int(os.getenv("SUPABASE_MAX_KEEPALIVE", "20"))
+SUPABASE_KEEPALIVE_EXPIRY = float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY", "30"))
+SUPABASE_CONNECT_TIMEOUT = float(os.getenv("SUPABASE_CONNECT_TIMEOUT", "5"))
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "15"))
+SUPABASE_POOL_TIMEOUT = float(os.getenv("SUPABASE_POOL_TIMEOUT", "5"))
+# 同时到达的相同读取请求共用一次上游调用（single-flight）
+SUPABASE_COALESCE_READS = os.getenv("SUPABASE_COALESCE_READS", "true").lower() == "true"
+
+# 阿里云百炼调用配置
+DASHSCOPE_BASE_URL = os.getenv("DASHSCOPE_BASE_URL", "https://dashscope.aliyuncs.com/api/v1")
+DASHSCOPE_TRANSPORT = os.getenv("DASHSCOPE_TRANSPORT", "http")  # http: 原生异步HTTP; sdk: 线程池中调用SDK
+DASHSCOPE_MAX_CONCURRENCY = int(os.getenv("DASHSCOPE_MAX_CONCURRENCY", "16"))
+DASHSCOPE_TIMEOUT = float(os.getenv("DASHSCOPE_TIMEOUT", "60"))
+DASHSCOPE_CONNECT_TIMEOUT = float(os.getenv("DASHSCOPE_CONNECT_TIMEOUT", "5"))
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))
+
+# 智能体调用重试配置（重试总时长受单次请求超时限制）
+DASHSCOPE_MAX_RETRIES = int(os.getenv("DASHSCOPE_MAX_RETRIES", "2"))
+DASHSCOPE_RETRY_BASE_DELAY = float(os.getenv("DASHSCOPE_RETRY_BASE_DELAY", "0.2"))
+DASHSCOPE_RETRY_MAX_DELAY = float(os.getenv("DASHSCOPE_RETRY_MAX_DELAY", "2"))
+
+# 智能体调用准入控制配置（AGENT_ADMISSION_ENABLED=false 时关闭）
+AGENT_ADMISSION_ENABLED = os.getenv("AGENT_ADMISSION_ENABLED", "true").lower() == "true"
+AGENT_MAX_ACTIVE = int(os.getenv("AGENT_MAX_ACTIVE", str(DASHSCOPE_MAX_CONCURRENCY)))  # 全局同时进行的调用数
+AGENT_QUEUE_MAX_SIZE = int(os.getenv("AGENT_QUEUE_MAX_SIZE", "256"))  # 全局排队上限
+AGENT_USER_QUEUE_SIZE = int(os.getenv("AGENT_USER_QUEUE_SIZE", "4"))  # 单个用户排队上限
+AGENT_USER_RATE = float(os.getenv("AGENT_USER_RATE", "0.5"))  # 每个用户每秒补充的令牌数
+AGENT_USER_BURST = float(os.getenv("AGENT_USER_BURST", "10"))  # 令牌桶容量
+AGENT_QUEUE_TIMEOUT = float(os.getenv("AGENT_QUEUE_TIMEOUT", "30"))  # 排队超时后使用备用回复
+# 套餐权重：公平调度时每轮可获得的名额数，同时放大令牌桶的速率和容量
+AGENT_PLAN_WEIGHTS = os.getenv("AGENT_PLAN_WEIGHTS", "个人版:1,专业版:2,企业版:4")
+
+# 对话上下文配置
+# session（默认）: 只发送最新消息和session_id，由百炼的服务端会话保持上下文；
+# history: 从已保存的消息中按token预算组装上下文随请求发送，不依赖服务端会话（需显式开启，输入token随预算变化）
+AGENT_CONTEXT_MODE = os.getenv("AGENT_CONTEXT_MODE", "session")
+AGENT_CONTEXT_MAX_TOKENS = int(os.getenv("AGENT_CONTEXT_MAX_TOKENS", "4000"))  # 上下文（含当前消息）的估算token预算
+AGENT_CONTEXT_MAX_MESSAGES = int(os.getenv("AGENT_CONTEXT_MAX_MESSAGES", "50"))  # 每次最多读取的历史消息数
+# 滚动摘要（默认关闭）：预算不足被丢弃的早期对话在后台压缩为摘要，之后的请求以摘要代替这些对话
+AGENT_CONTEXT_SUMMARY = os.getenv("AGENT_CONTEXT_SUMMARY", "false").lower() == "true"
+AGENT_CONTEXT_SUMMARY_MAX_CHARS = int(os.getenv("AGENT_CONTEXT_SUMMARY_MAX_CHARS", "300"))
+AGENT_CONTEXT_SUMMARY_CACHE_SIZE = int(os.getenv("AGENT_CONTEXT_SUMMARY_CACHE_SIZE", "10000"))
+AGENT_CONTEXT_SUMMARY_TTL = float(os.getenv("AGENT_CONTEXT_SUMMARY_TTL", "86400"))
+
+# 智能体熔断配置（AGENT_BREAKER_ENABLED=false 时关闭）
+AGENT_BREAKER_ENABLED = os.getenv("AGENT_BREAKER_ENABLED", "true").lower() == "true"
+AGENT_BREAKER_FAILURE_RATE = float(os.getenv("AGENT_BREAKER_FAILURE_RATE", "0.5"))
+AGENT_BREAKER_SLOW_CALL_SECONDS = float(os.getenv("AGENT_BREAKER_SLOW_CALL_SECONDS", "20"))
+AGENT_BREAKER_SLOW_CALL_RATE = float(os.getenv("AGENT_BREAKER_SLOW_CALL_RATE", "0.8"))
+AGENT_BREAKER_MIN_CALLS = int(os.getenv("AGENT_BREAKER_MIN_CALLS", "10"))
+AGENT_BREAKER_WINDOW_SIZE = int(os.getenv("AGENT_BREAKER_WINDOW_SIZE", "50"))
+AGENT_BREAKER_WINDOW_SECONDS = float(os.getenv("AGENT_BREAKER_WINDOW_SECONDS", "60"))
+AGENT_BREAKER_OPEN_SECONDS = float(os.getenv("AGENT_BREAKER_OPEN_SECONDS", "30"))
+AGENT_BREAKER_HALF_OPEN_CALLS = int(os.getenv("AGENT_BREAKER_HALF_OPEN_CALLS", "3"))
+
+# 启动预热与优雅停机配置
+# 停机分两段：uvicorn先在GRACEFUL_TIMEOUT内等待进行中的请求，之后lifespan依次等待WebSocket回复和智能体调用
+# （共用AGENT_DRAIN_TIMEOUT）、写完消息队列（MESSAGE_DRAIN_TIMEOUT）；backend-service.sh的STOP_TIMEOUT按三者之和计算
+AGENT_DRAIN_TIMEOUT = float(os.getenv("AGENT_DRAIN_TIMEOUT", "10"))
+WARMUP_MAX_RETRY_DELAY = float(os.getenv("WARMUP_MAX_RETRY_DELAY", "10"))
+# 工作进程数（由run.py设置）。缓存、智能体调度、WebSocket事件分发、对话摘要等状态都在进程内，多进程时互不共享
+SERVER_WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "1") or 1))
+
+# WebSocket聊天通道配置
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "20"))  # 服务端ping间隔（秒）
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "60"))  # 超过该时间未收到客户端任何消息则断开
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "1024"))  # 单连接发送队列上限，写满时断开慢连接
+WS_REPLAY_BUFFER_SIZE = int(os.getenv("WS_REPLAY_BUFFER_SIZE", "1000"))  # 每个用户保留的最近事件数，用于断线续传
+WS_RESUME_TTL = float(os.getenv("WS_RESUME_TTL", "300"))  # 用户所有连接断开后事件序列的保留时间（秒）
+WS_MAX_CONCURRENT_SENDS = int(os.getenv("WS_MAX_CONCURRENT_SENDS", "4"))  # 每个用户同时生成中的回复数上限
+
+# 快速JSON序列化（需安装orjson，默认关闭）：热点接口跳过response_model校验，历史消息直接透传PostgREST响应体
+FAST_JSON = os.getenv("FAST_JSON", "false").lower() == "true"
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    if FAST_JSON:
+        logger.warning("未安装orjson依赖，FAST_JSON已关闭")
+        FAST_JSON = False
+
+# 聊天历史分页配置
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "200"))
+MESSAGE_COLUMNS = "id,role,content,timestamp"
+
+# 批量对话操作配置：单次请求最多包含的对话ID数
+CHAT_BULK_MAX_SIZE = int(os.getenv("CHAT_BULK_MAX_SIZE", "100"))
+CHAT_COLUMNS = "id,user_id,title,color,icon_color,created_at,updated_at"
+
+# 用户缓存配置（USER_CACHE_MAX_SIZE=0 时关闭）
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+USER_CACHE_NEGATIVE_TTL = float(os.getenv("USER_CACHE_NEGATIVE_TTL", "5"))
+
+# 对话元数据缓存配置（CHAT_CACHE_MAX_SIZE=0 时关闭）
+# 其他工作进程删除对话不会使本进程的缓存失效，多进程时默认TTL缩短为5秒
+CHAT_CACHE_MAX_SIZE = int(os.getenv("CHAT_CACHE_MAX_SIZE", "10000"))
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", "300" if SERVER_WORKERS == 1 else "5"))
+
+# 新会话首条消息的智能体回复缓存（AGENT_REPLY_CACHE_MAX_SIZE=0 时关闭，默认关闭）
+AGENT_REPLY_CACHE_MAX_SIZE = int(os.getenv("AGENT_REPLY_CACHE_MAX_SIZE", "0"))
+AGENT_REPLY_CACHE_TTL = float(os.getenv("AGENT_REPLY_CACHE_TTL", "3600"))
+AGENT_REPLY_CACHE_MAX_PROMPT_CHARS = int(os.getenv("AGENT_REPLY_CACHE_MAX_PROMPT_CHARS", "50"))
+AGENT_REPLY_CACHE_MAX_REPLY_CHARS = int(os.getenv("AGENT_REPLY_CACHE_MAX_REPLY_CHARS", "4000"))
+
+# 消息写入队列配置（write-behind，默认关闭）
+MESSAGE_WRITE_BEHIND = os.getenv("MESSAGE_WRITE_BEHIND", "false").lower() == "true"
+MESSAGE_QUEUE_MAX_SIZE = int(os.getenv("MESSAGE_QUEUE_MAX_SIZE", "10000"))
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "100"))
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", "0.05"))
+MESSAGE_FLUSH_MAX_RETRIES = int(os.getenv("MESSAGE_FLUSH_MAX_RETRIES", "5"))
+MESSAGE_QUEUE_PUT_TIMEOUT = float(os.getenv("MESSAGE_QUEUE_PUT_TIMEOUT", "1"))
+MESSAGE_DRAIN_TIMEOUT = float(os.getenv("MESSAGE_DRAIN_TIMEOUT", "10"))
+
+# 密码哈希配置
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# 服务运行状态：上游连接预热完成后才报告就绪，停机时置为draining
+service_state = {
+    "ready": False,
+    "draining": False,
+    "supabase_warm": False,
+    "agent_warm": False
+}
+
+async def warm_up_upstreams():
+    """预热上游连接（TLS/HTTP2握手），Supabase预热成功后服务才就绪"""
+    delay = 0.5
+    attempt = 0
+    while not service_state["draining"]:
+        attempt += 1
+        if not service_state["supabase_warm"]:
+            service_state["supabase_warm"] = await db_service.warm_up()
+        # 智能体不可用时有备用回复，预热失败不影响就绪
+        if agent_service and not service_state["agent_warm"]:
+            service_state["agent_warm"] = await agent_service.warm_up()
+        
+        if service_state["supabase_warm"]:
+            service_state["ready"] = True
+            logger.info("上游连接预热完成，服务就绪: agent_warm=%s", service_state['agent_warm'])
+            return
+        
+        logger.warning("Supabase连接预热失败（第%s次），%s秒后重试", attempt, delay)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, WARMUP_MAX_RETRY_DELAY)
+
+def mark_draining():
+    """进入停机状态：就绪检查返回503，预热循环退出"""
+    if not service_state["draining"]:
+        logger.info("收到停机信号，停止报告就绪")
+    service_state["ready"] = False
+    service_state["draining"] = True
+
+def install_drain_signal_handler():
+    """
+    SIGTERM时先标记draining再交给uvicorn原有的处理函数
+    
+    uvicorn收到信号后先等待进行中的请求（最长GRACEFUL_TIMEOUT）才执行lifespan关闭，
+    在信号处理中标记可以让就绪检查在这段时间内就报告draining。
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    previous = signal.getsignal(signal.SIGTERM)
+    
+    def handle_sigterm(signum, frame):
+        mark_draining()
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            signal.signal(signum, previous or signal.SIG_DFL)
+            signal.raise_signal(signum)
+    
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时建立共享连接池并预热，关闭时等待进行中的智能体调用后释放"""
+    if SERVER_WORKERS > 1:
+        logger.warning("以%s个工作进程运行：对话缓存、智能体调度、WebSocket事件分发和对话摘要只在进程内生效，"
+                       "对话缓存TTL已缩短，WebSocket通道会提示客户端继续轮询", SERVER_WORKERS)
+    install_drain_signal_handler()
+    await db_service.start()
+    if db_service.write_queue:
+        await db_service.write_queue.start()
+    if agent_service:
+        await agent_service.start()
+    warmup_task = asyncio.ensure_future(warm_up_upstreams())
+    lag_task = asyncio.ensure_future(monitor_event_loop_lag()) if METRICS_ENABLED else None
+    try:
+        yield
+    finally:
+        mark_draining()
+        warmup_task.cancel()
+        if lag_task:
+            lag_task.cancel()
+        # WebSocket回复与智能体调用共用一个等待期限
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + AGENT_DRAIN_TIMEOUT
+        await chat_hub.drain(AGENT_DRAIN_TIMEOUT)
+        if agent_service:
+            await agent_service.drain(max(0.0, deadline - loop.time()))
+            await agent_service.close()
+        if db_service.write_queue:
+            await db_service.write_queue.close()
+        await db_service.close()
+        password_hasher.close()
+
 app = FastAPI(
     title="DeepSeek Chat API",
     description="DeepSeek聊天应用后端API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # 添加CORS中间件
@@ -40,8 +589,84 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "ETag"],
 )
 
+class RequestContextMiddleware:
+    """为每个请求设置关联ID（X-Request-ID）及链路日志采样标记"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        
+        request_id = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        if not request_id or not request_id.isprintable():
+            request_id = uuid.uuid4().hex[:16]
+        
+        request_token = request_id_var.set(request_id)
+        sampled_token = trace_sampled_var.set(random.random() < SUPABASE_TRACE_SAMPLE_RATE)
+        
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-request-id", request_id.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            trace_sampled_var.reset(sampled_token)
+            request_id_var.reset(request_token)
+
+app.add_middleware(RequestContextMiddleware)
+
+class MetricsMiddleware:
+    """按路由模板记录请求数、耗时和并发数（路由在处理后从scope中的endpoint反查）"""
+    
+    def __init__(self, app):
+        self.app = app
+        self._routes = None
+    
+    def route_of(self, scope) -> str:
+        if self._routes is None:
+            self._routes = {route.endpoint: route.path for route in app.routes if hasattr(route, "endpoint")}
+        return self._routes.get(scope.get("endpoint"), "unmatched")
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        status = 500
+        
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+        
+        started = time.perf_counter()
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_IN_FLIGHT.inc(amount=-1)
+            route = self.route_of(scope)
+            HTTP_LATENCY.observe(time.perf_counter() - started, scope["method"], route)
+            HTTP_REQUESTS.inc(scope["method"], route, status)
+
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
 # 数据模型定义
 class User(BaseModel):
     id: str
@@ -94,366 +719,1976 @@ class Chat(BaseModel):
     created_at: str
     updated_at: str
 
-# 数据库服务类 - 使用HTTP请求直接连接Supabase
-class DatabaseService:
-    def __init__(self):
-        self.base_url = f"{SUPABASE_URL}/rest/v1"
-        self.headers = {
-            "apikey": SUPABASE_KEY,
-            "Authorization": f"Bearer {SUPABASE_KEY}",
-            "Content-Type": "application/json",
-            "Prefer": "return=representation"
+# 后台任务引用集合，防止任务在完成前被垃圾回收
+background_tasks = set()
+
+def run_in_background(coro):
+    """在后台执行协程，不阻塞当前请求"""
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# 缓存未命中标记，用于区分缓存的None（负缓存）与未缓存
+CACHE_MISS = object()
+
+# 进程内缓存类 - 带过期时间的LRU缓存
+class TTLCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key, default=CACHE_MISS):
+        """获取缓存值，不存在或已过期时返回default"""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key, value, ttl: Optional[float] = None):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        if self.max_size <= 0:
+            return
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+    
+    def peek(self, key, default=CACHE_MISS):
+        """获取未过期的缓存值，不影响LRU顺序和命中统计"""
+        entry = self._data.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            return default
+        return entry[0]
+    
+    def pop(self, key):
+        """删除缓存条目"""
+        self._data.pop(key, None)
+    
+    def clear(self):
+        """清空缓存"""
+        self._data.clear()
+    
+    def get_stats(self) -> dict:
+        """获取缓存命中情况"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions
         }
+
+# 密码哈希服务类 - 在有界线程池中执行bcrypt（bcrypt计算期间会释放GIL）
+class PasswordHasher:
+    def __init__(self, rounds: int = BCRYPT_ROUNDS, max_workers: int = PASSWORD_HASH_WORKERS):
+        self.rounds = rounds
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._semaphore = asyncio.Semaphore(max_workers)
+        
+        # 队列指标
+        self.waiting = 0
+        self.active = 0
+        self.max_waiting = 0
+        self.completed = 0
+        self.total_wait_ms = 0.0
     
-    def hash_password(self, password: str) -> str:
-        """哈希密码"""
-        salt = bcrypt.gensalt()
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """获取哈希线程池，未启动时按需创建"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix="bcrypt"
+            )
+        return self._executor
+    
+    def close(self):
+        """关闭哈希线程池"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+    
+    async def _run(self, func, *args):
+        """在并发上限内于线程池中执行bcrypt计算"""
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        
+        self.total_wait_ms += (time.perf_counter() - queued_at) * 1000
+        self.active += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self.active -= 1
+            self.completed += 1
+            self._semaphore.release()
+    
+    def _hash(self, password: str) -> str:
+        salt = bcrypt.gensalt(rounds=self.rounds)
         return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
     
-    def check_password(self, password: str, hashed: str) -> bool:
-        """验证密码"""
+    def _verify(self, password: str, hashed: str) -> bool:
         return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
     
-    async def get_user_by_identifier(self, identifier: str):
-        """通过用户名或邮箱获取用户"""
-        async with httpx.AsyncClient() as client:
-            try:
-                # 先尝试通过用户名查找
-                response = await client.get(
-                    f"{self.base_url}/users",
-                    headers=self.headers,
-                    params={"username": f"eq.{identifier}"}
-                )
-                if response.status_code == 200 and response.json():
-                    return response.json()[0]
-                
-                # 再尝试通过邮箱查找
-                response = await client.get(
-                    f"{self.base_url}/users",
-                    headers=self.headers,
-                    params={"email": f"eq.{identifier}"}
-                )
-                if response.status_code == 200 and response.json():
-                    return response.json()[0]
-                
-                return None
-            except Exception as e:
-                logger.error(f"查询用户失败: {e}")
-                return None
+    async def hash(self, password: str) -> str:
+        """哈希密码"""
+        return await self._run(self._hash, password)
     
-    async def create_user(self, username: str, email: str, password_hash: str):
-        """创建新用户"""
-        async with httpx.AsyncClient() as client:
-            try:
-                user_id = str(uuid.uuid4())
-                user_data = {
-                    'id': user_id,
-                    'username': username,
-                    'email': email,
-                    'password_hash': password_hash,
-                    'avatar_url': 'https://design.gemcoder.com/staticResource/echoAiSystemImages/3af53b10252ba2331a996da3c32fd378.png',
-                    'plan': '个人版'
-                }
-                
-                response = await client.post(
-                    f"{self.base_url}/users",
-                    headers=self.headers,
-                    json=user_data
-                )
-                
-                if response.status_code == 201:
-                    return response.json()[0]
-                else:
-                    logger.error(f"创建用户失败，状态码: {response.status_code}, 响应: {response.text}")
-                    return None
-            except Exception as e:
-                logger.error(f"创建用户失败: {e}")
-                return None
+    async def verify(self, password: str, hashed: str) -> bool:
+        """验证密码"""
+        return await self._run(self._verify, password, hashed)
     
-    async def create_chat(self, user_id: str, title: str = "新对话"):
-        """创建新对话"""
-        async with httpx.AsyncClient() as client:
-            try:
-                logger.info(f"准备创建对话: user_id={user_id}, title={title}")
-                
-                chat_id = str(uuid.uuid4())
-                chat_data = {
-                    'id': chat_id,
-                    'user_id': user_id,
-                    'title': title,
-                    'color': 'bg-blue-100',
-                    'icon_color': 'text-blue-500'
-                }
-                
-                logger.info(f"发送对话数据到Supabase: {chat_data}")
-                
-                response = await client.post(
-                    f"{self.base_url}/chats",
-                    headers=self.headers,
-                    json=chat_data
-                )
-                
-                logger.info(f"Supabase对话创建响应状态码: {response.status_code}")
-                logger.info(f"Supabase对话创建响应内容: {response.text}")
-                
-                if response.status_code == 201:
-                    result = response.json()[0]
-                    logger.info(f"对话创建成功: {result}")
-                    return result
-                else:
-                    logger.error(f"创建对话失败，状态码: {response.status_code}, 响应: {response.text}")
-                    return None
-            except Exception as e:
-                logger.error(f"创建对话失败: {e}", exc_info=True)
-                return None
+    def needs_rehash(self, hashed: str) -> bool:
+        """判断哈希的cost是否与当前配置不一致"""
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return False
     
-    async def get_user_chats(self, user_id: str):
-        """获取用户的所有对话"""
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.get(
-                    f"{self.base_url}/chats",
-                    headers=self.headers,
-                    params={
-                        "user_id": f"eq.{user_id}",
-                        "order": "created_at.desc"
-                    }
-                )
-                
-                if response.status_code == 200:
-                    return response.json()
-                return []
-            except Exception as e:
-                logger.error(f"获取用户对话失败: {e}")
-                return []
+    def get_stats(self) -> dict:
+        """获取线程池队列指标"""
+        return {
+            "rounds": self.rounds,
+            "max_workers": self.max_workers,
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "max_queue_depth": self.max_waiting,
+            "completed": self.completed,
+            "avg_wait_ms": round(self.total_wait_ms / self.completed, 2) if self.completed else 0.0
+        }
 
-    async def get_user_chats_paginated(self, user_id: str, page: int = 1, page_size: int = 10):
-        """获取用户的分页对话列表"""
-        async with httpx.AsyncClient() as client:
-            try:
-                offset = (page - 1) * page_size
-                response = await client.get(
-                    f"{self.base_url}/chats",
-                    headers=self.headers,
-                    params={
-                        "user_id": f"eq.{user_id}",
-                        "order": "created_at.desc",
-                        "limit": page_size,
-                        "offset": offset
-                    }
-                )
-                
-                if response.status_code == 200:
-                    return response.json()
-                return []
-            except Exception as e:
-                logger.error(f"获取用户分页对话失败: {e}")
-                return []
+# 全局密码哈希服务实例
+password_hasher = PasswordHasher()
 
-    async def get_user_chats_count(self, user_id: str):
-        """获取用户对话总数"""
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.get(
-                    f"{self.base_url}/chats",
-                    headers=self.headers,
-                    params={
-                        "user_id": f"eq.{user_id}",
-                        "select": "count"
-                    }
-                )
-                
-                if response.status_code == 200:
-                    # Supabase返回的count格式
-                    count_data = response.json()
-                    if isinstance(count_data, list) and len(count_data) > 0:
-                        return count_data[0].get('count', 0)
-                    return 0
-                return 0
-            except Exception as e:
-                logger.error(f"获取用户对话总数失败: {e}")
-                return 0
+# 消息写入队列类 - 异步合并消息插入，批量写入Supabase
+@dataclass
+class InsertResult:
+    """
+    批量写入消息的结果（与存储后端无关）
+    
+    ok为True表示全部写入（已存在的ID视为已写入）；失败时retryable表示是否为暂时性错误，
+    不可重试的错误（如对话已删除导致外键冲突）由写入队列拆分为单条写入。
+    """
+    ok: bool
+    retryable: bool = False
+    error: Optional[str] = None
 
-    async def save_message(self, chat_id: str, role: str, content: str, timestamp: int):
-        """创建消息"""
-        async with httpx.AsyncClient() as client:
-            try:
-                logger.info(f"准备保存消息: chat_id={chat_id}, role={role}, content长度={len(content)}, timestamp={timestamp}")
-                
-                message_id = str(uuid.uuid4())
-                message_data = {
-                    'id': message_id,
-                    'chat_id': chat_id,
-                    'role': role,
-                    'content': content,
-                    'timestamp': timestamp
-                }
-                
-                logger.info(f"发送消息数据到Supabase: {message_data}")
-                
-                response = await client.post(
-                    f"{self.base_url}/messages",
-                    headers=self.headers,
-                    json=message_data
-                )
-                
-                logger.info(f"Supabase响应状态码: {response.status_code}")
-                logger.info(f"Supabase响应内容: {response.text}")
-                
-                if response.status_code == 201:
-                    result = response.json()[0]
-                    logger.info(f"消息保存成功: {result}")
-                    return result
-                else:
-                    logger.error(f"创建消息失败，状态码: {response.status_code}, 响应: {response.text}")
-                    return None
-            except Exception as e:
-                logger.error(f"创建消息失败: {e}", exc_info=True)
-                return None
+class MessageWriteQueue:
+    def __init__(self, db: "DatabaseService", max_size: int = MESSAGE_QUEUE_MAX_SIZE,
+                 batch_size: int = MESSAGE_BATCH_SIZE, flush_interval: float = MESSAGE_FLUSH_INTERVAL,
+                 max_retries: int = MESSAGE_FLUSH_MAX_RETRIES):
+        self.db = db
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue = asyncio.Queue(maxsize=max_size)
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        
+        # 队列指标
+        self.enqueued = 0
+        self.flushed = 0
+        self.batches = 0
+        self.retries = 0
+        self.failed = 0
+        self.dropped = 0
+        self.backpressure_waits = 0
     
-    async def check_chat_exists(self, chat_id: str):
-        """检查对话是否存在"""
-        async with httpx.AsyncClient() as client:
-            try:
-                logger.info(f"检查对话是否存在: chat_id={chat_id}")
-                
-                response = await client.get(
-                    f"{self.base_url}/chats",
-                    headers=self.headers,
-                    params={
-                        "id": f"eq.{chat_id}",
-                        "select": "id"
-                    }
-                )
-                
-                logger.info(f"检查对话存在性响应状态码: {response.status_code}")
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    exists = len(result) > 0
-                    logger.info(f"对话存在性检查结果: {exists}")
-                    return exists
-                else:
-                    logger.error(f"检查对话存在性失败，状态码: {response.status_code}, 响应: {response.text}")
-                    return False
-            except Exception as e:
-                logger.error(f"检查对话存在性失败: {e}", exc_info=True)
-                return False
+    async def start(self):
+        """启动后台刷写任务"""
+        if self._task is None or self._task.done():
+            self._closing = False
+            self._task = asyncio.ensure_future(self._run())
+            logger.info("消息写入队列已启动: batch_size=%s, flush_interval=%ss", self.batch_size, self.flush_interval)
     
-    async def create_chat_with_id(self, user_id: str, chat_id: str, title: str = "新对话"):
-        """使用指定ID创建新对话"""
-        async with httpx.AsyncClient() as client:
-            try:
-                logger.info(f"准备使用指定ID创建对话: user_id={user_id}, chat_id={chat_id}, title={title}")
-                
-                chat_data = {
-                    'id': chat_id,
-                    'user_id': user_id,
-                    'title': title,
-                    'color': 'bg-blue-100',
-                    'icon_color': 'text-blue-500'
-                }
-                
-                logger.info(f"发送对话数据到Supabase: {chat_data}")
-                
-                response = await client.post(
-                    f"{self.base_url}/chats",
-                    headers=self.headers,
-                    json=chat_data
-                )
-                
-                logger.info(f"Supabase对话创建响应状态码: {response.status_code}")
-                logger.info(f"Supabase对话创建响应内容: {response.text}")
-                
-                if response.status_code == 201:
-                    result = response.json()[0]
-                    logger.info(f"使用指定ID创建对话成功: {result}")
-                    return result
-                else:
-                    logger.error(f"使用指定ID创建对话失败，状态码: {response.status_code}, 响应: {response.text}")
-                    return None
-            except Exception as e:
-                logger.error(f"使用指定ID创建对话失败: {e}", exc_info=True)
-                return None
+    async def close(self, timeout: float = MESSAGE_DRAIN_TIMEOUT):
+        """停止接收新消息，并在超时时间内写完队列中剩余的消息"""
+        if self._task is None:
+            return
+        self._closing = True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            # 结束标记排在所有已入队消息之后，保证先写完再退出；入队与写完共用一个期限
+            await asyncio.wait_for(self._queue.put(None), timeout)
+            await asyncio.wait_for(self._task, max(0.0, deadline - loop.time()))
+            logger.info("消息写入队列已排空: flushed=%s", self.flushed)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+            logger.error("消息写入队列排空超时，未写入消息数: %s", self._queue.qsize())
+        self._task = None
     
-    async def update_chat_title(self, chat_id: str, title: str):
-        """更新对话标题"""
-        async with httpx.AsyncClient() as client:
+    async def _drain_remaining(self):
+        """
+        写完结束标记之后入队的消息
+        
+        close前已在put中等待（队列满）的生产者会在腾出空间后入队，排在结束标记之后；
+        每轮先让出一次事件循环，使已被唤醒的生产者完成入队，直到队列为空。
+        """
+        while True:
+            await asyncio.sleep(0)
+            if self._queue.empty():
+                return
+            batch = []
+            while len(batch) < self.batch_size and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is not None:
+                    batch.append(item)
+            if batch:
+                await self._flush(batch)
+    
+    async def enqueue(self, message: dict) -> bool:
+        """
+        将消息加入写入队列
+        
+        Returns:
+            bool: 是否成功入队；队列关闭或持续满载（背压超时）时返回False
+        """
+        if self._closing or self._task is None:
+            return False
+        if self._queue.full():
+            self.backpressure_waits += 1
+        try:
+            await asyncio.wait_for(self._queue.put(message), MESSAGE_QUEUE_PUT_TIMEOUT)
+        except asyncio.TimeoutError:
+            return False
+        self.enqueued += 1
+        return True
+    
+    async def _run(self):
+        """后台刷写循环：按数量或时间合并批次"""
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is None:
+                break
+            
+            # 队列中不足一批时等待一个刷写间隔，合并更多消息
+            if self.flush_interval > 0 and self._queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.flush_interval)
+            
+            batch = [first]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            
+            await self._flush(batch)
+        await self._drain_remaining()
+    
+    async def _flush(self, batch: List[dict]):
+        """写入一批消息，失败时按指数退避重试（消息ID由客户端生成，重试是幂等的）"""
+        for attempt in range(self.max_retries + 1):
             try:
-                logger.info(f"准备更新对话标题: chat_id={chat_id}, title={title}")
-                
-                update_data = {
-                    'title': title
-                }
+                result = await self.db.insert_messages(batch)
+                if result.ok:
+                    self.batches += 1
+                    self.flushed += len(batch)
+                    return
                 
-                response = await client.patch(
-                    f"{self.base_url}/chats",
-                    headers=self.headers,
-                    json=update_data,
-                    params={"id": f"eq.{chat_id}"}
-                )
-                
-                logger.info(f"Supabase对话标题更新响应状态码: {response.status_code}")
-                logger.info(f"Supabase对话标题更新响应内容: {response.text}")
-                
-                if response.status_code == 200 or response.status_code == 204:
-                    logger.info(f"更新对话标题成功: {chat_id}, title: {title}")
-                    return True
-                else:
-                    logger.error(f"更新对话标题失败，状态码: {response.status_code}, 响应: {response.text}")
-                    return False
+                if not result.retryable:
+                    # 不可重试的错误（如对话已删除导致外键冲突），拆分为单条写入以免影响同批其他消息
+                    if len(batch) > 1:
+                        for message in batch:
+                            await self._flush([message])
+                        return
+                    self.failed += 1
+                    logger.error("批量写入消息失败: %s, message_id: %s", result.error, batch[0]['id'])
+                    return
+                error = result.error
             except Exception as e:
-                logger.error(f"更新对话标题失败: {e}", exc_info=True)
-                return False
+                error = repr(e)
+            
+            if attempt < self.max_retries:
+                self.retries += 1
+                delay = min(0.1 * 2 ** attempt, 5) * (0.5 + random.random())
+                logger.warning("批量写入消息失败，%.2f秒后重试: %s", delay, error)
+                await asyncio.sleep(delay)
+        
+        self.dropped += len(batch)
+        logger.error("批量写入消息重试次数耗尽，丢弃消息数: %s", len(batch))
     
-    async def get_chat_messages(self, chat_id: str):
-        """获取对话的所有消息"""
-        async with httpx.AsyncClient() as client:
+    def get_stats(self) -> dict:
+        """获取队列指标"""
+        return {
+            "enabled": True,
+            "queue_size": self._queue.qsize(),
+            "max_size": self.max_size,
+            "batch_size": self.batch_size,
+            "flush_interval": self.flush_interval,
+            "enqueued": self.enqueued,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "retries": self.retries,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "backpressure_waits": self.backpressure_waits
+        }
+
+class RawJSON(bytes):
+    """已编码的JSON（如PostgREST原始响应体），序列化时原样拼接"""
+
+def encode_json(content: dict) -> bytes:
+    """用orjson编码响应体；顶层值为RawJSON时直接拼接字节，不再解析和重新编码"""
+    if not any(isinstance(value, RawJSON) for value in content.values()):
+        return orjson.dumps(content)
+    parts = [
+        orjson.dumps(key) + b":" + (value if isinstance(value, RawJSON) else orjson.dumps(value))
+        for key, value in content.items()
+    ]
+    return b"{" + b",".join(parts) + b"}"
+
+class FastJSONResponse(Response):
+    """orjson编码的JSON响应，不经过jsonable_encoder"""
+    media_type = "application/json"
+    
+    def render(self, content) -> bytes:
+        return encode_json(content)
+
+def fast_json(content: dict, headers: Optional[dict] = None):
+    """FAST_JSON开启时直接返回编码好的响应（跳过response_model二次校验），否则返回dict交给FastAPI处理"""
+    if FAST_JSON:
+        return FastJSONResponse(content, headers=headers)
+    return content
+
+class StorageBackend(ABC):
+    """
+    存储后端接口：用户、对话和消息的读写
+    
+    子类实现具体存储（DatabaseService: Supabase REST；SQLiteStorage: 本地SQLite），
+    基类提供与存储无关的部分：用户和对话元数据缓存、密码哈希、对话游标编码、消息写入队列。
+    """
+    
+    def __init__(self):
+        # 用户记录缓存，同时以用户名和邮箱为键
+        self.user_cache = TTLCache(USER_CACHE_MAX_SIZE, USER_CACHE_TTL)
+        # 对话元数据缓存：id、user_id、title、has_messages（None表示未知）
+        self.chat_cache = TTLCache(CHAT_CACHE_MAX_SIZE, CHAT_CACHE_TTL)
+        # 消息异步批量写入队列（未启用时直接写入）
+        self.write_queue = MessageWriteQueue(self) if MESSAGE_WRITE_BEHIND else None
+    
+    @abstractmethod
+    async def start(self):
+        """初始化连接或连接池"""
+    
+    @abstractmethod
+    async def close(self):
+        """释放连接"""
+    
+    @abstractmethod
+    async def warm_up(self) -> bool:
+        """预热连接，返回存储是否可用"""
+    
+    @abstractmethod
+    def get_pool_stats(self) -> dict:
+        """获取连接池使用情况"""
+    
+    @abstractmethod
+    async def find_users_by_identifiers(self, *identifiers: str):
+        """一次查询获取用户名或邮箱匹配任一标识的所有用户，查询失败时返回None"""
+    
+    @abstractmethod
+    async def find_user_by_id(self, user_id: str):
+        """按ID查询用户，不存在或查询失败时返回None"""
+    
+    @abstractmethod
+    async def create_user(self, username: str, email: str, password_hash: str):
+        """创建新用户，失败返回None"""
+    
+    @abstractmethod
+    async def rehash_password(self, user_id: str, password: str):
+        """使用当前cost重新哈希密码并更新"""
+    
+    @abstractmethod
+    async def create_chat(self, user_id: str, title: str = "新对话"):
+        """创建新对话，失败返回None"""
+    
+    @abstractmethod
+    async def create_chat_with_id(self, user_id: str, chat_id: str, title: str = "新对话"):
+        """使用指定ID创建新对话，失败返回None"""
+    
+    @abstractmethod
+    async def get_user_chats(self, user_id: str):
+        """获取用户的所有对话（按创建时间倒序）"""
+    
+    @abstractmethod
+    async def get_user_chats_page(self, user_id: str, page_size: int = 10, page: Optional[int] = None,
+                                  cursor: Optional[str] = None, count: Optional[str] = None) -> dict:
+        """获取用户的一页对话，返回chats、total_count、next_cursor、has_more；游标无效时抛出ValueError"""
+    
+    @abstractmethod
+    async def save_message(self, chat_id: str, role: str, content: str, timestamp: int):
+        """保存消息，失败返回None"""
+    
+    @abstractmethod
+    async def insert_messages(self, messages: List[dict]) -> InsertResult:
+        """批量插入消息（按id幂等），返回结果供写入队列判断是否重试"""
+    
+    @abstractmethod
+    async def get_chat_state(self, chat_id: str):
+        """获取对话的id、user_id、title、has_messages，不存在时返回None"""
+    
+    @abstractmethod
+    async def update_chat_title(self, chat_id: str, title: str):
+        """更新对话标题"""
+    
+    @abstractmethod
+    async def get_chat_messages(self, chat_id: str, limit: Optional[int] = None,
+                                before_timestamp: Optional[int] = None, since_timestamp: Optional[int] = None,
+                                columns: str = MESSAGE_COLUMNS, raw: bool = False, strict: bool = False):
+        """获取对话的消息（按时间升序），raw为True时返回RawJSON；strict为True时查询失败返回None而不是空列表"""
+    
+    @abstractmethod
+    async def delete_chat(self, chat_id: str):
+        """删除对话及其所有消息，成功时返回被删除的对话（含user_id），对话不存在或失败返回False"""
+    
+    @abstractmethod
+    async def get_chats_by_ids(self, user_id: str, chat_ids: List[str]) -> Optional[List[dict]]:
+        """一次查询获取属于该用户的指定对话（不存在或不属于该用户的ID不返回），失败返回None"""
+    
+    @abstractmethod
+    async def get_latest_chat_messages(self, user_id: str, limit: int, columns: str = MESSAGE_COLUMNS) -> Optional[dict]:
+        """
+        一次查询获取用户最新对话（与对话列表同序）的最新limit条消息
+        
+        Returns:
+            Optional[dict]: chat_id（用户没有对话时为None）和按时间升序的messages，查询失败返回None
+        """
+    
+    @abstractmethod
+    async def delete_chats(self, user_id: str, chat_ids: List[str]) -> Optional[List[str]]:
+        """一次删除属于该用户的指定对话及其消息，返回实际删除的对话ID，失败返回None"""
+    
+    def get_read_stats(self) -> dict:
+        """读取请求合并统计（仅Supabase后端支持）"""
+        return {"enabled": False}
+    
+    async def hash_password(self, password: str) -> str:
+        """哈希密码（在线程池中执行）"""
+        return await password_hasher.hash(password)
+    
+    async def check_password(self, password: str, hashed: str) -> bool:
+        """验证密码（在线程池中执行）"""
+        return await password_hasher.verify(password, hashed)
+    
+    def _cache_user(self, user: dict):
+        """以用户名、邮箱和ID为键缓存用户记录"""
+        self.user_cache.set(('username', user['username']), user)
+        self.user_cache.set(('email', user['email']), user)
+        self.user_cache.set(('id', user['id']), user)
+    
+    def _invalidate_user(self, *identifiers: str):
+        """使用户名或邮箱对应的缓存失效"""
+        for identifier in identifiers:
+            self.user_cache.pop(('username', identifier))
+            self.user_cache.pop(('email', identifier))
+    
+    @timed_db_method
+    async def get_user_by_id(self, user_id: str):
+        """通过ID获取用户（优先使用缓存）"""
+        cached = self.user_cache.get(('id', user_id))
+        if cached is not CACHE_MISS:
+            return cached
+        user = await self.find_user_by_id(user_id)
+        if user:
+            self._cache_user(user)
+        return user
+    
+    @timed_db_method
+    async def get_user_by_identifier(self, identifier: str):
+        """通过用户名或邮箱获取用户（优先匹配用户名）"""
+        for key in (('username', identifier), ('email', identifier)):
+            cached = self.user_cache.get(key)
+            if cached is not CACHE_MISS and cached is not None:
+                return cached
+        if self.user_cache.get(('identifier', identifier)) is None:
+            # 近期已确认不存在（负缓存）
+            return None
+        
+        users = await self.find_users_by_identifiers(identifier)
+        if users is None:
+            return None
+        
+        user = next((u for u in users if u['username'] == identifier), None)
+        if user is None:
+            user = next((u for u in users if u['email'] == identifier), None)
+        if user is None:
+            self.user_cache.set(('identifier', identifier), None, USER_CACHE_NEGATIVE_TTL)
+        return user
+    
+    def _cache_chat(self, chat: dict, has_messages: Optional[bool] = None):
+        """缓存对话元数据；has_messages未知时保留已缓存的值"""
+        if has_messages is None:
+            cached = self.chat_cache.peek(chat['id'])
+            if cached is not CACHE_MISS:
+                has_messages = cached['has_messages']
+        self.chat_cache.set(chat['id'], {
+            'id': chat['id'],
+            'user_id': chat.get('user_id'),
+            'title': chat.get('title'),
+            'has_messages': has_messages
+        })
+    
+    def _can_write_behind(self, chat_id: str) -> bool:
+        """
+        是否可以通过写入队列异步保存消息
+        
+        异步写入在入队时就返回成功，对话已被删除导致的外键失败无法再告知调用方，
+        因此只在对话有未过期的缓存（刚确认过存在）时入队，否则直接写入。
+        """
+        return self.write_queue is not None and self.chat_cache.peek(chat_id) is not CACHE_MISS
+    
+    def _mark_chat_has_messages(self, chat_id: str):
+        """对话保存消息后更新缓存中的has_messages"""
+        cached = self.chat_cache.peek(chat_id)
+        if cached is not CACHE_MISS:
+            cached['has_messages'] = True
+    
+    @staticmethod
+    def encode_chat_cursor(chat: dict) -> str:
+        """将对话的(created_at, id)编码为不透明游标"""
+        raw = json.dumps([chat['created_at'], chat['id']], separators=(',', ':'))
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+    
+    @staticmethod
+    def decode_chat_cursor(cursor: str) -> Tuple[str, str]:
+        """
+        解析对话分页游标
+        
+        Raises:
+            ValueError: 游标格式无效
+        """
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            created_at, chat_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+            return str(created_at), str(chat_id)
+        except Exception as e:
+            raise ValueError(f"无效的分页游标: {cursor}") from e
+
+# 数据库服务类 - 使用HTTP请求直接连接Supabase
+class DatabaseService(StorageBackend):
+    """Supabase存储后端：通过PostgREST接口读写，共享HTTP/2长连接池"""
+    
+    def __init__(self):
+        super().__init__()
+        self.base_url = f"{SUPABASE_URL}/rest/v1"
+        self.headers = {
+            "apikey": SUPABASE_KEY,
+            "Authorization": f"Bearer {SUPABASE_KEY}",
+            "Content-Type": "application/json",
+            "Prefer": "return=representation"
+        }
+        self._client: Optional[httpx.AsyncClient] = None
+        self._http2 = SUPABASE_HTTP2
+        # 自定义传输层，基准测试时替换为本地PostgREST替身
+        self.http_transport: Optional[httpx.AsyncBaseTransport] = None
+        # 进行中的读取：键为(表, 参数, Prefer)，按scope（"chat:ID"/"user:ID"）索引以便写入后失效
+        self._inflight_reads: Dict[tuple, asyncio.Task] = {}
+        self._inflight_scopes: Dict[str, set] = {}
+        self.read_stats = {"upstream": 0, "coalesced": 0, "invalidated": 0}
+    
+    def _create_client(self) -> httpx.AsyncClient:
+        """创建长连接复用的HTTP客户端（支持HTTP/2）"""
+        http2 = SUPABASE_HTTP2
+        if http2:
             try:
-                response = await client.get(
-                    f"{self.base_url}/messages",
-                    headers=self.headers,
-                    params={
-                        "chat_id": f"eq.{chat_id}",
-                        "order": "timestamp.asc"
-                    }
-                )
-                
-                if response.status_code == 200:
-                    return response.json()
-                return []
-            except Exception as e:
-                logger.error(f"获取对话消息失败: {e}")
-                return []
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("未安装h2依赖，Supabase连接回退到HTTP/1.1")
+                http2 = False
+        self._http2 = http2
+        
+        return InstrumentedAsyncClient(
+            "supabase",
+            http2=http2,
+            transport=self.http_transport,
+            limits=httpx.Limits(
+                max_connections=SUPABASE_MAX_CONNECTIONS,
+                max_keepalive_connections=SUPABASE_MAX_KEEPALIVE,
+                keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(
+                SUPABASE_TIMEOUT,
+                connect=SUPABASE_CONNECT_TIMEOUT,
+                pool=SUPABASE_POOL_TIMEOUT
+            )
+        )
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """获取共享HTTP客户端，未启动时按需创建"""
+        if self._client is None or self._client.is_closed:
+            self._client = self._create_client()
+        return self._client
+    
+    async def start(self):
+        """初始化共享连接池"""
+        if self._client is None or self._client.is_closed:
+            self._client = self._create_client()
+        logger.info("Supabase连接池已创建: http2=%s, max_connections=%s, max_keepalive=%s",
+                    self._http2, SUPABASE_MAX_CONNECTIONS, SUPABASE_MAX_KEEPALIVE)
+    
+    async def close(self):
+        """关闭共享连接池"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+            logger.info("Supabase连接池已关闭")
+        self._client = None
+    
+    async def _get(self, table: str, params: dict, scope: str, headers: Optional[dict] = None) -> httpx.Response:
+        """
+        合并相同的读取请求：表、参数和Prefer都相同的GET同时进行时共用一次上游调用，结果分发给所有等待者
+        
+        上游调用在独立任务中执行，某个等待者被取消不影响其他等待者。
+        写入后调用_invalidate_reads使该scope下进行中的读取不再被复用，之后到达的读取会重新查询。
+        """
+        headers = headers or self.headers
+        url = f"{self.base_url}/{table}"
+        if not SUPABASE_COALESCE_READS:
+            return await self.client.get(url, headers=headers, params=params)
+        
+        key = (table, tuple(sorted((name, str(value)) for name, value in params.items())), headers.get("Prefer"))
+        task = self._inflight_reads.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.client.get(url, headers=headers, params=params))
+            self._inflight_reads[key] = task
+            self._inflight_scopes.setdefault(scope, set()).add(key)
+            task.add_done_callback(functools.partial(self._forget_read, key, scope))
+            self.read_stats["upstream"] += 1
+        else:
+            self.read_stats["coalesced"] += 1
+            DB_COALESCED_READS.inc(table)
+        return await asyncio.shield(task)
+    
+    def _forget_read(self, key: tuple, scope: str, task: asyncio.Task):
+        if not task.cancelled():
+            task.exception()  # 所有等待者都已取消时避免未获取异常的警告
+        if self._inflight_reads.get(key) is task:
+            del self._inflight_reads[key]
+            keys = self._inflight_scopes.get(scope)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._inflight_scopes[scope]
+    
+    def _invalidate_reads(self, *scopes: str):
+        """写入后使相关的进行中读取失效（已在等待的请求仍拿到原结果）"""
+        for scope in scopes:
+            for key in self._inflight_scopes.pop(scope, ()):
+                if self._inflight_reads.pop(key, None) is not None:
+                    self.read_stats["invalidated"] += 1
+    
+    def get_read_stats(self) -> dict:
+        """读取合并统计：upstream为实际发起的上游读取数，coalesced为节省的上游调用数"""
+        total = self.read_stats["upstream"] + self.read_stats["coalesced"]
+        return {
+            "enabled": SUPABASE_COALESCE_READS,
+            **self.read_stats,
+            "in_flight": len(self._inflight_reads),
+            "saved_ratio": round(self.read_stats["coalesced"] / total, 4) if total else 0.0
+        }
+    
+    async def warm_up(self) -> bool:
+        """预热连接池（建立TLS/HTTP2连接），返回Supabase是否可用"""
+        try:
+            response = await self.client.get(
+                f"{self.base_url}/chats",
+                headers=self.headers,
+                params={"select": "id", "limit": 1}
+            )
+            return response.status_code < 500
+        except Exception as e:
+            logger.warning("Supabase连接预热失败: %r", e)
+            return False
+    
+    def get_pool_stats(self) -> dict:
+        """获取连接池使用情况"""
+        stats = {
+            "http2": self._http2,
+            "max_connections": SUPABASE_MAX_CONNECTIONS,
+            "max_keepalive_connections": SUPABASE_MAX_KEEPALIVE,
+            "keepalive_expiry": SUPABASE_KEEPALIVE_EXPIRY,
+            "open_connections": 0,
+            "in_use_connections": 0,
+            "idle_connections": 0
+        }
+        if self._client is None or self._client.is_closed:
+            return stats
+        
+        # 连接数来自httpx/httpcore的内部属性，版本变化或使用自定义transport时标记为unavailable
+        try:
+            pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+            connections = list(getattr(pool, "connections"))
+            idle = sum(1 for conn in connections if conn.is_idle())
+        except (AttributeError, TypeError):
+            stats.update(open_connections="unavailable", in_use_connections="unavailable", idle_connections="unavailable")
+            return stats
+        stats["open_connections"] = len(connections)
+        stats["idle_connections"] = idle
+        stats["in_use_connections"] = len(connections) - idle
+        return stats
+    
+    @timed_db_method
+    async def rehash_password(self, user_id: str, password: str):
+        """使用当前cost重新哈希密码并更新到数据库"""
+        client = self.client
+        try:
+            password_hash = await self.hash_password(password)
+            response = await client.patch(
+                f"{self.base_url}/users",
+                headers=self.headers,
+                json={'password_hash': password_hash},
+                params={"id": f"eq.{user_id}"}
+            )
+            
+            if response.status_code in [200, 204]:
+                for user in response.json() if response.status_code == 200 else []:
+                    self._cache_user(user)
+                logger.info("已按新的cost重新哈希用户密码: %s", user_id)
+                return True
+            else:
+                logger.error("重新哈希用户密码失败，状态码: %s, 响应: %s", response.status_code, response.text)
+                return False
+        except Exception as e:
+            logger.error("重新哈希用户密码失败: %s", e, exc_info=True)
+            return False
+    
+    @timed_db_method
+    async def find_users_by_identifiers(self, *identifiers: str):
+        """
+        一次查询获取用户名或邮箱匹配任一标识的所有用户
+        
+        Returns:
+            Optional[list]: 匹配的用户列表，查询失败时返回None
+        """
+        client = self.client
+        try:
+            # PostgREST的or过滤条件中，值用双引号包裹以支持逗号、括号等字符
+            conditions = []
+            for identifier in identifiers:
+                quoted = '"' + identifier.replace('\\', '\\\\').replace('"', '\\"') + '"'
+                conditions.append(f"username.eq.{quoted}")
+                conditions.append(f"email.eq.{quoted}")
+            
+            response = await client.get(
+                f"{self.base_url}/users",
+                headers=self.headers,
+                params={"or": f"({','.join(conditions)})"}
+            )
+            if response.status_code != 200:
+                logger.error("查询用户失败，状态码: %s, 响应: %s", response.status_code, response.text)
+                return None
+            
+            users = response.json()
+            for user in users:
+                self._cache_user(user)
+            return users
+        except Exception as e:
+            logger.error("查询用户失败: %s", e)
+            return None
+    
+    @timed_db_method
+    async def find_user_by_id(self, user_id: str):
+        """按ID查询用户，不存在或查询失败时返回None"""
+        try:
+            response = await self.client.get(
+                f"{self.base_url}/users",
+                headers=self.headers,
+                params={"id": f"eq.{user_id}"}
+            )
+            if response.status_code != 200:
+                logger.error("查询用户失败，状态码: %s, 响应: %s", response.status_code, response.text)
+                return None
+            users = response.json()
+            return users[0] if users else None
+        except Exception as e:
+            logger.error("查询用户失败: %s", e)
+            return None
+    
+    @timed_db_method
+    async def create_user(self, username: str, email: str, password_hash: str):
+        """创建新用户"""
+        client = self.client
+        try:
+            user_id = str(uuid.uuid4())
+            user_data = {
+                'id': user_id,
+                'username': username,
+                'email': email,
+                'password_hash': password_hash,
+                'avatar_url': 'https://design.gemcoder.com/staticResource/echoAiSystemImages/3af53b10252ba2331a996da3c32fd378.png',
+                'plan': '个人版'
+            }
+            
+            response = await client.post(
+                f"{self.base_url}/users",
+                headers=self.headers,
+                json=user_data
+            )
+            
+            if response.status_code == 201:
+                user = response.json()[0]
+                self._invalidate_user(username, email)
+                self.user_cache.pop(('identifier', username))
+                self.user_cache.pop(('identifier', email))
+                self._cache_user(user)
+                return user
+            else:
+                logger.error("创建用户失败，状态码: %s, 响应: %s", response.status_code, response.text)
+                return None
+        except Exception as e:
+            logger.error("创建用户失败: %s", e)
+            return None
+    
+    @timed_db_method
+    async def create_chat(self, user_id: str, title: str = "新对话"):
+        """创建新对话"""
+        client = self.client
+        try:
+            logger.info("准备创建对话: user_id=%s, title=%s", user_id, title)
+            
+            chat_id = str(uuid.uuid4())
+            chat_data = {
+                'id': chat_id,
+                'user_id': user_id,
+                'title': title,
+                'color': 'bg-blue-100',
+                'icon_color': 'text-blue-500'
+            }
+            
+            supabase_trace("发送对话数据到Supabase: %s", chat_data)
+            
+            response = await client.post(
+                f"{self.base_url}/chats",
+                headers=self.headers,
+                json=chat_data
+            )
+            
+            supabase_trace("Supabase对话创建响应状态码: %s", response.status_code)
+            supabase_trace("Supabase对话创建响应内容: %s", response)
+            
+            if response.status_code == 201:
+                result = response.json()[0]
+                supabase_trace("对话创建成功: %s", result)
+                self._cache_chat(result, has_messages=False)
+                self._invalidate_reads(f"user:{user_id}")
+                return result
+            else:
+                logger.error("创建对话失败，状态码: %s, 响应: %s", response.status_code, response.text)
+                return None
+        except Exception as e:
+            logger.error("创建对话失败: %s", e, exc_info=True)
+            return None
+    
+    @timed_db_method
+    async def get_user_chats(self, user_id: str):
+        """获取用户的所有对话"""
+        try:
+            response = await self._get("chats", {
+                "user_id": f"eq.{user_id}",
+                "order": "created_at.desc"
+            }, f"user:{user_id}")
+            
+            if response.status_code == 200:
+                chats = response.json()
+                for chat in chats:
+                    self._cache_chat(chat)
+                return chats
+            return []
+        except Exception as e:
+            logger.error("获取用户对话失败: %s", e)
+            return []
+
+    @staticmethod
+    def parse_content_range_total(content_range: Optional[str]) -> Optional[int]:
+        """从PostgREST的Content-Range响应头（如 0-9/42）中解析总数"""
+        if not content_range or '/' not in content_range:
+            return None
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+    
+    @timed_db_method
+    async def get_user_chats_page(self, user_id: str, page_size: int = 10, page: Optional[int] = None,
+                                  cursor: Optional[str] = None, count: Optional[str] = None) -> dict:
+        """
+        获取用户的一页对话，支持偏移分页和基于(created_at, id)的游标分页
+        
+        Args:
+            user_id: 用户ID
+            page_size: 每页数量
+            page: 页码（偏移分页，未提供游标时使用）
+            cursor: 上一页返回的next_cursor（游标分页）
+            count: 总数统计方式 exact/planned/estimated，None表示不统计
+            
+        Returns:
+            dict: 包含chats、total_count、next_cursor、has_more
+            
+        Raises:
+            ValueError: 游标格式无效
+        """
+        params = {
+            "user_id": f"eq.{user_id}",
+            "order": "created_at.desc,id.desc",
+            # 多取一条用于判断是否还有下一页
+            "limit": page_size + 1
+        }
+        if cursor:
+            created_at, chat_id = self.decode_chat_cursor(cursor)
+            params["or"] = f'(created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt."{chat_id}"))'
+        elif page:
+            params["offset"] = (page - 1) * page_size
+        
+        headers = self.headers
+        if count:
+            # 通过Content-Range响应头在同一请求中返回总数
+            headers = {**self.headers, "Prefer": f"count={count}"}
+        
+        try:
+            response = await self._get("chats", params, f"user:{user_id}", headers)
+            
+            if response.status_code not in [200, 206]:
+                logger.error("获取用户分页对话失败，状态码: %s, 响应: %s", response.status_code, response.text)
+                return {"chats": [], "total_count": 0 if count else None, "next_cursor": None, "has_more": False}
+            
+            rows = response.json()
+            has_more = len(rows) > page_size
+            chats = rows[:page_size]
+            for chat in chats:
+                self._cache_chat(chat)
+            total_count = self.parse_content_range_total(response.headers.get("content-range")) if count else None
+            return {
+                "chats": chats,
+                "total_count": total_count,
+                "next_cursor": self.encode_chat_cursor(chats[-1]) if has_more and chats else None,
+                "has_more": has_more
+            }
+        except Exception as e:
+            logger.error("获取用户分页对话失败: %s", e)
+            return {"chats": [], "total_count": 0 if count else None, "next_cursor": None, "has_more": False}
+    
+    @timed_db_method
+    async def save_message(self, chat_id: str, role: str, content: str, timestamp: int):
+        """创建消息"""
+        client = self.client
+        try:
+            logger.debug("准备保存消息: chat_id=%s, role=%s, content长度=%d, timestamp=%s", chat_id, role, len(content), timestamp)
+            
+            message_id = str(uuid.uuid4())
+            message_data = {
+                'id': message_id,
+                'chat_id': chat_id,
+                'role': role,
+                'content': content,
+                'timestamp': timestamp
+            }
+            
+            # 启用写入队列且对话存在时异步批量写入，直接返回消息数据
+            if self._can_write_behind(chat_id):
+                if await self.write_queue.enqueue(message_data):
+                    self._mark_chat_has_messages(chat_id)
+                    return message_data
+                logger.warning("消息写入队列不可用，直接保存消息: %s", message_id)
+            
+            supabase_trace("发送消息数据到Supabase: %s", message_data)
+            
+            response = await client.post(
+                f"{self.base_url}/messages",
+                headers=self.headers,
+                json=message_data
+            )
+            
+            supabase_trace("Supabase响应状态码: %s", response.status_code)
+            supabase_trace("Supabase响应内容: %s", response)
+            
+            if response.status_code == 201:
+                result = response.json()[0]
+                supabase_trace("消息保存成功: %s", result)
+                self._mark_chat_has_messages(chat_id)
+                self._invalidate_reads(f"chat:{chat_id}")
+                return result
+            else:
+                logger.error("创建消息失败，状态码: %s, 响应: %s", response.status_code, response.text)
+                # 对话可能已被其他进程删除，使缓存失效
+                self.chat_cache.pop(chat_id)
+                return None
+        except Exception as e:
+            logger.error("创建消息失败: %s", e, exc_info=True)
+            return None
+    
+    @timed_db_method
+    async def insert_messages(self, messages: List[dict]) -> InsertResult:
+        """批量插入消息，按id幂等（已存在的id会被忽略）；408、429和5xx视为可重试"""
+        try:
+            response = await self.client.post(
+                f"{self.base_url}/messages",
+                headers={**self.headers, "Prefer": "return=minimal,resolution=ignore-duplicates"},
+                params={"on_conflict": "id"},
+                json=messages
+            )
+        except httpx.HTTPError as e:
+            return InsertResult(False, retryable=True, error=repr(e))
+        finally:
+            self._invalidate_reads(*{f"chat:{message['chat_id']}" for message in messages})
+        
+        if response.status_code in (200, 201, 204):
+            return InsertResult(True)
+        retryable = response.status_code >= 500 or response.status_code in (408, 429)
+        return InsertResult(False, retryable=retryable, error=f"状态码: {response.status_code}, 响应: {response.text}")
+    
+    @timed_db_method
+    async def get_chat_state(self, chat_id: str):
+        """
+        一次查询获取对话是否存在及是否已有消息
+        
+        Returns:
+            Optional[dict]: 包含id、user_id、title、has_messages，对话不存在时返回None
+        """
+        # 只信任已有消息的缓存：has_messages为False时对话可能已在别处收到消息，需重新查询以免覆盖标题
+        cached = self.chat_cache.get(chat_id)
+        if cached is not CACHE_MISS and cached['has_messages']:
+            return dict(cached)
+        
+        client = self.client
+        try:
+            response = await client.get(
+                f"{self.base_url}/chats",
+                headers=self.headers,
+                params={
+                    "id": f"eq.{chat_id}",
+                    "select": "id,user_id,title,messages(id)",
+                    "messages.limit": "1"
+                }
+            )
+            
+            if response.status_code == 200:
+                result = response.json()
+                if not result:
+                    return None
+                chat = result[0]
+                state = {
+                    'id': chat['id'],
+                    'user_id': chat.get('user_id'),
+                    'title': chat.get('title'),
+                    'has_messages': bool(chat.get('messages'))
+                }
+                self.chat_cache.set(chat_id, state)
+                return dict(state)
+            else:
+                logger.error("查询对话状态失败，状态码: %s, 响应: %s", response.status_code, response.text)
+                return None
+        except Exception as e:
+            logger.error("查询对话状态失败: %s", e, exc_info=True)
+            return None
+    
+    @timed_db_method
+    async def create_chat_with_id(self, user_id: str, chat_id: str, title: str = "新对话"):
+        """使用指定ID创建新对话"""
+        client = self.client
+        try:
+            logger.debug("准备使用指定ID创建对话: user_id=%s, chat_id=%s, title=%s", user_id, chat_id, title)
+            
+            chat_data = {
+                'id': chat_id,
+                'user_id': user_id,
+                'title': title,
+                'color': 'bg-blue-100',
+                'icon_color': 'text-blue-500'
+            }
+            
+            supabase_trace("发送对话数据到Supabase: %s", chat_data)
+            
+            response = await client.post(
+                f"{self.base_url}/chats",
+                headers=self.headers,
+                json=chat_data
+            )
+            
+            supabase_trace("Supabase对话创建响应状态码: %s", response.status_code)
+            supabase_trace("Supabase对话创建响应内容: %s", response)
+            
+            if response.status_code == 201:
+                result = response.json()[0]
+                supabase_trace("使用指定ID创建对话成功: %s", result)
+                self._cache_chat(result, has_messages=False)
+                self._invalidate_reads(f"user:{user_id}", f"chat:{chat_id}")
+                return result
+            else:
+                logger.error("使用指定ID创建对话失败，状态码: %s, 响应: %s", response.status_code, response.text)
+                return None
+        except Exception as e:
+            logger.error("使用指定ID创建对话失败: %s", e, exc_info=True)
+            return None
+    
+    @timed_db_method
+    async def update_chat_title(self, chat_id: str, title: str):
+        """更新对话标题"""
+        client = self.client
+        try:
+            logger.debug("准备更新对话标题: chat_id=%s, title=%s", chat_id, title)
+            
+            update_data = {
+                'title': title
+            }
+            
+            response = await client.patch(
+                f"{self.base_url}/chats",
+                headers=self.headers,
+                json=update_data,
+                params={"id": f"eq.{chat_id}"}
+            )
+            
+            supabase_trace("Supabase对话标题更新响应状态码: %s", response.status_code)
+            supabase_trace("Supabase对话标题更新响应内容: %s", response)
+            
+            if response.status_code == 200 or response.status_code == 204:
+                logger.info("更新对话标题成功: %s, title: %s", chat_id, title)
+                cached = self.chat_cache.peek(chat_id)
+                if cached is not CACHE_MISS:
+                    cached['title'] = title
+                updated = response.json() if response.status_code == 200 else []
+                self._invalidate_reads(*(f"user:{chat['user_id']}" for chat in updated))
+                return True
+            else:
+                logger.error("更新对话标题失败，状态码: %s, 响应: %s", response.status_code, response.text)
+                self.chat_cache.pop(chat_id)
+                return False
+        except Exception as e:
+            logger.error("更新对话标题失败: %s", e, exc_info=True)
+            self.chat_cache.pop(chat_id)
+            return False
+    
+    @timed_db_method
+    async def get_chat_messages(self, chat_id: str, limit: Optional[int] = None,
+                                before_timestamp: Optional[int] = None, since_timestamp: Optional[int] = None,
+                                columns: str = MESSAGE_COLUMNS, raw: bool = False, strict: bool = False):
+        """
+        获取对话的消息（按时间升序）
+        
+        Args:
+            chat_id: 对话ID
+            limit: 最多返回的条数；与since_timestamp同时使用时取最早的limit条，否则取最新的limit条
+            before_timestamp: 只返回早于该时间戳的消息（向前翻页）
+            since_timestamp: 只返回晚于该时间戳的消息（增量拉取）
+            columns: 查询的列
+            raw: 不限条数时直接返回PostgREST响应体（RawJSON），不解析
+            strict: 查询失败时返回None，供调用方区分查询失败与没有消息
+        """
+        try:
+            params = {
+                "chat_id": f"eq.{chat_id}",
+                "select": columns
+            }
+            filters = []
+            if before_timestamp is not None:
+                filters.append(f"timestamp.lt.{before_timestamp}")
+            if since_timestamp is not None:
+                filters.append(f"timestamp.gt.{since_timestamp}")
+            if filters:
+                params["and"] = f"({','.join(filters)})"
+            
+            # 取最新的limit条时倒序查询，返回前再翻转为升序
+            newest_first = limit is not None and since_timestamp is None
+            params["order"] = "timestamp.desc,id.desc" if newest_first else "timestamp.asc,id.asc"
+            if limit is not None:
+                params["limit"] = limit
+            
+            response = await self._get("messages", params, f"chat:{chat_id}")
+            
+            if response.status_code == 200:
+                if raw and not newest_first:
+                    return RawJSON(response.content)
+                messages = orjson.loads(response.content) if orjson else response.json()
+                if newest_first:
+                    messages.reverse()
+                return messages
+            logger.error("获取对话消息失败: HTTP %s", response.status_code)
+        except Exception as e:
+            logger.error("获取对话消息失败: %s", e)
+        if strict:
+            return None
+        return RawJSON(b"[]") if raw else []
+    
+    @timed_db_method
+    async def delete_chat(self, chat_id: str):
+        """删除对话及其所有消息，成功时返回被删除的对话（含user_id），对话不存在或失败返回False"""
+        client = self.client
+        try:
+            logger.info("准备删除对话: %s", chat_id)
+            
+            # 直接删除对话，由于有ON DELETE CASCADE约束，消息会自动删除
+            self.chat_cache.pop(chat_id)
+            chat_response = await client.delete(
+                f"{self.base_url}/chats",
+                headers=self.headers,
+                params={"id": f"eq.{chat_id}", "select": "id,user_id"}
+            )
+            
+            supabase_trace("删除对话响应状态码: %s", chat_response.status_code)
+            supabase_trace("删除对话响应内容: %s", chat_response)
+            
+            if chat_response.status_code in [200, 204]:
+                deleted = chat_response.json() if chat_response.status_code == 200 else []
+                if not deleted:
+                    logger.warning("要删除的对话不存在: %s", chat_id)
+                    return False
+                logger.info("成功删除对话: %s", chat_id)
+                self._invalidate_reads(f"chat:{chat_id}", f"user:{deleted[0]['user_id']}")
+                return deleted[0]
+            else:
+                logger.error("删除对话失败，状态码: %s, 响应: %s", chat_response.status_code, chat_response.text)
+                return False
+        except Exception as e:
+            logger.error("删除对话失败: %s", e, exc_info=True)
+            return False
+    
+    @staticmethod
+    def in_filter(values: List[str]) -> str:
+        """构建PostgREST的in过滤条件，值加引号并转义，避免逗号和括号被当作分隔符"""
+        quoted = ('"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"' for value in values)
+        return f"in.({','.join(quoted)})"
+    
+    @timed_db_method
+    async def get_chats_by_ids(self, user_id: str, chat_ids: List[str]) -> Optional[List[dict]]:
+        """一次查询获取属于该用户的指定对话（id=in.(...)并限定user_id），失败返回None"""
+        try:
+            response = await self._get("chats", {
+                "id": self.in_filter(chat_ids),
+                "user_id": f"eq.{user_id}",
+                "select": CHAT_COLUMNS
+            }, f"user:{user_id}")
+            if response.status_code != 200:
+                logger.error("批量获取对话失败，状态码: %s, 响应: %s", response.status_code, response.text)
+                return None
+            chats = response.json()
+            for chat in chats:
+                self._cache_chat(chat)
+            return chats
+        except Exception as e:
+            logger.error("批量获取对话失败: %s", e)
+            return None
+    
+    @timed_db_method
+    async def get_latest_chat_messages(self, user_id: str, limit: int, columns: str = MESSAGE_COLUMNS) -> Optional[dict]:
+        """
+        一次请求获取用户最新对话的最新limit条消息：取一条对话并嵌入按时间倒序截取的messages
+        
+        不参与读取合并：消息写入只使对话的scope失效，无法覆盖按用户查询的这次读取。
+        """
+        try:
+            response = await self.client.get(
+                f"{self.base_url}/chats",
+                headers=self.headers,
+                params={
+                    "user_id": f"eq.{user_id}",
+                    "select": f"id,messages({columns})",
+                    "order": "created_at.desc,id.desc",
+                    "limit": 1,
+                    "messages.order": "timestamp.desc,id.desc",
+                    "messages.limit": limit
+                }
+            )
+            if response.status_code != 200:
+                logger.error("获取最新对话消息失败，状态码: %s, 响应: %s", response.status_code, response.text)
+                return None
+            chats = response.json()
+            if not chats:
+                return {"chat_id": None, "messages": []}
+            messages = chats[0].get('messages') or []
+            messages.reverse()
+            return {"chat_id": chats[0]['id'], "messages": messages}
+        except Exception as e:
+            logger.error("获取最新对话消息失败: %s", e)
+            return None
+    
+    @timed_db_method
+    async def delete_chats(self, user_id: str, chat_ids: List[str]) -> Optional[List[str]]:
+        """一次请求删除属于该用户的指定对话（消息由外键级联删除），返回实际删除的对话ID，失败返回None"""
+        try:
+            for chat_id in chat_ids:
+                self.chat_cache.pop(chat_id)
+            response = await self.client.delete(
+                f"{self.base_url}/chats",
+                headers=self.headers,
+                params={"id": self.in_filter(chat_ids), "user_id": f"eq.{user_id}", "select": "id"}
+            )
+            if response.status_code not in [200, 204]:
+                logger.error("批量删除对话失败，状态码: %s, 响应: %s", response.status_code, response.text)
+                return None
+            deleted = [chat['id'] for chat in response.json()] if response.status_code == 200 else []
+            self._invalidate_reads(f"user:{user_id}", *(f"chat:{chat_id}" for chat_id in deleted))
+            logger.info("批量删除对话: user_id=%s, 请求%s个, 删除%s个", user_id, len(chat_ids), len(deleted))
+            return deleted
+        except Exception as e:
+            logger.error("批量删除对话失败: %s", e, exc_info=True)
+            return None
+
+class SQLiteStorage(StorageBackend):
+    """
+    本地SQLite存储后端（STORAGE_BACKEND=sqlite）：省去到Supabase的网络往返，适合单机/边缘部署和离线基准测试
+    
+    WAL模式下读写互不阻塞：写入在单个写线程中串行执行，读取在只读线程池中并发执行，均不占用事件循环。
+    每个线程一个连接，SQL均为固定语句加参数，由sqlite3按连接缓存预编译语句。
+    """
+    
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        id TEXT PRIMARY KEY,
+        username TEXT UNIQUE NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        avatar_url TEXT,
+        plan TEXT DEFAULT '个人版',
+        created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')),
+        updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+    );
+    CREATE TABLE IF NOT EXISTS chats (
+        id TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        title TEXT NOT NULL DEFAULT '新对话',
+        color TEXT DEFAULT 'bg-blue-100',
+        icon_color TEXT DEFAULT 'text-blue-500',
+        created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')),
+        updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+    );
+    CREATE INDEX IF NOT EXISTS idx_chats_user_created_id ON chats(user_id, created_at DESC, id DESC);
+    CREATE INDEX IF NOT EXISTS idx_chats_user_updated ON chats(user_id, updated_at DESC, id DESC);
+    CREATE TABLE IF NOT EXISTS messages (
+        id TEXT PRIMARY KEY,
+        chat_id TEXT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+        role TEXT NOT NULL CHECK (role IN ('user', 'assistant', 'system')),
+        content TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+    );
+    CREATE INDEX IF NOT EXISTS idx_messages_chat_timestamp ON messages(chat_id, timestamp, id);
+    """
+    MESSAGE_FIELDS = {"id", "chat_id", "role", "content", "timestamp", "created_at"}
+    
+    def __init__(self, path: str = SQLITE_PATH, readers: int = SQLITE_READERS):
+        super().__init__()
+        self.path = path
+        self.readers = max(1, readers)
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._reader: Optional[ThreadPoolExecutor] = None
+        self.reads = 0
+        self.writes = 0
+    
+    @staticmethod
+    def _now() -> str:
+        """与PostgREST一致的ISO 8601时间字符串"""
+        return datetime.now(timezone.utc).isoformat()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """获取当前线程的连接，首次使用时创建"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT / 1000,
+                                         check_same_thread=False, cached_statements=256)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+    
+    def _execute_read(self, func, *args):
+        return func(self._connect(), *args)
+    
+    def _execute_write(self, func, *args):
+        connection = self._connect()
+        with connection:  # 一个事务，异常时回滚
+            return func(connection, *args)
+    
+    async def _read(self, func, *args):
+        """在读线程池中执行 func(connection, *args)"""
+        if self._reader is None:
+            self._reader = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="sqlite-read")
+        self.reads += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._reader, functools.partial(self._execute_read, func, *args))
+    
+    async def _write(self, func, *args):
+        """在写线程中以事务执行 func(connection, *args)"""
+        if self._writer is None:
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-write")
+        self.writes += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, functools.partial(self._execute_write, func, *args))
+    
+    async def start(self):
+        """创建表和索引"""
+        await self._write(lambda connection: connection.executescript(self.SCHEMA))
+        logger.info("SQLite存储已就绪: path=%s, readers=%s", self.path, self.readers)
+    
+    def _shutdown(self, executors: List[ThreadPoolExecutor]):
+        """等待线程池中排队的读写完成并关闭所有连接（阻塞，在线程中执行）"""
+        for executor in executors:
+            executor.shutdown(wait=True)
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+    
+    async def close(self):
+        """等待进行中的读写完成并关闭所有连接，等待期间不阻塞事件循环"""
+        executors = [executor for executor in (self._writer, self._reader) if executor is not None]
+        self._writer = self._reader = None
+        await asyncio.to_thread(self._shutdown, executors)
+        self._local = threading.local()
+        logger.info("SQLite存储已关闭")
+    
+    async def warm_up(self) -> bool:
+        """建立读写连接，返回数据库是否可用"""
+        try:
+            await self._read(lambda connection: connection.execute("SELECT 1").fetchone())
+            return True
+        except Exception as e:
+            logger.warning("SQLite连接预热失败: %r", e)
+            return False
+    
+    def get_pool_stats(self) -> dict:
+        """获取连接使用情况"""
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "readers": self.readers,
+            "open_connections": len(self._connections),
+            "reads": self.reads,
+            "writes": self.writes
+        }
+    
+    @timed_db_method
+    async def find_users_by_identifiers(self, *identifiers: str):
+        """一次查询获取用户名或邮箱匹配任一标识的所有用户，查询失败时返回None"""
+        def query(connection):
+            marks = ",".join("?" * len(identifiers))
+            rows = connection.execute(
+                f"SELECT * FROM users WHERE username IN ({marks}) OR email IN ({marks})", identifiers * 2
+            ).fetchall()
+            return [dict(row) for row in rows]
+        
+        try:
+            users = await self._read(query)
+            for user in users:
+                self._cache_user(user)
+            return users
+        except Exception as e:
+            logger.error("查询用户失败: %s", e)
+            return None
+    
+    @timed_db_method
+    async def find_user_by_id(self, user_id: str):
+        """按ID查询用户，不存在或查询失败时返回None"""
+        try:
+            row = await self._read(lambda connection: connection.execute(
+                "SELECT * FROM users WHERE id = ?", (user_id,)
+            ).fetchone())
+            return dict(row) if row else None
+        except Exception as e:
+            logger.error("查询用户失败: %s", e)
+            return None
+    
+    @timed_db_method
+    async def create_user(self, username: str, email: str, password_hash: str):
+        """创建新用户"""
+        now = self._now()
+        user = {
+            'id': str(uuid.uuid4()),
+            'username': username,
+            'email': email,
+            'password_hash': password_hash,
+            'avatar_url': 'https://design.gemcoder.com/staticResource/echoAiSystemImages/3af53b10252ba2331a996da3c32fd378.png',
+            'plan': '个人版',
+            'created_at': now,
+            'updated_at': now
+        }
+        try:
+            await self._write(lambda connection: connection.execute(
+                "INSERT INTO users (id, username, email, password_hash, avatar_url, plan, created_at, updated_at) "
+                "VALUES (:id, :username, :email, :password_hash, :avatar_url, :plan, :created_at, :updated_at)", user
+            ))
+            self._invalidate_user(username, email)
+            self.user_cache.pop(('identifier', username))
+            self.user_cache.pop(('identifier', email))
+            self._cache_user(user)
+            return user
+        except Exception as e:
+            logger.error("创建用户失败: %s", e)
+            return None
+    
+    @timed_db_method
+    async def rehash_password(self, user_id: str, password: str):
+        """使用当前cost重新哈希密码并更新到数据库"""
+        def update(connection, password_hash):
+            connection.execute("UPDATE users SET password_hash = ?, updated_at = ? WHERE id = ?",
+                               (password_hash, self._now(), user_id))
+            row = connection.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+            return dict(row) if row else None
+        
+        try:
+            user = await self._write(update, await self.hash_password(password))
+            if user:
+                self._cache_user(user)
+            logger.info("已按新的cost重新哈希用户密码: %s", user_id)
+            return True
+        except Exception as e:
+            logger.error("重新哈希用户密码失败: %s", e, exc_info=True)
+            return False
+    
+    async def _insert_chat(self, user_id: str, chat_id: str, title: str):
+        now = self._now()
+        chat = {
+            'id': chat_id,
+            'user_id': user_id,
+            'title': title,
+            'color': 'bg-blue-100',
+            'icon_color': 'text-blue-500',
+            'created_at': now,
+            'updated_at': now
+        }
+        try:
+            await self._write(lambda connection: connection.execute(
+                "INSERT INTO chats (id, user_id, title, color, icon_color, created_at, updated_at) "
+                "VALUES (:id, :user_id, :title, :color, :icon_color, :created_at, :updated_at)", chat
+            ))
+            self._cache_chat(chat, has_messages=False)
+            return chat
+        except Exception as e:
+            logger.error("创建对话失败: chat_id=%s, %s", chat_id, e)
+            return None
+    
+    @timed_db_method
+    async def create_chat(self, user_id: str, title: str = "新对话"):
+        """创建新对话"""
+        return await self._insert_chat(user_id, str(uuid.uuid4()), title)
+    
+    @timed_db_method
+    async def create_chat_with_id(self, user_id: str, chat_id: str, title: str = "新对话"):
+        """使用指定ID创建新对话"""
+        return await self._insert_chat(user_id, chat_id, title)
+    
+    @timed_db_method
+    async def get_user_chats(self, user_id: str):
+        """获取用户的所有对话"""
+        try:
+            chats = await self._read(lambda connection: [dict(row) for row in connection.execute(
+                "SELECT * FROM chats WHERE user_id = ? ORDER BY created_at DESC", (user_id,)
+            )])
+            for chat in chats:
+                self._cache_chat(chat)
+            return chats
+        except Exception as e:
+            logger.error("获取用户对话失败: %s", e)
+            return []
+    
+    @timed_db_method
+    async def get_user_chats_page(self, user_id: str, page_size: int = 10, page: Optional[int] = None,
+                                  cursor: Optional[str] = None, count: Optional[str] = None) -> dict:
+        """
+        获取用户的一页对话，参数与返回值同Supabase后端；count的各种统计方式都返回精确总数
+        
+        Raises:
+            ValueError: 游标格式无效
+        """
+        where, args = "user_id = ?", [user_id]
+        offset = 0
+        if cursor:
+            created_at, chat_id = self.decode_chat_cursor(cursor)
+            where += " AND (created_at < ? OR (created_at = ? AND id < ?))"
+            args += [created_at, created_at, chat_id]
+        elif page:
+            offset = (page - 1) * page_size
+        
+        def query(connection):
+            # 多取一条用于判断是否还有下一页
+            rows = connection.execute(
+                f"SELECT * FROM chats WHERE {where} ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?",
+                (*args, page_size + 1, offset)
+            ).fetchall()
+            total = connection.execute(f"SELECT COUNT(*) FROM chats WHERE {where}", args).fetchone()[0] if count else None
+            return [dict(row) for row in rows], total
+        
+        try:
+            rows, total_count = await self._read(query)
+            has_more = len(rows) > page_size
+            chats = rows[:page_size]
+            for chat in chats:
+                self._cache_chat(chat)
+            return {
+                "chats": chats,
+                "total_count": total_count,
+                "next_cursor": self.encode_chat_cursor(chats[-1]) if has_more and chats else None,
+                "has_more": has_more
+            }
+        except Exception as e:
+            logger.error("获取用户分页对话失败: %s", e)
+            return {"chats": [], "total_count": 0 if count else None, "next_cursor": None, "has_more": False}
+    
+    @timed_db_method
+    async def save_message(self, chat_id: str, role: str, content: str, timestamp: int):
+        """创建消息"""
+        message = {
+            'id': str(uuid.uuid4()),
+            'chat_id': chat_id,
+            'role': role,
+            'content': content,
+            'timestamp': timestamp
+        }
+        if self._can_write_behind(chat_id):
+            if await self.write_queue.enqueue(message):
+                self._mark_chat_has_messages(chat_id)
+                return message
+            logger.warning("消息写入队列不可用，直接保存消息: %s", message['id'])
+        
+        message['created_at'] = self._now()
+        try:
+            await self._write(lambda connection: connection.execute(
+                "INSERT INTO messages (id, chat_id, role, content, timestamp, created_at) "
+                "VALUES (:id, :chat_id, :role, :content, :timestamp, :created_at)", message
+            ))
+            self._mark_chat_has_messages(chat_id)
+            return message
+        except Exception as e:
+            logger.error("创建消息失败: %s", e)
+            # 对话可能已被删除，使缓存失效
+            self.chat_cache.pop(chat_id)
+            return None
+    
+    @timed_db_method
+    async def insert_messages(self, messages: List[dict]) -> InsertResult:
+        """批量插入消息，按id幂等；外键冲突（对话已删除）不可重试，其他数据库错误（如锁超时）可重试"""
+        now = self._now()
+        rows = [(m['id'], m['chat_id'], m['role'], m['content'], m['timestamp'], now) for m in messages]
+        try:
+            await self._write(lambda connection: connection.executemany(
+                "INSERT OR IGNORE INTO messages (id, chat_id, role, content, timestamp, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows
+            ))
+            return InsertResult(True)
+        except sqlite3.IntegrityError as e:
+            return InsertResult(False, error=str(e))
+        except sqlite3.Error as e:
+            return InsertResult(False, retryable=True, error=repr(e))
+    
+    @timed_db_method
+    async def get_chat_state(self, chat_id: str):
+        """一次查询获取对话是否存在及是否已有消息"""
+        # 只信任已有消息的缓存：has_messages为False时对话可能已在别处收到消息，需重新查询以免覆盖标题
+        cached = self.chat_cache.get(chat_id)
+        if cached is not CACHE_MISS and cached['has_messages']:
+            return dict(cached)
+        try:
+            row = await self._read(lambda connection: connection.execute(
+                "SELECT id, user_id, title, EXISTS(SELECT 1 FROM messages WHERE chat_id = chats.id) AS has_messages "
+                "FROM chats WHERE id = ?", (chat_id,)
+            ).fetchone())
+            if row is None:
+                return None
+            state = {**dict(row), 'has_messages': bool(row['has_messages'])}
+            self.chat_cache.set(chat_id, state)
+            return dict(state)
+        except Exception as e:
+            logger.error("查询对话状态失败: %s", e)
+            return None
+    
+    @timed_db_method
+    async def update_chat_title(self, chat_id: str, title: str):
+        """更新对话标题"""
+        try:
+            updated = await self._write(lambda connection: connection.execute(
+                "UPDATE chats SET title = ?, updated_at = ? WHERE id = ?", (title, self._now(), chat_id)
+            ).rowcount)
+            if not updated:
+                self.chat_cache.pop(chat_id)
+                return False
+            cached = self.chat_cache.peek(chat_id)
+            if cached is not CACHE_MISS:
+                cached['title'] = title
+            return True
+        except Exception as e:
+            logger.error("更新对话标题失败: %s", e)
+            self.chat_cache.pop(chat_id)
+            return False
+    
+    @timed_db_method
+    async def get_chat_messages(self, chat_id: str, limit: Optional[int] = None,
+                                before_timestamp: Optional[int] = None, since_timestamp: Optional[int] = None,
+                                columns: str = MESSAGE_COLUMNS, raw: bool = False, strict: bool = False):
+        """获取对话的消息（按时间升序），参数含义同Supabase后端；raw为True时在读线程中完成序列化"""
+        if not set(columns.split(",")) <= self.MESSAGE_FIELDS:
+            raise ValueError(f"不支持的消息字段: {columns}")
+        
+        sql, args = f"SELECT {columns} FROM messages WHERE chat_id = ?", [chat_id]
+        if before_timestamp is not None:
+            sql += " AND timestamp < ?"
+            args.append(before_timestamp)
+        if since_timestamp is not None:
+            sql += " AND timestamp > ?"
+            args.append(since_timestamp)
+        # 取最新的limit条时倒序查询，返回前再翻转为升序
+        newest_first = limit is not None and since_timestamp is None
+        sql += " ORDER BY timestamp DESC, id DESC" if newest_first else " ORDER BY timestamp ASC, id ASC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        
+        def query(connection):
+            messages = [dict(row) for row in connection.execute(sql, args)]
+            if newest_first:
+                messages.reverse()
+            if raw:
+                return RawJSON(orjson.dumps(messages) if orjson else json.dumps(messages, ensure_ascii=False).encode())
+            return messages
+        
+        try:
+            return await self._read(query)
+        except Exception as e:
+            logger.error("获取对话消息失败: %s", e)
+            if strict:
+                return None
+            return RawJSON(b"[]") if raw else []
     
+    @timed_db_method
     async def delete_chat(self, chat_id: str):
-        """删除对话及其所有消息"""
-        async with httpx.AsyncClient() as client:
-            try:
-                logger.info(f"准备删除对话: {chat_id}")
-                
-                # 直接删除对话，由于有ON DELETE CASCADE约束，消息会自动删除
-                chat_response = await client.delete(
-                    f"{self.base_url}/chats",
-                    headers=self.headers,
-                    params={"id": f"eq.{chat_id}"}
-                )
-                
-                logger.info(f"删除对话响应状态码: {chat_response.status_code}")
-                logger.info(f"删除对话响应内容: {chat_response.text}")
-                
-                if chat_response.status_code in [200, 204]:
-                    logger.info(f"成功删除对话: {chat_id}")
-                    return True
-                else:
-                    logger.error(f"删除对话失败，状态码: {chat_response.status_code}, 响应: {chat_response.text}")
-                    return False
-            except Exception as e:
-                logger.error(f"删除对话失败: {e}", exc_info=True)
+        """删除对话及其所有消息（外键级联），成功时返回被删除的对话（含user_id），对话不存在或失败返回False"""
+        try:
+            self.chat_cache.pop(chat_id)
+            deleted = await self._write(lambda connection: [dict(row) for row in connection.execute(
+                "DELETE FROM chats WHERE id = ? RETURNING id, user_id", (chat_id,)
+            ).fetchall()])
+            if not deleted:
+                logger.warning("要删除的对话不存在: %s", chat_id)
                 return False
+            logger.info("成功删除对话: %s", chat_id)
+            return deleted[0]
+        except Exception as e:
+            logger.error("删除对话失败: %s", e, exc_info=True)
+            return False
+    
+    @timed_db_method
+    async def get_chats_by_ids(self, user_id: str, chat_ids: List[str]) -> Optional[List[dict]]:
+        """一次查询获取属于该用户的指定对话，失败返回None"""
+        marks = ",".join("?" * len(chat_ids))
+        try:
+            chats = await self._read(lambda connection: [dict(row) for row in connection.execute(
+                f"SELECT {CHAT_COLUMNS} FROM chats WHERE user_id = ? AND id IN ({marks})", (user_id, *chat_ids)
+            )])
+            for chat in chats:
+                self._cache_chat(chat)
+            return chats
+        except Exception as e:
+            logger.error("批量获取对话失败: %s", e)
+            return None
+    
+    @timed_db_method
+    async def get_latest_chat_messages(self, user_id: str, limit: int, columns: str = MESSAGE_COLUMNS) -> Optional[dict]:
+        """在同一次读线程调用中取用户最新对话及其最新limit条消息"""
+        if not set(columns.split(",")) <= self.MESSAGE_FIELDS:
+            raise ValueError(f"不支持的消息字段: {columns}")
+        
+        def query(connection):
+            row = connection.execute(
+                "SELECT id FROM chats WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT 1", (user_id,)
+            ).fetchone()
+            if row is None:
+                return {"chat_id": None, "messages": []}
+            messages = [dict(message) for message in connection.execute(
+                f"SELECT {columns} FROM messages WHERE chat_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+                (row['id'], limit)
+            )]
+            messages.reverse()
+            return {"chat_id": row['id'], "messages": messages}
+        
+        try:
+            return await self._read(query)
+        except Exception as e:
+            logger.error("获取最新对话消息失败: %s", e)
+            return None
+    
+    @timed_db_method
+    async def delete_chats(self, user_id: str, chat_ids: List[str]) -> Optional[List[str]]:
+        """一条语句删除属于该用户的指定对话（消息由外键级联删除），返回实际删除的对话ID，失败返回None"""
+        marks = ",".join("?" * len(chat_ids))
+        try:
+            for chat_id in chat_ids:
+                self.chat_cache.pop(chat_id)
+            deleted = await self._write(lambda connection: [row[0] for row in connection.execute(
+                f"DELETE FROM chats WHERE user_id = ? AND id IN ({marks}) RETURNING id", (user_id, *chat_ids)
+            ).fetchall()])
+            logger.info("批量删除对话: user_id=%s, 请求%s个, 删除%s个", user_id, len(chat_ids), len(deleted))
+            return deleted
+        except Exception as e:
+            logger.error("批量删除对话失败: %s", e, exc_info=True)
+            return None
+
+def create_storage() -> StorageBackend:
+    """按STORAGE_BACKEND创建存储后端"""
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage()
+    if STORAGE_BACKEND != "supabase":
+        raise ValueError(f"不支持的存储后端: {STORAGE_BACKEND}")
+    return DatabaseService()
 
 # 全局数据库服务实例
-db_service = DatabaseService()
+db_service = create_storage()
+
+class CircuitOpenError(RuntimeError):
+    """熔断器打开，调用被快速拒绝"""
+
+class CircuitBreaker:
+    """
+    熔断器：closed（正常）-> open（快速失败）-> half_open（放行少量探测请求）
+    
+    在最近window_size次、window_seconds秒内的调用中，错误率或慢调用率超过阈值时打开；
+    打开open_seconds秒后进入半开，探测请求全部成功则关闭，任一失败则重新打开。
+    只在事件循环线程中使用，无需加锁。
+    """
+    STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+    
+    def __init__(self, name: str, failure_rate: float = AGENT_BREAKER_FAILURE_RATE,
+                 slow_call_seconds: float = AGENT_BREAKER_SLOW_CALL_SECONDS,
+                 slow_call_rate: float = AGENT_BREAKER_SLOW_CALL_RATE,
+                 min_calls: int = AGENT_BREAKER_MIN_CALLS, window_size: int = AGENT_BREAKER_WINDOW_SIZE,
+                 window_seconds: float = AGENT_BREAKER_WINDOW_SECONDS,
+                 open_seconds: float = AGENT_BREAKER_OPEN_SECONDS,
+                 half_open_calls: int = AGENT_BREAKER_HALF_OPEN_CALLS):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.state = "closed"
+        self.opened_at = 0.0
+        # 滑动窗口：(时间, 是否失败, 是否慢调用)，并维护累计值避免每次遍历
+        self._window = deque(maxlen=window_size)
+        self._failures = 0
+        self._slow = 0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self.rejected = 0
+        self.last_open_reason = None
+    
+    def _transition(self, state: str, reason: Optional[str] = None):
+        self.state = state
+        AGENT_CIRCUIT_TRANSITIONS.inc(state)
+        if state == "open":
+            self.opened_at = time.monotonic()
+            self.last_open_reason = reason
+            logger.warning("熔断器%s打开: %s", self.name, reason)
+        else:
+            logger.info("熔断器%s进入%s状态", self.name, state)
+        if state != "open":
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+        if state == "closed":
+            self._window.clear()
+            self._failures = self._slow = 0
+    
+    def _evict(self, entry):
+        self._failures -= entry[1]
+        self._slow -= entry[2]
+    
+    def allow(self) -> bool:
+        """判断是否放行本次调用；放行的调用必须随后调用record或release"""
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.open_seconds:
+                self.rejected += 1
+                return False
+            self._transition("half_open")
+        if self.state == "half_open":
+            if self._probes_in_flight >= self.half_open_calls:
+                self.rejected += 1
+                return False
+            self._probes_in_flight += 1
+        return True
+    
+    def release(self):
+        """放行的调用被取消（如客户端断开）时释放探测名额，不计入统计"""
+        if self.state == "half_open" and self._probes_in_flight > 0:
+            self._probes_in_flight -= 1
+    
+    def record(self, success: bool, elapsed: float):
+        """记录一次调用结果"""
+        slow = elapsed >= self.slow_call_seconds
+        if self.state == "half_open":
+            self._probes_in_flight = max(0, self._probes_in_flight - 1)
+            if not success or slow:
+                self._transition("open", "半开探测失败" if not success else f"半开探测慢调用 {elapsed:.1f}s")
+                return
+            self._probe_successes += 1
+            if self._probe_successes >= self.half_open_calls:
+                self._transition("closed")
+            return
+        if self.state == "open":
+            return
+        
+        now = time.monotonic()
+        while self._window and now - self._window[0][0] > self.window_seconds:
+            self._evict(self._window.popleft())
+        if len(self._window) == self._window.maxlen:
+            self._evict(self._window[0])
+        self._window.append((now, not success, slow))
+        self._failures += not success
+        self._slow += slow
+        
+        calls = len(self._window)
+        if calls < self.min_calls:
+            return
+        if self._failures / calls >= self.failure_rate:
+            self._transition("open", f"错误率 {self._failures}/{calls}")
+        elif self._slow / calls >= self.slow_call_rate:
+            self._transition("open", f"慢调用率 {self._slow}/{calls}")
+    
+    def get_stats(self) -> dict:
+        """获取熔断器状态"""
+        calls = len(self._window)
+        stats = {
+            "state": self.state,
+            "window_calls": calls,
+            "failure_rate": round(self._failures / calls, 4) if calls else 0.0,
+            "slow_call_rate": round(self._slow / calls, 4) if calls else 0.0,
+            "rejected": self.rejected,
+            "last_open_reason": self.last_open_reason
+        }
+        if self.state == "open":
+            stats["retry_in_seconds"] = round(max(0.0, self.open_seconds - (time.monotonic() - self.opened_at)), 1)
+        return stats
 
 # 阿里云百炼智能体服务类
 class DashScopeService:
@@ -471,95 +2706,1107 @@ class DashScopeService:
         
         # 设置API密钥
         dashscope.api_key = self.api_key
-        logger.info(f"DashScope服务初始化成功，APP_ID: {self.app_id}")
+        
+        self.completion_url = f"{DASHSCOPE_BASE_URL}/apps/{self.app_id}/completion"
+        self.headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        self.transport = DASHSCOPE_TRANSPORT
+        self._client: Optional[httpx.AsyncClient] = None
+        # 自定义传输层，基准测试时替换为本地智能体替身
+        self.http_transport: Optional[httpx.AsyncBaseTransport] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # 限制同时进行的智能体调用数量
+        self._semaphore = asyncio.Semaphore(DASHSCOPE_MAX_CONCURRENCY)
+        # 进行中的调用数（含排队），停机时等待其归零
+        self.in_flight = 0
+        self.breaker = CircuitBreaker("dashscope") if AGENT_BREAKER_ENABLED else None
+        # 新会话首条消息的回复缓存，键为 (app_id, 规范化消息)
+        self.reply_cache = TTLCache(AGENT_REPLY_CACHE_MAX_SIZE, AGENT_REPLY_CACHE_TTL)
+        logger.info("DashScope服务初始化成功，APP_ID: %s, 调用方式: %s", self.app_id, self.transport)
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """获取共享HTTP客户端，未启动时按需创建"""
+        if self._client is None or self._client.is_closed:
+            self._client = InstrumentedAsyncClient(
+                "dashscope",
+                headers=self.headers,
+                transport=self.http_transport,
+                limits=httpx.Limits(max_connections=DASHSCOPE_MAX_CONCURRENCY),
+                timeout=httpx.Timeout(DASHSCOPE_TIMEOUT, connect=DASHSCOPE_CONNECT_TIMEOUT)
+            )
+        return self._client
+    
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """获取SDK调用线程池，未启动时按需创建"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=DASHSCOPE_MAX_CONCURRENCY,
+                thread_name_prefix="dashscope"
+            )
+        return self._executor
+    
+    async def start(self):
+        """初始化智能体调用所需的客户端或线程池"""
+        channel = self.executor if self.transport == "sdk" else self.client
+        logger.info("智能体调用通道已就绪: %s, transport=%s, max_concurrency=%s",
+                    type(channel).__name__, self.transport, DASHSCOPE_MAX_CONCURRENCY)
+    
+    async def warm_up(self) -> bool:
+        """预热到百炼的连接，返回是否成功建立连接"""
+        if self.transport == "sdk":
+            return True
+        try:
+            await self.client.head(DASHSCOPE_BASE_URL)
+            return True
+        except Exception as e:
+            logger.warning("百炼连接预热失败: %r", e)
+            return False
+    
+    async def drain(self, timeout: float):
+        """等待进行中的智能体调用完成，最多等待timeout秒"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        if self.in_flight:
+            logger.info("等待进行中的智能体调用完成: %s", self.in_flight)
+        while self.in_flight and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        if self.in_flight:
+            logger.warning("停机等待超时，仍有%s个智能体调用未完成", self.in_flight)
+    
+    async def close(self):
+        """释放智能体调用资源"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+    
+    def _build_payload(self, message: str, session_id: Optional[str] = None, stream: bool = False,
+                       messages: Optional[List[dict]] = None) -> dict:
+        """构建百炼应用调用请求体；传入messages（最后一条为当前消息）时不再使用prompt和服务端会话"""
+        payload = {
+            "input": {"messages": messages} if messages else {"prompt": message},
+            "parameters": {"incremental_output": stream},
+            "debug": {}
+        }
+        if session_id and not messages:
+            payload["input"]["session_id"] = session_id
+        return payload
+    
+    async def _call_http(self, message: str, session_id: Optional[str] = None,
+                         messages: Optional[List[dict]] = None) -> dict:
+        """通过原生异步HTTP调用百炼应用"""
+        response = await self.client.post(
+            self.completion_url,
+            json=self._build_payload(message, session_id, messages=messages)
+        )
+        data = response.json() if response.content else {}
+        return {
+            'status_code': response.status_code,
+            'output': data.get('output') or {},
+            'usage': data.get('usage') or {},
+            'message': data.get('message', response.text)
+        }
+    
+    def _call_sdk(self, message: str, session_id: Optional[str] = None,
+                  messages: Optional[List[dict]] = None) -> dict:
+        """通过SDK同步调用百炼应用（在线程池中执行）"""
+        request_params = {
+            'app_id': self.app_id,
+            'stream': False,
+            'incremental_output': False
+        }
+        if messages:
+            request_params['messages'] = messages
+        else:
+            request_params['prompt'] = message
+            if session_id:
+                request_params['session_id'] = session_id
+        
+        response = Application.call(**request_params)
+        return {
+            'status_code': response.status_code,
+            'output': response.output or {},
+            'usage': response.usage or {},
+            'message': response.message
+        }
+    
+    async def _invoke(self, message: str, session_id: Optional[str] = None,
+                      messages: Optional[List[dict]] = None) -> dict:
+        """在并发上限内执行一次调用"""
+        self.in_flight += 1
+        try:
+            async with self._semaphore:
+                if self.transport == "sdk":
+                    loop = asyncio.get_running_loop()
+                    return await loop.run_in_executor(self.executor, self._call_sdk, message, session_id, messages)
+                return await self._call_http(message, session_id, messages)
+        finally:
+            self.in_flight -= 1
     
-    async def call_agent(self, message: str, session_id: Optional[str] = None) -> dict:
+    async def call_agent(self, message: str, session_id: Optional[str] = None, timeout: Optional[float] = None,
+                         messages: Optional[List[dict]] = None) -> dict:
         """
         调用阿里云百炼智能体
         
+        熔断器打开时立即返回失败，由调用方使用备用回复；5xx、429和网络异常在截止时间内按带抖动的指数退避重试。
+        
         Args:
             message: 用户消息
             session_id: 会话ID（可选，用于保持上下文）
+            timeout: 本次请求的截止时间（秒），默认使用DASHSCOPE_TIMEOUT，包含排队等待和所有重试
+            messages: 组装好的上下文（可选，最后一条为当前消息），传入时不使用session_id
             
         Returns:
             dict: 包含回复内容和状态信息
         """
+        timeout = timeout or DASHSCOPE_TIMEOUT
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        attempt = 0
+        while True:
+            result = await self._call_once(message, session_id, deadline - loop.time(), messages)
+            if result['success'] or not result.get('retryable'):
+                return result
+            
+            # 全抖动退避，避免故障恢复时所有请求同时重试
+            delay = random.uniform(0, min(DASHSCOPE_RETRY_MAX_DELAY, DASHSCOPE_RETRY_BASE_DELAY * 2 ** attempt))
+            attempt += 1
+            if attempt > DASHSCOPE_MAX_RETRIES or loop.time() + delay >= deadline:
+                return result
+            AGENT_RETRIES.inc()
+            logger.warning("智能体调用失败，%.2f秒后第%s次重试: %s", delay, attempt, result['error'])
+            await asyncio.sleep(delay)
+    
+    async def _call_once(self, message: str, session_id: Optional[str], timeout: float,
+                         messages: Optional[List[dict]] = None) -> dict:
+        """执行一次调用并把结果计入熔断器"""
+        if self.breaker and not self.breaker.allow():
+            AGENT_LATENCY.observe(0.0, "call", "circuit_open")
+            logger.warning("智能体熔断中，跳过调用")
+            return {
+                'success': False,
+                'error': "智能体服务暂时不可用（熔断中）",
+                'circuit_open': True
+            }
+        
+        started = time.perf_counter()
+        outcome = "error"
+        # 4xx是请求本身的问题，不计为上游故障
+        upstream_healthy = False
+        try:
+            logger.debug("调用阿里云百炼智能体，消息: %.50s...", message)
+            
+            response = await asyncio.wait_for(self._invoke(message, session_id, messages), timeout)
+            
+            retryable = response['status_code'] >= 500 or response['status_code'] == 429
+            upstream_healthy = not retryable
+            if response['status_code'] == 200:
+                outcome = "success"
+                result = response['output']
+                logger.debug("智能体调用成功，回复: %.100s...", result.get('text', ''))
+                
+                return {
+                    'success': True,
+                    'response': result.get('text', ''),
+                    'session_id': result.get('session_id', session_id),
+                    'usage': response['usage']
+                }
+            else:
+                outcome = "failure"
+                logger.error("智能体调用失败，状态码: %s, 错误: %s", response['status_code'], response['message'])
+                return {
+                    'success': False,
+                    'error': f"智能体调用失败: {response['message']}",
+                    'status_code': response['status_code'],
+                    'retryable': retryable
+                }
+        
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            logger.error("调用阿里云百炼智能体超时: %.1f秒", timeout)
+            return {
+                'success': False,
+                'error': f"调用智能体超时（{timeout:.1f}秒）",
+                'timeout': True
+            }
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        except Exception as e:
+            logger.error("调用阿里云百炼智能体异常: %s", e, exc_info=True)
+            return {
+                'success': False,
+                'error': f"调用智能体异常: {str(e)}",
+                'retryable': True
+            }
+        finally:
+            elapsed = time.perf_counter() - started
+            AGENT_LATENCY.observe(elapsed, "call", outcome)
+            if self.breaker:
+                if outcome == "cancelled":
+                    self.breaker.release()
+                else:
+                    self.breaker.record(upstream_healthy, elapsed)
+    
+    async def stream_agent(self, message: str, session_id: Optional[str] = None, timeout: Optional[float] = None,
+                           messages: Optional[List[dict]] = None):
+        """
+        以增量输出方式流式调用阿里云百炼智能体
+        
+        Args:
+            message: 用户消息
+            session_id: 会话ID（可选，用于保持上下文）
+            timeout: 整个流的超时时间（秒），默认使用DASHSCOPE_TIMEOUT
+            messages: 组装好的上下文（可选，最后一条为当前消息），传入时不使用session_id
+            
+        Yields:
+            dict: 增量片段，包含text、session_id、usage和finish_reason
+            
+        Raises:
+            asyncio.TimeoutError: 排队或生成超过超时时间
+            RuntimeError: 智能体返回错误
+        """
+        timeout = timeout or DASHSCOPE_TIMEOUT
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        
+        # SDK方式不支持异步流式读取，退化为一次性返回完整回复
+        if self.transport == "sdk":
+            result = await self.call_agent(message, session_id, timeout, messages)
+            if not result['success']:
+                raise RuntimeError(result.get('error', '智能体调用失败'))
+            yield {
+                'text': result['response'],
+                'session_id': result.get('session_id'),
+                'usage': result.get('usage', {}),
+                'finish_reason': 'stop'
+            }
+            return
+        
+        if self.breaker and not self.breaker.allow():
+            AGENT_LATENCY.observe(0.0, "stream", "circuit_open")
+            raise CircuitOpenError("智能体服务暂时不可用（熔断中）")
+        
+        started = time.perf_counter()
+        outcome = "cancelled"
+        # 熔断器的慢调用按首包耗时判断，流的总时长取决于回复长度
+        first_chunk_elapsed = None
+        # 4xx是请求本身的问题，不计为上游故障（与_call_once一致）
+        upstream_healthy = False
+        self.in_flight += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout)
+        except BaseException as e:
+            self.in_flight -= 1
+            AGENT_LATENCY.observe(
+                time.perf_counter() - started, "stream", "timeout" if isinstance(e, asyncio.TimeoutError) else "cancelled"
+            )
+            # 本地并发槽排队超时不代表上游故障，只归还熔断器的试探名额
+            if self.breaker:
+                self.breaker.release()
+            raise
+        try:
+            logger.debug("流式调用阿里云百炼智能体，消息: %.50s...", message)
+            async with self.client.stream(
+                "POST",
+                self.completion_url,
+                json=self._build_payload(message, session_id, stream=True, messages=messages),
+                headers={"X-DashScope-SSE": "enable"}
+            ) as response:
+                if response.status_code != 200:
+                    upstream_healthy = response.status_code < 500 and response.status_code != 429
+                    body = await response.aread()
+                    raise RuntimeError(f"智能体调用失败，状态码: {response.status_code}, 响应: {body.decode('utf-8', 'ignore')}")
+                
+                event = None
+                async for line in response.aiter_lines():
+                    if loop.time() > deadline:
+                        raise asyncio.TimeoutError()
+                    if line.startswith("event:"):
+                        event = line[6:].strip()
+                        continue
+                    if not line.startswith("data:"):
+                        continue
+                    
+                    data = json.loads(line[5:])
+                    if event == "error" or data.get('code'):
+                        raise RuntimeError(f"智能体调用失败: {data.get('message', data)}")
+                    
+                    output = data.get('output') or {}
+                    if first_chunk_elapsed is None:
+                        first_chunk_elapsed = time.perf_counter() - started
+                    yield {
+                        'text': output.get('text') or '',
+                        'session_id': output.get('session_id', session_id),
+                        'usage': data.get('usage') or {},
+                        'finish_reason': output.get('finish_reason')
+                    }
+            outcome = "success"
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            raise
+        except Exception:
+            outcome = "failure"
+            raise
+        finally:
+            self._semaphore.release()
+            self.in_flight -= 1
+            elapsed = time.perf_counter() - started
+            AGENT_LATENCY.observe(elapsed, "stream", outcome)
+            if self.breaker:
+                if outcome == "cancelled":
+                    self.breaker.release()
+                else:
+                    self.breaker.record(outcome == "success" or upstream_healthy, first_chunk_elapsed or elapsed)
+    
+    def _reply_cache_key(self, message: str) -> Optional[tuple]:
+        """规范化消息（全半角、大小写、空白和结尾标点）作为缓存键；缓存关闭或消息过长时返回None"""
+        if self.reply_cache.max_size <= 0:
+            return None
+        normalized = " ".join(unicodedata.normalize("NFKC", message).lower().split())
+        normalized = normalized.rstrip("!?.~。！？～…")
+        if not normalized or len(normalized) > AGENT_REPLY_CACHE_MAX_PROMPT_CHARS:
+            return None
+        return (self.app_id, normalized)
+    
+    def get_cached_reply(self, message: str) -> Optional[str]:
+        """
+        查询首条消息的缓存回复（只能用于新会话的第一条消息，此时回复不依赖上下文）
+        
+        命中时不会调用智能体，该轮对话不会进入百炼的会话上下文。
+        """
+        key = self._reply_cache_key(message)
+        if key is None:
+            return None
+        reply = self.reply_cache.get(key)
+        if reply is CACHE_MISS:
+            AGENT_REPLY_CACHE_LOOKUPS.inc("miss")
+            return None
+        AGENT_REPLY_CACHE_LOOKUPS.inc("hit")
+        return reply
+    
+    def cache_reply(self, message: str, reply: str):
+        """缓存智能体成功返回的首条回复，超出长度上限的不缓存"""
+        key = self._reply_cache_key(message)
+        if key is not None and reply.strip() and len(reply) <= AGENT_REPLY_CACHE_MAX_REPLY_CHARS:
+            self.reply_cache.set(key, reply)
+    
+    def get_fallback_response(self, message: str) -> str:
+        """
+        获取备用回复（当智能体不可用时使用）
+        
+        Args:
+            message: 用户消息
+            
+        Returns:
+            str: 备用回复
+        """
+        logger.info("使用备用回复方案")
+        
+        # 简单的备用回复逻辑
+        if "你好" in message or "hi" in message.lower():
+            return "您好！我是AI助手，很高兴为您服务。虽然我现在连接智能体遇到了一些问题，但我仍然会尽力帮助您。"
+        elif "帮助" in message or "help" in message.lower():
+            return "我可以帮您解答问题、创作内容、分析文档等。目前智能体服务暂时不可用，请稍后再试。"
+        else:
+            return f"我已收到您的消息：'{message}'。目前智能体服务暂时不可用，请稍后再试。我会尽快恢复服务。"
+
+# 全局智能体服务实例
+try:
+    agent_service = DashScopeService()
+    logger.info("阿里云百炼智能体服务初始化成功")
+except Exception as e:
+    logger.error("阿里云百炼智能体服务初始化失败: %s", e)
+    agent_service = None
+
+class AgentOverloadedError(RuntimeError):
+    """智能体调用被准入控制拒绝（限流或排队已满）"""
+    
+    def __init__(self, message: str, retry_after: float, reason: str):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+class TokenBucket:
+    """令牌桶：按rate持续补充，最多积累capacity个"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def take(self) -> float:
+        """取一个令牌，成功返回0，否则返回需要等待的秒数"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class AgentScheduler:
+    """
+    智能体调用的准入控制与公平调度
+    
+    每个用户一个令牌桶限制调用频率；全局并发达到上限后请求按用户排队，空出的名额在排队用户间轮转分配
+    （按套餐加权），单个用户的大量请求不会占满百炼配额。令牌不足或排队已满时立即拒绝，由接口返回429。
+    """
+    
+    def __init__(self, enabled: bool = AGENT_ADMISSION_ENABLED, max_active: int = AGENT_MAX_ACTIVE,
+                 queue_size: int = AGENT_QUEUE_MAX_SIZE, user_queue_size: int = AGENT_USER_QUEUE_SIZE,
+                 rate: float = AGENT_USER_RATE, burst: float = AGENT_USER_BURST,
+                 queue_timeout: float = AGENT_QUEUE_TIMEOUT, plan_weights: str = AGENT_PLAN_WEIGHTS):
+        self.enabled = enabled
+        self.max_active = max(1, max_active)
+        self.queue_size = queue_size
+        self.user_queue_size = user_queue_size
+        self.rate = rate
+        self.burst = burst
+        self.queue_timeout = queue_timeout
+        self.plan_weights = {}
+        for item in plan_weights.split(","):
+            plan, _, weight = item.partition(":")
+            if plan.strip() and weight.strip():
+                self.plan_weights[plan.strip()] = max(1, int(weight))
+        # 用户套餐在登录时记录；令牌桶闲置到补满后即可丢弃
+        self.plans = TTLCache(USER_CACHE_MAX_SIZE, 86400)
+        self.buckets = TTLCache(max(USER_CACHE_MAX_SIZE, 10000), burst / rate if rate > 0 else 0)
+        self.active = 0
+        self.waiting = 0
+        # 排队中的用户按轮转顺序排列，值为该用户的等待队列
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self._credits: Dict[str, int] = {}
+        # 名额占用时长的滑动平均，用于估算Retry-After
+        self._avg_hold = 5.0
+        self.granted = 0
+    
+    def set_plan(self, user_id: str, plan: Optional[str]):
+        if user_id and plan:
+            self.plans.set(user_id, plan)
+    
+    def weight_of(self, user_id: str) -> int:
+        return self.plan_weights.get(self.plans.peek(user_id, None), 1)
+    
+    def _reject(self, reason: str, retry_after: float, message: str):
+        AGENT_ADMISSION_REJECTIONS.inc(reason)
+        raise AgentOverloadedError(message, max(1, math.ceil(retry_after)), reason)
+    
+    def admit(self, user_id: Optional[str]):
+        """
+        请求准入检查（不等待）：排队已满或用户令牌不足时抛出AgentOverloadedError
+        
+        只检查并消耗令牌，排队在实际调用智能体时进行（slot）。
+        """
+        if not self.enabled:
+            return
+        user_id = user_id or "anonymous"
+        if self.active >= self.max_active:
+            queued = len(self._queues.get(user_id, ()))
+            if queued >= self.user_queue_size or self.waiting >= self.queue_size:
+                retry_after = self._avg_hold * (self.waiting + 1) / self.max_active
+                self._reject("queue_full", retry_after, "当前请求较多，请稍后再试")
+        
+        if self.rate <= 0:
+            return
+        bucket = self.buckets.peek(user_id, None)
+        if bucket is None:
+            weight = self.weight_of(user_id)
+            bucket = TokenBucket(self.rate * weight, self.burst * weight)
+        wait = bucket.take()
+        self.buckets.set(user_id, bucket)
+        if wait:
+            self._reject("rate_limited", wait, "发送过于频繁，请稍后再试")
+    
+    @asynccontextmanager
+    async def slot(self, user_id: Optional[str]):
+        """占用一个调用名额，全局名额已满时公平排队，排队超时抛出AgentOverloadedError"""
+        if not self.enabled:
+            yield
+            return
+        await self._acquire(user_id or "anonymous")
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._avg_hold = 0.9 * self._avg_hold + 0.1 * (time.monotonic() - started)
+            self._release()
+    
+    async def _acquire(self, user_id: str):
+        if self.active < self.max_active and not self.waiting:
+            self.active += 1
+            self.granted += 1
+            AGENT_QUEUE_WAIT.observe(0.0, "granted")
+            return
+        
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+            self._credits[user_id] = self.weight_of(user_id)
+        queue.append(future)
+        self.waiting += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # 名额已分配但调用方已放弃，转给下一个排队请求
+                self._release()
+            else:
+                self._discard(user_id, future)
+            outcome = "timeout" if isinstance(e, asyncio.TimeoutError) else "cancelled"
+            AGENT_QUEUE_WAIT.observe(time.perf_counter() - started, outcome)
+            if outcome == "timeout":
+                self._reject("queue_timeout", self._avg_hold, "排队超时，请稍后再试")
+            raise
+        AGENT_QUEUE_WAIT.observe(time.perf_counter() - started, "granted")
+    
+    def _discard(self, user_id: str, future):
+        queue = self._queues.get(user_id)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            self.waiting -= 1
+            if not queue:
+                del self._queues[user_id]
+                self._credits.pop(user_id, None)
+    
+    def _release(self):
+        self.active -= 1
+        # 轮转分配：队首用户按权重连续获得名额，用完后移到队尾
+        while self.active < self.max_active and self._queues:
+            user_id, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            self.waiting -= 1
+            self._credits[user_id] -= 1
+            if not queue:
+                del self._queues[user_id]
+                self._credits.pop(user_id, None)
+            elif self._credits[user_id] <= 0:
+                self._credits[user_id] = self.weight_of(user_id)
+                self._queues.move_to_end(user_id)
+            if future.done():
+                continue
+            future.set_result(None)
+            self.active += 1
+            self.granted += 1
+    
+    def get_stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "active": self.active,
+            "max_active": self.max_active,
+            "waiting": self.waiting,
+            "queued_users": len(self._queues),
+            "queue_size": self.queue_size,
+            "user_queue_size": self.user_queue_size,
+            "user_rate": self.rate,
+            "user_burst": self.burst,
+            "granted": self.granted,
+            "avg_hold_seconds": round(self._avg_hold, 3),
+            "plan_weights": self.plan_weights
+        }
+
+# 全局智能体调度实例
+agent_scheduler = AgentScheduler()
+
+class ContextBuilder:
+    """
+    智能体调用的上下文组装（AGENT_CONTEXT_MODE=history）
+    
+    从已保存的消息中取最近的对话，按本地估算的token数从新到旧装入预算，超出预算的早期对话整条丢弃；
+    开启滚动摘要时，被丢弃的对话在后台压缩为摘要并以system消息放在上下文最前。
+    上下文随请求发送，服务端会话过期不会丢失上下文，每轮的输入token也有上限。
+    实际消耗以调用返回的usage为准，与估算值一起计入统计，用于校准预算。
+    """
+    
+    # 每条消息的角色和分隔符开销（估算）
+    MESSAGE_OVERHEAD = 4
+    
+    def __init__(self, mode: str = AGENT_CONTEXT_MODE, max_tokens: int = AGENT_CONTEXT_MAX_TOKENS,
+                 max_messages: int = AGENT_CONTEXT_MAX_MESSAGES, summary: bool = AGENT_CONTEXT_SUMMARY):
+        self.enabled = mode == "history"
+        self.max_tokens = max_tokens
+        self.max_messages = max_messages
+        self.summary_enabled = summary
+        # 对话摘要：chat_id -> {"until": 摘要覆盖的最后一条消息的时间戳, "text": 摘要}
+        self.summaries = TTLCache(AGENT_CONTEXT_SUMMARY_CACHE_SIZE, AGENT_CONTEXT_SUMMARY_TTL)
+        self._summarizing = set()
+        self.builds = 0
+        self.history_failures = 0
+        self.truncated_builds = 0
+        self.dropped_messages = 0
+        self.summaries_generated = 0
+        self.summaries_used = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        # 组装了上下文的调用：估算值与实际输入token
+        self.usage_calls = 0
+        self.estimated_tokens = 0
+        self.context_input_tokens = 0
+    
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """
+        快速估算token数：中文等非ASCII字符约1个token，ASCII约4个字符1个token
+        
+        只做两次长度计算（UTF-8编码在C层完成），按CJK字符3字节折算非ASCII字符数。
+        """
+        extra = len(text.encode("utf-8")) - len(text)
+        non_ascii = extra // 2
+        return non_ascii + (len(text) - non_ascii + 3) // 4
+    
+    def message_tokens(self, message: dict) -> int:
+        return self.estimate_tokens(message['content']) + self.MESSAGE_OVERHEAD
+    
+    def fit(self, history: List[dict], budget: int) -> int:
+        """从最新一条向前装入预算，返回保留部分的起始下标（之前的消息被丢弃）"""
+        start = len(history)
+        while start > 0:
+            cost = self.message_tokens(history[start - 1])
+            if cost > budget:
+                break
+            budget -= cost
+            start -= 1
+        return start
+    
+    async def build(self, chat_id: str, message: str, before_timestamp: Optional[int] = None,
+                    fresh_chat: bool = False, user_id: Optional[str] = None) -> Optional[dict]:
+        """
+        组装本次调用的上下文
+        
+        Args:
+            chat_id: 对话ID
+            message: 当前用户消息
+            before_timestamp: 只读取早于该时间戳的消息（排除并发保存的当前消息）
+            fresh_chat: 新会话的第一条消息，无需读取历史
+            user_id: 发起调用的用户，生成摘要时按该用户占用调度名额
+            
+        Returns:
+            dict: messages（最后一条为当前消息）、estimated_tokens、history、dropped；
+            session模式或读取历史失败时返回None（本次调用改用百炼会话保持上下文）
+        """
+        if not self.enabled:
+            return None
+        self.builds += 1
+        
+        current = {"role": "user", "content": message}
+        history = []
+        if not fresh_chat:
+            rows = await db_service.get_chat_messages(chat_id, limit=self.max_messages,
+                                                      before_timestamp=before_timestamp,
+                                                      columns="role,content,timestamp", strict=True)
+            if rows is None:
+                # 历史读取失败时不发送缺少上下文的请求
+                self.history_failures += 1
+                logger.warning("读取对话历史失败，本次调用改用会话上下文: chat_id=%s", chat_id)
+                return None
+            history = [row for row in rows if row['role'] in ("user", "assistant") and row['content']]
+        
+        summary = self.summaries.get(chat_id) if self.summary_enabled and history else CACHE_MISS
+        prefix = []
+        if summary is not CACHE_MISS:
+            history = [row for row in history if row['timestamp'] > summary['until']]
+            prefix = [{"role": "system", "content": f"此前对话的摘要：{summary['text']}"}]
+        
+        used = self.message_tokens(current) + sum(self.message_tokens(m) for m in prefix)
+        start = self.fit(history, self.max_tokens - used)
+        kept, dropped = history[start:], history[:start]
+        if dropped:
+            self.truncated_builds += 1
+            self.dropped_messages += len(dropped)
+            AGENT_CONTEXT_TRUNCATIONS.inc(amount=len(dropped))
+            if self.summary_enabled:
+                self.schedule_summary(chat_id, summary, dropped, user_id)
+        if prefix:
+            self.summaries_used += 1
+        
+        messages = prefix + [{"role": m['role'], "content": m['content']} for m in kept] + [current]
+        estimated = used + sum(self.message_tokens(m) for m in kept)
+        return {"messages": messages, "estimated_tokens": estimated, "history": len(kept), "dropped": len(dropped)}
+    
+    def schedule_summary(self, chat_id: str, previous, dropped: List[dict], user_id: Optional[str] = None):
+        """在后台把被丢弃的对话（连同已有摘要）压缩为新摘要，同一对话同时只生成一个"""
+        if agent_service is None or chat_id in self._summarizing:
+            return
+        self._summarizing.add(chat_id)
+        run_in_background(self._summarize(chat_id, previous, dropped, user_id))
+    
+    async def _summarize(self, chat_id: str, previous, dropped: List[dict], user_id: Optional[str] = None):
+        try:
+            lines = [f"{'用户' if m['role'] == 'user' else '助手'}：{m['content']}" for m in dropped]
+            if previous is not CACHE_MISS:
+                lines.insert(0, f"此前的摘要：{previous['text']}")
+            prompt = (f"请把下面的对话压缩成不超过{AGENT_CONTEXT_SUMMARY_MAX_CHARS}字的摘要，"
+                      "保留关键事实、用户的偏好和尚未解决的问题，只输出摘要本身。\n\n" + "\n".join(lines))
+            # 摘要调用与对话调用一样经过准入控制，计入该用户的频率和全局并发
+            async with agent_scheduler.slot(user_id):
+                result = await agent_service.call_agent(prompt)
+            if not result['success'] or not result['response'].strip():
+                logger.warning("生成对话摘要失败: chat_id=%s, %s", chat_id, result.get('error'))
+                return
+            self.record_usage(None, result.get('usage'))
+            self.summaries.set(chat_id, {
+                "until": dropped[-1]['timestamp'],
+                "text": result['response'].strip()[:AGENT_CONTEXT_SUMMARY_MAX_CHARS * 2]
+            })
+            self.summaries_generated += 1
+        except AgentOverloadedError as e:
+            logger.warning("智能体繁忙，跳过生成对话摘要: chat_id=%s, %s", chat_id, e)
+        except Exception as e:
+            logger.error("生成对话摘要异常: chat_id=%s, %r", chat_id, e)
+        finally:
+            self._summarizing.discard(chat_id)
+    
+    @staticmethod
+    def parse_usage(usage) -> Tuple[int, int]:
+        """从百炼返回的usage中取输入、输出token数（应用接口按模型分列在models中）"""
+        if not usage:
+            return 0, 0
+        models = usage.get('models') if isinstance(usage, dict) else None
+        if models:
+            return (sum(m.get('input_tokens') or 0 for m in models),
+                    sum(m.get('output_tokens') or 0 for m in models))
+        return usage.get('input_tokens') or 0, usage.get('output_tokens') or 0
+    
+    def record_usage(self, context: Optional[dict], usage):
+        """记录一次调用的实际token消耗；context为本次调用的上下文（session模式为None）"""
+        input_tokens, output_tokens = self.parse_usage(usage)
+        if not input_tokens and not output_tokens:
+            return
+        AGENT_TOKENS.inc("input", amount=input_tokens)
+        AGENT_TOKENS.inc("output", amount=output_tokens)
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        if context is not None:
+            self.usage_calls += 1
+            self.estimated_tokens += context['estimated_tokens']
+            self.context_input_tokens += input_tokens
+    
+    def get_stats(self) -> dict:
+        return {
+            "mode": "history" if self.enabled else "session",
+            "max_tokens": self.max_tokens,
+            "max_messages": self.max_messages,
+            "builds": self.builds,
+            "history_failures": self.history_failures,
+            "truncated_builds": self.truncated_builds,
+            "dropped_messages": self.dropped_messages,
+            "summary_enabled": self.summary_enabled,
+            "summary_cache": self.summaries.get_stats(),
+            "summaries_generated": self.summaries_generated,
+            "summaries_used": self.summaries_used,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            # 实际输入token与估算值之比（含应用自身的提示词），用于调整AGENT_CONTEXT_MAX_TOKENS
+            "usage_calls": self.usage_calls,
+            "estimated_tokens": self.estimated_tokens,
+            "actual_to_estimated": round(self.context_input_tokens / self.estimated_tokens, 3) if self.estimated_tokens else None
+        }
+
+# 全局上下文组装实例
+context_builder = ContextBuilder()
+
+class ClientDisconnectedError(Exception):
+    """客户端在请求处理完成前断开连接"""
+
+async def run_until_disconnected(request: Request, coro, poll_interval: float = DISCONNECT_POLL_INTERVAL):
+    """
+    执行协程，并在客户端断开连接时取消执行
+    
+    Raises:
+        ClientDisconnectedError: 客户端已断开连接
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                raise ClientDisconnectedError()
+    finally:
+        if not task.done():
+            task.cancel()
+
+class ChatConnection:
+    """
+    单个WebSocket连接：事件先放入有界发送队列，由独立的写协程发送
+    
+    客户端读取过慢导致队列写满时断开连接（1013），慢连接不会阻塞回复生成和其他连接，客户端可按seq重连续传。
+    """
+    
+    def __init__(self, websocket: WebSocket, max_queue: int = WS_SEND_QUEUE_SIZE):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(max_queue)
+        self.overflowed = False
+        self._writer = None
+    
+    def start(self):
+        self._writer = asyncio.ensure_future(self._write_loop())
+    
+    async def _write_loop(self):
         try:
-            logger.info(f"调用阿里云百炼智能体，消息: {message[:50]}...")
-            
-            # 准备请求参数
-            request_params = {
-                'app_id': self.app_id,
-                'prompt': message,
-                'stream': False,  # 不使用流式响应
-                'incremental_output': False
-            }
-            
-            # 如果有会话ID，添加到请求中
-            if session_id:
-                request_params['session_id'] = session_id
-            
-            # 调用智能体
-            response = Application.call(**request_params)
-            
-            if response.status_code == 200:
-                result = response.output
-                logger.info(f"智能体调用成功，回复: {result.get('text', '')[:100]}...")
-                
-                return {
-                    'success': True,
-                    'response': result.get('text', ''),
-                    'session_id': result.get('session_id', session_id),
-                    'usage': result.get('usage', {})
-                }
-            else:
-                logger.error(f"智能体调用失败，状态码: {response.status_code}, 错误: {response.message}")
-                return {
-                    'success': False,
-                    'error': f"智能体调用失败: {response.message}",
-                    'status_code': response.status_code
-                }
-                
+            while True:
+                text = await self.queue.get()
+                await self.websocket.send_text(text)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error(f"调用阿里云百炼智能体异常: {e}", exc_info=True)
-            return {
-                'success': False,
-                'error': f"调用智能体异常: {str(e)}"
-            }
+            logger.info("WebSocket发送失败，连接可能已断开: %r", e)
     
-    def get_fallback_response(self, message: str) -> str:
+    def offer(self, text: str) -> bool:
+        """放入发送队列（不等待）；队列已满时断开连接"""
+        if self.overflowed:
+            return False
+        try:
+            self.queue.put_nowait(text)
+            return True
+        except asyncio.QueueFull:
+            self.overflowed = True
+            WS_DISCONNECTS.inc("overflow")
+            logger.warning("WebSocket发送队列已满，断开慢连接: 积压 %s 条", self.queue.qsize())
+            run_in_background(self.close(1013, "send queue overflow"))
+            return False
+    
+    async def close(self, code: int = 1000, reason: str = ""):
+        if self._writer:
+            self._writer.cancel()
+        try:
+            await self.websocket.close(code, reason)
+        except Exception:
+            pass  # 连接已关闭
+
+class UserChannel:
+    """单个用户的事件序列：递增seq、最近事件的重放缓冲和当前连接"""
+    
+    def __init__(self, replay_size: int):
+        self.epoch = uuid.uuid4().hex[:12]
+        self.seq = 0
+        self.events = deque(maxlen=replay_size)  # (seq, 事件JSON文本)
+        self.connections = set()
+        self.pending_sends = 0
+        self.detached_at = time.monotonic()
+
+class ChatChannelHub:
+    """
+    按用户分发聊天事件：每个用户的事件带递增seq，并保留最近的事件供断线重连后续传
+    
+    同一用户的所有连接（多个标签页或设备）都会收到事件。状态保存在进程内，多进程部署时只能收到
+    本进程产生的事件（hello中partial为true，客户端需保留轮询）；重连到另一进程或服务重启后epoch不同，
+    客户端需重新拉取对话列表和历史。
+    """
+    
+    def __init__(self, replay_size: int = WS_REPLAY_BUFFER_SIZE, resume_ttl: float = WS_RESUME_TTL):
+        self.replay_size = replay_size
+        self.resume_ttl = resume_ttl
+        self.channels: Dict[str, UserChannel] = {}
+        self.tasks = set()
+        self._last_prune = time.monotonic()
+    
+    @property
+    def connection_count(self) -> int:
+        return sum(len(channel.connections) for channel in self.channels.values())
+    
+    def attach(self, user_id: str, connection: ChatConnection, epoch: Optional[str] = None,
+               last_seq: Optional[int] = None) -> Tuple[UserChannel, Optional[List[str]]]:
         """
-        获取备用回复（当智能体不可用时使用）
+        注册连接并计算需要重放的事件
         
-        Args:
-            message: 用户消息
-            
         Returns:
-            str: 备用回复
+            Tuple[UserChannel, Optional[List[str]]]: (用户事件序列, 需重放的事件)；
+            无法续传（epoch不一致或事件已超出重放缓冲）时为None
         """
-        logger.info("使用备用回复方案")
+        self._prune()
+        channel = self.channels.get(user_id)
+        if channel is None:
+            channel = self.channels[user_id] = UserChannel(self.replay_size)
         
-        # 简单的备用回复逻辑
-        if "你好" in message or "hi" in message.lower():
-            return "您好！我是AI助手，很高兴为您服务。虽然我现在连接智能体遇到了一些问题，但我仍然会尽力帮助您。"
-        elif "帮助" in message or "help" in message.lower():
-            return "我可以帮您解答问题、创作内容、分析文档等。目前智能体服务暂时不可用，请稍后再试。"
-        else:
-            return f"我已收到您的消息：'{message}'。目前智能体服务暂时不可用，请稍后再试。我会尽快恢复服务。"
+        replay = []
+        if last_seq is not None:
+            oldest = channel.events[0][0] if channel.events else channel.seq + 1
+            if epoch != channel.epoch or last_seq > channel.seq or last_seq < oldest - 1:
+                replay = None
+            else:
+                replay = [text for seq, text in channel.events if seq > last_seq]
+        channel.connections.add(connection)
+        return channel, replay
+    
+    def detach(self, user_id: str, connection: ChatConnection):
+        channel = self.channels.get(user_id)
+        if channel:
+            channel.connections.discard(connection)
+            if not channel.connections:
+                channel.detached_at = time.monotonic()
+    
+    def publish(self, user_id: Optional[str], event_type: str, data: dict) -> Optional[int]:
+        """向用户的所有连接发布事件；用户没有连接且已过续传保留期时忽略"""
+        channel = self.channels.get(user_id) if user_id else None
+        if channel is None:
+            return None
+        channel.seq += 1
+        text = json.dumps({"seq": channel.seq, "type": event_type, **data}, ensure_ascii=False)
+        channel.events.append((channel.seq, text))
+        for connection in list(channel.connections):
+            connection.offer(text)
+        WS_EVENTS.inc(event_type)
+        self._prune()
+        return channel.seq
+    
+    def _prune(self):
+        """清理所有连接都已断开且超过续传保留期的用户"""
+        now = time.monotonic()
+        if now - self._last_prune < min(self.resume_ttl, 60):
+            return
+        self._last_prune = now
+        expired = [user_id for user_id, channel in self.channels.items()
+                   if not channel.connections and not channel.pending_sends and now - channel.detached_at > self.resume_ttl]
+        for user_id in expired:
+            del self.channels[user_id]
+    
+    def spawn(self, coro):
+        """在后台执行回复生成，停机时等待其完成"""
+        task = run_in_background(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+    
+    async def drain(self, timeout: float):
+        """等待进行中的回复生成完成（最多timeout秒）"""
+        if self.tasks:
+            logger.info("等待 %s 个WebSocket回复生成完成", len(self.tasks))
+            await asyncio.wait(set(self.tasks), timeout=timeout)
+    
+    def get_stats(self) -> dict:
+        return {
+            "users": len(self.channels),
+            "connections": self.connection_count,
+            "pending_replies": len(self.tasks),
+            "replay_buffer_size": self.replay_size,
+            "resume_ttl": self.resume_ttl
+        }
 
-# 全局智能体服务实例
-try:
-    agent_service = DashScopeService()
-    logger.info("阿里云百炼智能体服务初始化成功")
-except Exception as e:
-    logger.error(f"阿里云百炼智能体服务初始化失败: {e}")
-    agent_service = None
+# 全局聊天事件分发实例
+chat_hub = ChatChannelHub()
+
+# 抓取时计算的连接池、队列和智能体并发指标
+metrics.register(Gauge(
+    "agent_calls_in_flight", "进行中的智能体调用数（含排队）",
+    collect=lambda: agent_service.in_flight if agent_service else 0))
+metrics.register(Gauge(
+    "agent_circuit_state", "智能体熔断器状态（0关闭 1半开 2打开）",
+    collect=lambda: CircuitBreaker.STATE_VALUES[agent_service.breaker.state] if agent_service and agent_service.breaker else 0))
+def collect_pool_connections() -> dict:
+    """连接池各状态的连接数，无法统计（unavailable）的状态不输出"""
+    stats = db_service.get_pool_stats()
+    return {(state,): stats[f"{state}_connections"] for state in ("in_use", "idle")
+            if isinstance(stats.get(f"{state}_connections"), int)}
+
+metrics.register(Gauge(
+    "supabase_pool_connections", "Supabase连接池连接数", ("state",), collect=collect_pool_connections))
+metrics.register(Gauge(
+    "message_write_queue_depth", "消息写入队列积压数",
+    collect=lambda: db_service.write_queue.get_stats()["queue_size"] if db_service.write_queue else 0))
+metrics.register(Gauge(
+    "agent_scheduler_slots", "智能体调度名额（active进行中，waiting排队中）", ("state",),
+    collect=lambda: {("active",): agent_scheduler.active, ("waiting",): agent_scheduler.waiting}))
+metrics.register(Gauge(
+    "ws_connections", "当前WebSocket连接数", collect=lambda: chat_hub.connection_count))
+metrics.register(Gauge(
+    "password_hash_tasks", "密码哈希线程池任务数", ("state",),
+    collect=lambda: {("active",): password_hasher.active, ("waiting",): password_hasher.waiting}))
 
 # API路由
 @app.get("/")
 async def root():
     return {"message": "DeepSeek Chat API 服务运行中", "version": "1.0.0"}
 
+@app.get("/api/system/ready")
+async def readiness():
+    """就绪检查：上游连接预热完成且未处于停机状态时返回200，否则返回503"""
+    status = {
+        "ready": service_state["ready"] and not service_state["draining"],
+        "draining": service_state["draining"],
+        "supabase_warm": service_state["supabase_warm"],
+        "agent_warm": service_state["agent_warm"],
+        "agent_in_flight": agent_service.in_flight if agent_service else 0
+    }
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus指标"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/system/agent-circuit")
+async def get_agent_circuit_stats():
+    """获取智能体熔断器状态"""
+    if not agent_service or not agent_service.breaker:
+        return {"success": True, "circuit": {"enabled": False}}
+    return {"success": True, "circuit": {"enabled": True, **agent_service.breaker.get_stats()}}
+
+@app.get("/api/system/agent-scheduler")
+async def get_agent_scheduler_stats():
+    """获取智能体调用准入控制与排队状态"""
+    return {"success": True, "scheduler": agent_scheduler.get_stats()}
+
+@app.get("/api/system/agent-context")
+async def get_agent_context_stats():
+    """获取对话上下文组装与token消耗统计"""
+    return {"success": True, "context": context_builder.get_stats()}
+
+@app.get("/api/system/db-pool")
+async def get_db_pool_stats():
+    """获取Supabase连接池状态（用于压测调优）"""
+    return {"success": True, "pool": db_service.get_pool_stats(), "coalescing": db_service.get_read_stats()}
+
+@app.get("/api/system/password-pool")
+async def get_password_pool_stats():
+    """获取密码哈希线程池队列指标"""
+    return {"success": True, "pool": password_hasher.get_stats()}
+
+@app.get("/api/system/websocket")
+async def get_websocket_stats():
+    """获取WebSocket聊天通道的连接与续传状态"""
+    return {"success": True, "websocket": chat_hub.get_stats()}
+
+@app.get("/api/system/caches")
+async def get_cache_stats():
+    """获取进程内缓存命中情况"""
+    return {
+        "success": True,
+        "caches": {
+            "users": db_service.user_cache.get_stats(),
+            "chats": db_service.chat_cache.get_stats(),
+            "agent_replies": agent_service.reply_cache.get_stats() if agent_service else None
+        }
+    }
+
+@app.get("/api/system/message-queue")
+async def get_message_queue_stats():
+    """获取消息写入队列指标"""
+    if db_service.write_queue is None:
+        return {"success": True, "queue": {"enabled": False}}
+    return {"success": True, "queue": db_service.write_queue.get_stats()}
+
+def public_user_info(user: dict) -> dict:
+    """返回给客户端的用户信息（不包含密码）"""
+    return {
+        'id': user['id'],
+        'username': user['username'],
+        'email': user['email'],
+        'avatar': user.get('avatar_url', 'https://design.gemcoder.com/staticResource/echoAiSystemImages/3af53b10252ba2331a996da3c32fd378.png'),
+        'plan': user.get('plan', '个人版'),
+        'created_at': user.get('created_at', datetime.now().isoformat())
+    }
+
 @app.post("/api/auth/login", response_model=LoginResponse)
 async def login(user_data: UserLogin):
     """用户登录"""
@@ -570,22 +3817,20 @@ async def login(user_data: UserLogin):
             return LoginResponse(success=False, message="用户不存在")
         
         # 验证密码
-        if not db_service.check_password(user_data.password, user['password_hash']):
+        if not await db_service.check_password(user_data.password, user['password_hash']):
             return LoginResponse(success=False, message="密码错误")
         
+        # bcrypt cost配置变更后，登录成功时在后台透明升级哈希
+        if password_hasher.needs_rehash(user['password_hash']):
+            run_in_background(db_service.rehash_password(user['id'], user_data.password))
+        
         # 登录成功，返回用户信息（不包含密码）
-        user_info = {
-            'id': user['id'],
-            'username': user['username'],
-            'email': user['email'],
-            'avatar': user.get('avatar_url', 'https://design.gemcoder.com/staticResource/echoAiSystemImages/3af53b10252ba2331a996da3c32fd378.png'),
-            'plan': user.get('plan', '个人版'),
-            'created_at': user.get('created_at', datetime.now().isoformat())
-        }
+        user_info = public_user_info(user)
         
+        agent_scheduler.set_plan(user['id'], user_info['plan'])
         return LoginResponse(success=True, user=User(**user_info))
     except Exception as e:
-        logger.error(f"登录失败: {e}")
+        logger.error("登录失败: %s", e)
         return LoginResponse(success=False, message="登录失败，请稍后重试")
 
 @app.post("/api/auth/register", response_model=LoginResponse)
@@ -600,18 +3845,19 @@ async def register(user_data: UserRegister):
         if not user_data.agree_terms:
             return LoginResponse(success=False, message="请同意服务条款")
         
-        # 检查用户名是否已存在
-        existing_user = await db_service.get_user_by_identifier(user_data.username)
-        if existing_user:
+        # 一次查询同时检查用户名和邮箱是否已存在
+        existing_users = await db_service.find_users_by_identifiers(user_data.username, user_data.email)
+        if existing_users is None:
+            return LoginResponse(success=False, message="注册失败，请稍后重试")
+        
+        if any(user_data.username in (u['username'], u['email']) for u in existing_users):
             return LoginResponse(success=False, message="用户名已被使用")
         
-        # 检查邮箱是否已存在
-        existing_email = await db_service.get_user_by_identifier(user_data.email)
-        if existing_email:
+        if any(user_data.email in (u['username'], u['email']) for u in existing_users):
             return LoginResponse(success=False, message="邮箱已被注册")
         
         # 创建新用户
-        hashed_password = db_service.hash_password(user_data.password)
+        hashed_password = await db_service.hash_password(user_data.password)
         user = await db_service.create_user(user_data.username, user_data.email, hashed_password)
         
         if not user:
@@ -636,17 +3882,68 @@ async def register(user_data: UserRegister):
         
         return LoginResponse(success=True, user=User(**user_info))
     except Exception as e:
-        logger.error(f"注册失败: {e}")
+        logger.error("注册失败: %s", e)
         return LoginResponse(success=False, message="注册失败，请稍后重试")
 
+# 条件请求：响应只属于当前用户，允许浏览器缓存但每次都要重新验证
+ETAG_CACHE_CONTROL = "private, no-cache"
+
+def make_etag(kind: str, digest: str, *params) -> str:
+    """由响应数据摘要和请求参数生成弱ETag"""
+    digest = hashlib.blake2b(f"{kind}|{digest}|{params!r}".encode(), digest_size=12).hexdigest()
+    return f'W/"{digest}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """按弱比较规则判断If-None-Match是否命中"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag[2:] in {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+
+def body_digest(items) -> str:
+    """响应体数据的摘要（RawJSON直接计算，不再解析）"""
+    data = items if isinstance(items, bytes) else (orjson.dumps(items) if orjson else json.dumps(items).encode())
+    return hashlib.blake2b(data, digest_size=12).hexdigest()
+
+async def respond_with_etag(request: Request, response: Response, build_body, kind: str, *params):
+    """
+    带ETag的读取，If-None-Match命中时返回304（不传输响应体）
+    
+    ETag由本次响应体的数据（列表及has_more、pagination等其余字段）计算，与响应体必然一致，
+    命中与否都只有一次查询；查询失败（success为False）时不返回ETag，下次完整拉取。
+    
+    Args:
+        build_body: 生成响应体的协程函数
+        kind: 资源类型，与params一起参与ETag计算
+    """
+    body = await build_body()
+    etag = None
+    if body.get("success"):
+        items = body.get("chats", body.get("messages"))
+        rest = {key: value for key, value in body.items() if key not in ("chats", "messages")}
+        etag = make_etag(kind, body_digest(items), rest, *params)
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": ETAG_CACHE_CONTROL})
+    
+    headers = {"ETag": etag, "Cache-Control": ETAG_CACHE_CONTROL} if etag else None
+    if FAST_JSON:
+        return FastJSONResponse(body, headers=headers)
+    if headers:
+        response.headers.update(headers)
+    return body
+
 @app.get("/api/auth/chats/{user_id}")
-async def get_user_chats(user_id: str):
-    """获取用户的所有对话"""
-    try:
+async def get_user_chats(user_id: str, request: Request, response: Response):
+    """获取用户的所有对话（支持If-None-Match条件请求）"""
+    async def build_body():
         chats = await db_service.get_user_chats(user_id)
         return {"success": True, "chats": chats}
+    
+    try:
+        return await respond_with_etag(request, response, build_body, "chats", user_id)
     except Exception as e:
-        logger.error(f"获取用户对话失败: {e}")
+        logger.error("获取用户对话失败: %s", e)
         return {"success": False, "message": "获取对话失败", "chats": []}
 
 from pydantic import BaseModel
@@ -658,6 +3955,9 @@ class GetUserChatsRequest(BaseModel):
     user_id: str
     page: int = 1
     page_size: int = 10
+    use_cursor: bool = False  # 使用游标分页（首页不传cursor）
+    cursor: Optional[str] = None  # 上一页返回的next_cursor
+    count: Optional[str] = "exact"  # 总数统计方式: exact/planned/estimated，null表示不统计
 
 @app.post("/api/chat/new")
 async def create_new_chat(request_data: CreateChatRequest = None):
@@ -675,260 +3975,733 @@ async def create_new_chat(request_data: CreateChatRequest = None):
         chat = await db_service.create_chat(user_id, "新对话")
         
         if chat:
-            return {
-                "success": True, 
-                "chat": {
-                    "id": chat['id'],
-                    "title": chat['title'],
-                    "color": chat['color'],
-                    "icon_color": chat['icon_color'],
-                    "created_at": chat['created_at']
-                }
-            }
+            chat_hub.publish(user_id, "chat.created", {"chat": chat_summary(chat)})
+            return {"success": True, "chat": chat_summary(chat)}
         else:
             return {"success": False, "message": "创建对话失败"}
     except Exception as e:
-        logger.error(f"创建新对话失败: {e}")
+        logger.error("创建新对话失败: %s", e)
         return {"success": False, "message": "创建对话失败"}
 
 @app.post("/api/auth/chats")
-async def get_user_chats_paginated(request: GetUserChatsRequest):
-    """获取用户的分页对话列表"""
-    try:
-        chats = await db_service.get_user_chats_paginated(request.user_id, request.page, request.page_size)
-        total_count = await db_service.get_user_chats_count(request.user_id)
+async def get_user_chats_paginated(request: GetUserChatsRequest, http_request: Request, response: Response):
+    """获取用户的分页对话列表（只读查询，支持If-None-Match条件请求）"""
+    async def build_body():
+        if request.use_cursor or request.cursor:
+            # 游标分页：按(created_at, id)定位，深分页不会变慢
+            try:
+                result = await db_service.get_user_chats_page(
+                    request.user_id, request.page_size, cursor=request.cursor, count=request.count
+                )
+            except ValueError:
+                return {"success": False, "message": "无效的分页游标", "chats": []}
+            
+            return {
+                "success": True,
+                "chats": result["chats"],
+                "pagination": {
+                    "page_size": request.page_size,
+                    "total_count": result["total_count"],
+                    "next_cursor": result["next_cursor"],
+                    "has_more": result["has_more"]
+                }
+            }
+        
+        # 偏移分页：总数从同一响应的Content-Range中获取，无需再次请求
+        result = await db_service.get_user_chats_page(
+            request.user_id, request.page_size, page=request.page, count=request.count
+        )
+        total_count = result["total_count"] or 0
         
         return {
             "success": True, 
-            "chats": chats,
+            "chats": result["chats"],
             "pagination": {
                 "page": request.page,
                 "page_size": request.page_size,
                 "total_count": total_count,
-                "total_pages": (total_count + request.page_size - 1) // request.page_size
+                "total_pages": (total_count + request.page_size - 1) // request.page_size,
+                "next_cursor": result["next_cursor"],
+                "has_more": result["has_more"]
             }
         }
+    
+    try:
+        if request.count not in (None, "exact", "planned", "estimated"):
+            return {"success": False, "message": "不支持的总数统计方式", "chats": []}
+        
+        return await respond_with_etag(http_request, response, build_body, "chats_page", request.model_dump())
     except Exception as e:
-        logger.error(f"获取用户对话失败: {e}")
+        logger.error("获取用户对话失败: %s", e)
         return {"success": False, "message": "获取对话失败", "chats": []}
 
-# 保持原有的API兼容性
-@app.get("/api/auth/chats/{user_id}")
-async def get_user_chats(user_id: str):
-    """获取用户的所有对话（兼容旧版本）"""
+@app.get("/api/auth/bootstrap/{user_id}")
+async def bootstrap(
+    user_id: str,
+    page_size: int = Query(10, ge=1, le=100),
+    message_limit: int = Query(50, ge=1, le=HISTORY_MAX_PAGE_SIZE)
+):
+    """
+    登录后的初始数据：用户信息、第一页对话和最新对话的最新消息
+    
+    三个查询并发执行，耗时约为一次上游往返；最新对话与对话列表同序（即chats[0]），
+    其消息多取一条用于判断has_more，与聊天历史接口的limit参数语义一致。
+    """
     try:
-        chats = await db_service.get_user_chats(user_id)
-        return {"success": True, "chats": chats}
+        timer = StageTimer("bootstrap")
+        user, page, latest = await asyncio.gather(
+            timer.track("user", db_service.get_user_by_id(user_id)),
+            timer.track("chats", db_service.get_user_chats_page(user_id, page_size, page=1, count="exact")),
+            timer.track("messages", db_service.get_latest_chat_messages(user_id, message_limit + 1))
+        )
+        timer.log(user_id=user_id)
+        
+        if not user:
+            return {"success": False, "message": "用户不存在"}
+        
+        user_info = public_user_info(user)
+        agent_scheduler.set_plan(user_id, user_info['plan'])
+        
+        current_chat = None
+        if latest and latest['chat_id']:
+            messages = latest['messages']
+            has_more = len(messages) > message_limit
+            current_chat = {
+                "chat_id": latest['chat_id'],
+                "messages": messages[1:] if has_more else messages,
+                "has_more": has_more
+            }
+        
+        total_count = page["total_count"] or 0
+        return fast_json({
+            "success": True,
+            "user": user_info,
+            "chats": page["chats"],
+            "pagination": {
+                "page": 1,
+                "page_size": page_size,
+                "total_count": total_count,
+                "total_pages": (total_count + page_size - 1) // page_size,
+                "next_cursor": page["next_cursor"],
+                "has_more": page["has_more"]
+            },
+            "current_chat": current_chat
+        })
     except Exception as e:
-        logger.error(f"获取用户对话失败: {e}")
-        return {"success": False, "message": "获取对话失败", "chats": []}
+        logger.error("获取登录初始数据失败: %s", e, exc_info=True)
+        return {"success": False, "message": "获取初始数据失败，请稍后重试"}
+
+class StageTimer:
+    """记录请求各阶段耗时，统一输出一行日志便于统计p50/p99"""
+    
+    # 阶段耗时订阅者，签名为 observer(name, stages, total)，供基准测试等统计使用
+    observers: List = []
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.stages = {}
+    
+    async def track(self, stage: str, awaitable):
+        """等待awaitable并记录该阶段耗时"""
+        stage_start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.stages[stage] = (time.perf_counter() - stage_start) * 1000
+    
+    def log(self, **extra):
+        """输出各阶段耗时（毫秒）"""
+        total = (time.perf_counter() - self.started) * 1000
+        for observer in StageTimer.observers:
+            observer(self.name, self.stages, total)
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        stages = " ".join(f"{stage}={elapsed:.1f}ms" for stage, elapsed in self.stages.items())
+        fields = "".join(f" {key}={value}" for key, value in extra.items())
+        logger.info("阶段耗时 %s: %s total=%.1fms%s", self.name, stages, total, fields)
+
+def build_chat_title(message: str) -> str:
+    """使用用户第一条消息作为对话标题（截取前20个字符）"""
+    return message[:20] + "..." if len(message) > 20 else message
+
+async def persist_user_message(chat_request: ChatRequest, chat_id: str, timestamp: int, timer: Optional[StageTimer] = None) -> Tuple[Optional[dict], Optional[str]]:
+    """
+    确保对话存在并保存用户消息
+    
+    对话状态只查询一次；对话不存在时先创建再保存，首条消息的标题更新与消息保存并发执行。
+    
+    Returns:
+        Tuple[Optional[dict], Optional[str]]: (保存的用户消息, 失败原因)
+    """
+    timer = timer or StageTimer("persist_user_message")
+    chat_state = None
+    if chat_request.chat_id:
+        chat_state = await timer.track("chat_state", db_service.get_chat_state(chat_id))
+    
+    if chat_state is None:
+        # 从前端传递的数据中获取用户ID，未传递时使用测试用户ID
+        user_id = chat_request.user_id or "a2431f9f-f48e-4225-b59e-c1a16cb590f2"
+        title = build_chat_title(chat_request.message)
+        logger.info("对话不存在，创建新对话: chat_id=%s, user_id=%s, title=%s", chat_id, user_id, title)
+        
+        new_chat = await timer.track("create_chat", db_service.create_chat_with_id(user_id, chat_id, title))
+        if not new_chat:
+            logger.error("创建对话失败: %s", chat_id)
+            return None, "创建对话失败"
+        chat_hub.publish(user_id, "chat.created", {"chat": chat_summary(new_chat)})
+        user_message = await timer.track(
+            "save_user", db_service.save_message(chat_id, 'user', chat_request.message, timestamp)
+        )
+    elif not chat_state['has_messages']:
+        # 对话的第一条消息，标题更新与消息保存并发执行
+        title = build_chat_title(chat_request.message)
+        logger.info("检测到这是对话的第一条消息，更新标题: %s, title: %s", chat_id, title)
+        update_success, user_message = await timer.track("save_user", asyncio.gather(
+            db_service.update_chat_title(chat_id, title),
+            db_service.save_message(chat_id, 'user', chat_request.message, timestamp)
+        ))
+        if update_success:
+            chat_hub.publish(chat_state['user_id'], "chat.updated", {"chat_id": chat_id, "title": title})
+        else:
+            logger.warning("更新对话标题失败，但继续处理消息: %s", chat_id)
+    else:
+        user_message = await timer.track(
+            "save_user", db_service.save_message(chat_id, 'user', chat_request.message, timestamp)
+        )
+    
+    if not user_message:
+        logger.error("保存用户消息失败，chat_id: %s", chat_id)
+        return None, "消息保存失败"
+    # 对话列表按最后活动时间排序，通知客户端把该对话移到最前
+    owner_id = chat_state['user_id'] if chat_state else user_id
+    chat_hub.publish(owner_id, "chat.updated", {"chat_id": chat_id, "last_message_at": timestamp})
+    return user_message, None
+
+def chat_summary(chat: dict) -> dict:
+    """对话列表项（与创建对话接口返回的字段一致）"""
+    return {
+        "id": chat['id'],
+        "title": chat['title'],
+        "color": chat.get('color'),
+        "icon_color": chat.get('icon_color'),
+        "created_at": chat.get('created_at')
+    }
+
+def is_fresh_chat(chat_request: ChatRequest) -> bool:
+    """是否为新会话的第一条消息：新对话，或缓存显示还没有消息的已有对话"""
+    if not chat_request.chat_id:
+        return True
+    if SERVER_WORKERS > 1:
+        # 对话可能已在其他进程收到消息，缓存中的has_messages=False不可信
+        return False
+    cached = db_service.chat_cache.peek(chat_request.chat_id)
+    return cached is not CACHE_MISS and cached['has_messages'] is False
+
+def overloaded_response(error: AgentOverloadedError) -> JSONResponse:
+    """准入控制拒绝时返回429及Retry-After"""
+    return JSONResponse(
+        status_code=429,
+        content={"success": False, "message": str(error), "retry_after": error.retry_after},
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
+async def generate_ai_response(message: str, session_id: str, fresh_chat: bool = False, user_id: Optional[str] = None,
+                               before_timestamp: Optional[int] = None) -> str:
+    """
+    调用阿里云百炼智能体生成回复（按用户公平排队），失败时使用备用回复；新会话的首条消息优先使用回复缓存
+    
+    session_id即对话ID：history模式下据此读取历史组装上下文（只取早于before_timestamp的消息），否则作为百炼会话ID。
+    """
+    ai_response = None
+    
+    if agent_service and fresh_chat:
+        cached_reply = agent_service.get_cached_reply(message)
+        if cached_reply is not None:
+            logger.info("首条消息命中回复缓存，回复长度: %d", len(cached_reply))
+            return cached_reply
+    
+    if agent_service:
+        logger.debug("开始调用阿里云百炼智能体")
+        context = await context_builder.build(session_id, message, before_timestamp, fresh_chat, user_id)
+        try:
+            async with agent_scheduler.slot(user_id):
+                agent_result = await agent_service.call_agent(
+                    message, session_id, messages=context['messages'] if context else None
+                )
+        except AgentOverloadedError as e:
+            agent_result = {'success': False, 'error': str(e)}
+        
+        if agent_result['success']:
+            context_builder.record_usage(context, agent_result.get('usage'))
+            ai_response = agent_result['response']
+            logger.debug("智能体调用成功，生成回复长度: %d", len(ai_response))
+            if fresh_chat:
+                agent_service.cache_reply(message, ai_response)
+        else:
+            logger.warning("智能体调用失败: %s", agent_result.get('error', '未知错误'))
+            AGENT_FALLBACKS.inc("call")
+            # 使用备用回复
+            ai_response = agent_service.get_fallback_response(message)
+            logger.info("使用备用回复方案")
+    else:
+        logger.warning("智能体服务未初始化，使用备用回复")
+        AGENT_FALLBACKS.inc("call")
+        # 智能体服务未初始化，使用备用回复
+        ai_response = f"我已收到您的消息：'{message}'。智能体服务暂时不可用，请稍后再试。"
+    
+    # 确保AI回复不为空
+    if not ai_response or not ai_response.strip():
+        logger.warning("AI回复为空，使用默认回复")
+        ai_response = f"我已收到您的消息：'{message}'，正在处理中..."
+    
+    return ai_response
 
 @app.post("/api/chat/send", response_model=ChatResponse)
-async def send_message(chat_request: ChatRequest):
+async def send_message(chat_request: ChatRequest, request: Request):
     """发送聊天消息"""
     try:
-        logger.info(f"收到消息发送请求: message='{chat_request.message}', chat_id={chat_request.chat_id}")
+        logger.info("收到消息发送请求: 消息长度=%d, chat_id=%s", len(chat_request.message), chat_request.chat_id)
         
         if not chat_request.message.strip():
             logger.warning("消息内容为空")
             return ChatResponse(success=False, message="消息内容不能为空")
         
-        # 生成聊天ID（如果未提供）
-        chat_id = chat_request.chat_id
+        agent_scheduler.admit(chat_request.user_id)
         
-        # 如果没有提供chat_id，需要先创建对话
-        if not chat_id:
-            logger.info("未提供chat_id，需要创建新对话")
-            # 从前端传递的数据中获取用户ID
-            user_id = None
-            if hasattr(chat_request, 'user_id') and chat_request.user_id:
-                user_id = chat_request.user_id
-            
-            # 如果前端没有传递用户ID，使用测试用户ID
-            if not user_id:
-                user_id = "a2431f9f-f48e-4225-b59e-c1a16cb590f2"  # 测试用户ID
-                logger.info(f"使用测试用户ID: {user_id}")
-            
-            # 使用用户第一条消息作为对话标题（截取前20个字符）
-            title = chat_request.message[:20] + "..." if len(chat_request.message) > 20 else chat_request.message
-            logger.info(f"使用用户消息作为对话标题: {title}")
-            
-            new_chat = await db_service.create_chat(user_id, title)
-            
-            if not new_chat:
-                logger.error("创建对话失败")
-                return ChatResponse(success=False, message="创建对话失败")
-            
-            chat_id = new_chat['id']
-            logger.info(f"成功创建新对话，chat_id: {chat_id}, title: {title}")
-        else:
-            # 如果提供了chat_id，检查对话是否存在
-            logger.info(f"检查chat_id是否存在: {chat_id}")
-            chat_exists = await db_service.check_chat_exists(chat_id)
-            if not chat_exists:
-                logger.info(f"chat_id不存在，需要创建新对话: {chat_id}")
-                # 从前端传递的数据中获取用户ID
-                user_id = None
-                if hasattr(chat_request, 'user_id') and chat_request.user_id:
-                    user_id = chat_request.user_id
-                
-                # 如果前端没有传递用户ID，使用测试用户ID
-                if not user_id:
-                    user_id = "a2431f9f-f48e-4225-b59e-c1a16cb590f2"  # 测试用户ID
-                    logger.info(f"使用测试用户ID: {user_id}")
-                
-                # 使用用户第一条消息作为对话标题（截取前20个字符）
-                title = chat_request.message[:20] + "..." if len(chat_request.message) > 20 else chat_request.message
-                logger.info(f"使用用户消息作为对话标题: {title}")
-                
-                # 使用前端提供的chat_id创建对话
-                new_chat = await db_service.create_chat_with_id(user_id, chat_id, title)
-                
-                if not new_chat:
-                    logger.error(f"使用指定ID创建对话失败: {chat_id}")
-                    return ChatResponse(success=False, message="创建对话失败")
-                
-                logger.info(f"成功使用指定ID创建新对话: {chat_id}, title: {title}")
-            else:
-                logger.info(f"chat_id存在，直接使用: {chat_id}")
-                
-                # 检查这是否是该对话的第一条消息，如果是则更新标题
-                messages = await db_service.get_chat_messages(chat_id)
-                if not messages:  # 如果没有消息，说明这是第一条消息
-                    logger.info(f"检测到这是对话的第一条消息，更新标题")
-                    title = chat_request.message[:20] + "..." if len(chat_request.message) > 20 else chat_request.message
-                    logger.info(f"使用用户消息作为对话标题: {title}")
-                    
-                    # 更新对话标题
-                    update_success = await db_service.update_chat_title(chat_id, title)
-                    if update_success:
-                        logger.info(f"成功更新对话标题: {chat_id}, title: {title}")
-                    else:
-                        logger.warning(f"更新对话标题失败，但继续处理消息: {chat_id}")
-        
-        # 保存用户消息
-        logger.info(f"开始保存用户消息到chat_id: {chat_id}")
+        timer = StageTimer("send_message")
+        # 未提供chat_id时预先生成，使智能体调用无需等待对话创建
+        chat_id = chat_request.chat_id or str(uuid.uuid4())
         user_message_timestamp = int(datetime.now().timestamp() * 1000)
-        user_message = await db_service.save_message(chat_id, 'user', chat_request.message, user_message_timestamp)
-        
-        if not user_message:
-            logger.error(f"保存用户消息失败，chat_id: {chat_id}")
-            return ChatResponse(success=False, message="消息保存失败")
-        
-        logger.info(f"成功保存用户消息，message_id: {user_message['id']}")
         
-        # 调用阿里云百炼智能体生成回复
-        ai_response = None
-        session_id = chat_id  # 使用chat_id作为session_id以保持上下文
-        
-        if agent_service:
-            logger.info("开始调用阿里云百炼智能体")
-            agent_result = await agent_service.call_agent(chat_request.message, session_id)
+        # 智能体调用（使用chat_id作为session_id以保持上下文）与对话检查、用户消息保存并发执行
+        agent_task = asyncio.ensure_future(timer.track("agent", generate_ai_response(
+            chat_request.message, chat_id, is_fresh_chat(chat_request), chat_request.user_id, user_message_timestamp
+        )))
+        try:
+            user_message, error = await persist_user_message(chat_request, chat_id, user_message_timestamp, timer)
+            if not user_message:
+                return ChatResponse(success=False, message=error)
             
-            if agent_result['success']:
-                ai_response = agent_result['response']
-                logger.info(f"智能体调用成功，生成回复长度: {len(ai_response)}")
-            else:
-                logger.warning(f"智能体调用失败: {agent_result.get('error', '未知错误')}")
-                # 使用备用回复
-                ai_response = agent_service.get_fallback_response(chat_request.message)
-                logger.info("使用备用回复方案")
-        else:
-            logger.warning("智能体服务未初始化，使用备用回复")
-            # 智能体服务未初始化，使用备用回复
-            ai_response = f"我已收到您的消息：'{chat_request.message}'。智能体服务暂时不可用，请稍后再试。"
-        
-        # 确保AI回复不为空
-        if not ai_response or not ai_response.strip():
-            logger.warning("AI回复为空，使用默认回复")
-            ai_response = f"我已收到您的消息：'{chat_request.message}'，正在处理中..."
+            logger.debug("成功保存用户消息，message_id: %s", user_message['id'])
+            ai_response = await run_until_disconnected(request, agent_task)
+        finally:
+            if not agent_task.done():
+                agent_task.cancel()
         
-        logger.info(f"最终AI回复: {ai_response[:100]}...")
+        logger.debug("最终AI回复: %.100s...", ai_response)
         
         # 保存AI回复
-        logger.info(f"开始保存AI回复到chat_id: {chat_id}")
+        logger.debug("开始保存AI回复到chat_id: %s", chat_id)
         ai_message_timestamp = int(datetime.now().timestamp() * 1000)
-        ai_message = await db_service.save_message(chat_id, 'assistant', ai_response, ai_message_timestamp)
+        ai_message = await timer.track(
+            "save_assistant", db_service.save_message(chat_id, 'assistant', ai_response, ai_message_timestamp)
+        )
+        timer.log(chat_id=chat_id)
         
         if not ai_message:
-            logger.error(f"保存AI回复失败，chat_id: {chat_id}")
+            logger.error("保存AI回复失败，chat_id: %s", chat_id)
             return ChatResponse(success=False, message="AI回复保存失败")
         
-        logger.info(f"成功保存AI回复，message_id: {ai_message['id']}")
-        
-        response_message = Message(
-            id=ai_message['id'],
-            role="assistant",
-            content=ai_response,
-            timestamp=ai_message_timestamp
-        )
-        
-        logger.info(f"消息发送成功，返回response，chat_id: {chat_id}")
+        logger.debug("成功保存AI回复，message_id: %s", ai_message['id'])
+        logger.debug("消息发送成功，返回response，chat_id: %s", chat_id)
         
-        # 手动构建响应，确保timestamp格式正确
+        # 直接构建与ChatResponse一致的响应，不再经过Message模型中转
         response_data = {
             "success": True,
             "response": {
-                "id": response_message.id,
-                "role": response_message.role,
-                "content": response_message.content,
-                "timestamp": response_message.timestamp
+                "id": ai_message['id'],
+                "role": "assistant",
+                "content": ai_response,
+                "timestamp": ai_message_timestamp
             },
             "message": "消息发送成功",
             "chat_id": chat_id
         }
         
-        return response_data
+        return fast_json(response_data)
+    except AgentOverloadedError as e:
+        logger.warning("智能体调用被拒绝: user_id=%s, reason=%s", chat_request.user_id, e.reason)
+        return overloaded_response(e)
+    except ClientDisconnectedError:
+        logger.warning("客户端已断开连接，取消智能体调用: chat_id=%s", chat_request.chat_id)
+        return ChatResponse(success=False, message="客户端已断开连接")
     except Exception as e:
-        logger.error(f"发送消息失败: {e}", exc_info=True)
+        logger.error("发送消息失败: %s", e, exc_info=True)
         return ChatResponse(success=False, message="消息发送失败，请稍后重试")
 
-@app.get("/api/chat/history/{chat_id}")
-async def get_chat_history(chat_id: str):
-    """获取聊天历史"""
+def format_sse(event: str, data: dict) -> str:
+    """格式化Server-Sent Events消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def stream_reply(chat_request: ChatRequest, chat_id: str, user_message: dict, fresh_chat: bool, encode=format_sse):
+    """
+    流式生成智能体回复事件（start、delta，最后是done或error），结束或被关闭时保存一次AI回复
+    
+    SSE接口与WebSocket通道共用，encode(event, data)决定每个事件的输出形式。
+    """
+    parts = []
+    partial = False
+    completed = False
     try:
-        messages = await db_service.get_chat_messages(chat_id)
-        
-        # 格式化消息数据
-        formatted_messages = []
-        for msg in messages:
-            formatted_messages.append({
-                "id": msg['id'],
-                "role": msg['role'],
-                "content": msg['content'],
-                "timestamp": msg['timestamp']
-            })
+        yield encode("start", {"chat_id": chat_id, "user_message_id": user_message['id']})
+        
+        cached_reply = agent_service.get_cached_reply(chat_request.message) if agent_service and fresh_chat else None
+        if cached_reply is not None:
+            logger.info("首条消息命中回复缓存，回复长度: %d", len(cached_reply))
+            parts.append(cached_reply)
+            yield encode("delta", {"content": cached_reply})
+        elif agent_service:
+            try:
+                context = await context_builder.build(chat_id, chat_request.message, user_message['timestamp'],
+                                                      fresh_chat, chat_request.user_id)
+                usage = None
+                async with agent_scheduler.slot(chat_request.user_id):
+                    async with aclosing(agent_service.stream_agent(
+                        chat_request.message, chat_id, messages=context['messages'] if context else None
+                    )) as chunks:
+                        async for chunk in chunks:
+                            usage = chunk['usage'] or usage
+                            if chunk['text']:
+                                parts.append(chunk['text'])
+                                yield encode("delta", {"content": chunk['text']})
+                # 流式响应的usage为累计值，以最后一个分块为准
+                context_builder.record_usage(context, usage)
+                if fresh_chat:
+                    agent_service.cache_reply(chat_request.message, "".join(parts))
+            except Exception as e:
+                # 已输出部分内容时保留部分回复，否则使用备用回复
+                logger.warning("流式调用智能体失败: %r, 已输出片段数: %s", e, len(parts))
+                if parts:
+                    partial = True
+                else:
+                    AGENT_FALLBACKS.inc("stream")
+                    fallback = agent_service.get_fallback_response(chat_request.message)
+                    parts.append(fallback)
+                    yield encode("delta", {"content": fallback})
+        else:
+            AGENT_FALLBACKS.inc("stream")
+            fallback = f"我已收到您的消息：'{chat_request.message}'。智能体服务暂时不可用，请稍后再试。"
+            parts.append(fallback)
+            yield encode("delta", {"content": fallback})
+        
+        completed = True
+    finally:
+        ai_response = "".join(parts)
+        if not completed:
+            logger.warning("客户端在流式回复完成前断开连接: chat_id=%s, 已生成长度: %s",
+                           chat_id, len(ai_response))
+            partial = True
+        
+        # 流结束时只保存一次AI回复；客户端断开时也要保存已生成的部分内容
+        ai_message = None
+        ai_message_timestamp = int(datetime.now().timestamp() * 1000)
+        if ai_response.strip():
+            with anyio.CancelScope(shield=True):
+                ai_message = await db_service.save_message(chat_id, 'assistant', ai_response, ai_message_timestamp)
+    
+    if not ai_message:
+        yield encode("error", {"chat_id": chat_id, "message": "AI回复保存失败"})
+        return
+    
+    yield encode("done", {
+        "chat_id": chat_id,
+        "partial": partial,
+        "response": {
+            "id": ai_message['id'],
+            "role": "assistant",
+            "content": ai_response,
+            "timestamp": ai_message_timestamp
+        }
+    })
+
+@app.post("/api/chat/stream")
+async def stream_message(chat_request: ChatRequest):
+    """发送聊天消息，并以SSE流式返回智能体回复"""
+    try:
+        logger.info("收到流式消息请求: chat_id=%s", chat_request.chat_id)
+        
+        if not chat_request.message.strip():
+            return ChatResponse(success=False, message="消息内容不能为空")
+        
+        agent_scheduler.admit(chat_request.user_id)
+        chat_id = chat_request.chat_id or str(uuid.uuid4())
+        fresh_chat = is_fresh_chat(chat_request)
+        user_message_timestamp = int(datetime.now().timestamp() * 1000)
+        user_message, error = await persist_user_message(chat_request, chat_id, user_message_timestamp)
+        if not user_message:
+            return ChatResponse(success=False, message=error)
+    except AgentOverloadedError as e:
+        logger.warning("智能体调用被拒绝: user_id=%s, reason=%s", chat_request.user_id, e.reason)
+        return overloaded_response(e)
+    except Exception as e:
+        logger.error("流式发送消息失败: %s", e, exc_info=True)
+        return ChatResponse(success=False, message="消息发送失败，请稍后重试")
+    
+    return StreamingResponse(
+        stream_reply(chat_request, chat_id, user_message, fresh_chat),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def relay_chat_reply(user_id: str, client_id: Optional[str], chat_request: ChatRequest):
+    """
+    处理WebSocket通道发送的消息：保存用户消息后流式生成回复，事件发布给用户的所有连接
+    
+    回复在后台生成，连接断开不会中断生成，重连后可按seq续传。
+    """
+    chat_id = chat_request.chat_id or str(uuid.uuid4())
+    ref = {"client_id": client_id, "chat_id": chat_id}
+    channel = chat_hub.channels.get(user_id)
+    try:
+        fresh_chat = is_fresh_chat(chat_request)
+        timestamp = int(datetime.now().timestamp() * 1000)
+        user_message, error = await persist_user_message(chat_request, chat_id, timestamp)
+        if not user_message:
+            chat_hub.publish(user_id, "reply.error", {**ref, "message": error})
+            return
+        chat_hub.publish(user_id, "message.ack", {**ref, "message": {
+            "id": user_message['id'], "role": "user", "content": chat_request.message, "timestamp": timestamp
+        }})
+        
+        events = stream_reply(chat_request, chat_id, user_message, fresh_chat, encode=lambda event, data: (event, data))
+        async with aclosing(events):
+            async for event, data in events:
+                if event != "start":
+                    chat_hub.publish(user_id, f"reply.{event}", {**ref, **data})
+    except Exception as e:
+        logger.error("WebSocket消息处理失败: %s", e, exc_info=True)
+        chat_hub.publish(user_id, "reply.error", {**ref, "message": "消息发送失败，请稍后重试"})
+    finally:
+        if channel:
+            channel.pending_sends -= 1
+
+@app.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket, user_id: str, epoch: Optional[str] = None, last_seq: Optional[int] = None):
+    """
+    聊天WebSocket通道：每个用户一个连接，承载所有对话的发送、流式回复、标题和对话列表变更
+    
+    客户端消息：
+        {"type": "send", "client_id": "前端生成的ID", "message": "...", "chat_id": "可选，不传时创建新对话"}
+        {"type": "ping"} / {"type": "pong"}
+    服务端事件（带seq，断线后用 ?epoch=&last_seq= 重连续传）：
+        message.ack、reply.delta、reply.done、reply.error、chat.created、chat.updated、chat.deleted
+    控制消息（不带seq）：hello（resync为true时需重新拉取数据；partial为true时事件只来自本进程，
+    其他进程上的发送和变更不会推送，客户端需继续轮询对话列表和历史）、ping、pong、error
+    """
+    await websocket.accept()
+    connection = ChatConnection(websocket)
+    channel, replay = chat_hub.attach(user_id, connection, epoch, last_seq)
+    if replay is not None and len(replay) >= WS_SEND_QUEUE_SIZE:
+        replay = None
+    
+    # attach与hello、重放之间没有await，重放事件不会与新事件乱序
+    connection.offer(json.dumps({
+        "type": "hello",
+        "epoch": channel.epoch,
+        "seq": channel.seq,
+        "resync": replay is None,
+        "partial": SERVER_WORKERS > 1,
+        "heartbeat_interval": WS_HEARTBEAT_INTERVAL
+    }))
+    for text in replay or []:
+        connection.offer(text)
+    connection.start()
+    logger.info("WebSocket已连接: user_id=%s, last_seq=%s, 重放事件数: %s", user_id, last_seq, len(replay or []))
+    
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_INTERVAL)
+            connection.offer(json.dumps({"type": "ping", "ts": int(time.time() * 1000)}))
+    
+    heartbeat_task = asyncio.ensure_future(heartbeat())
+    reason = "client"
+    try:
+        while not connection.overflowed:
+            text = await asyncio.wait_for(websocket.receive_text(), WS_IDLE_TIMEOUT)
+            try:
+                payload = json.loads(text)
+                kind = payload.get("type")
+            except (ValueError, AttributeError):
+                connection.offer(json.dumps({"type": "error", "message": "消息格式错误"}, ensure_ascii=False))
+                continue
+            
+            if kind == "ping":
+                connection.offer(json.dumps({"type": "pong", "ts": int(time.time() * 1000)}))
+            elif kind == "pong":
+                continue
+            elif kind == "send":
+                client_id = payload.get("client_id")
+                message = payload.get("message")
+                chat_id = payload.get("chat_id") or None
+                if not isinstance(message, str) or not message.strip():
+                    connection.offer(json.dumps({"type": "error", "client_id": client_id, "message": "消息内容不能为空"}, ensure_ascii=False))
+                    continue
+                if chat_id is not None and not isinstance(chat_id, str):
+                    connection.offer(json.dumps({"type": "error", "client_id": client_id, "message": "消息格式错误"}, ensure_ascii=False))
+                    continue
+                if channel.pending_sends >= WS_MAX_CONCURRENT_SENDS:
+                    connection.offer(json.dumps({"type": "error", "client_id": client_id, "message": "回复生成中，请稍后再发送"}, ensure_ascii=False))
+                    continue
+                try:
+                    agent_scheduler.admit(user_id)
+                except AgentOverloadedError as e:
+                    connection.offer(json.dumps({
+                        "type": "error", "client_id": client_id, "message": str(e), "retry_after": e.retry_after
+                    }, ensure_ascii=False))
+                    continue
+                channel.pending_sends += 1
+                chat_request = ChatRequest(message=message, chat_id=chat_id, user_id=user_id)
+                chat_hub.spawn(relay_chat_reply(user_id, client_id, chat_request))
+            else:
+                connection.offer(json.dumps({"type": "error", "message": f"未知的消息类型: {kind}"}, ensure_ascii=False))
+    except asyncio.TimeoutError:
+        reason = "idle"
+        logger.info("WebSocket空闲超时，断开连接: user_id=%s", user_id)
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        reason = "error"
+        logger.warning("WebSocket连接异常: user_id=%s, %r", user_id, e)
+    finally:
+        heartbeat_task.cancel()
+        chat_hub.detach(user_id, connection)
+        if not connection.overflowed:
+            WS_DISCONNECTS.inc(reason)
+            await connection.close(1000 if reason != "error" else 1011)
+        logger.info("WebSocket已断开: user_id=%s", user_id)
+
+@app.get("/api/chat/history/{chat_id}")
+async def get_chat_history(
+    chat_id: str,
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    before_timestamp: Optional[int] = None,
+    since_timestamp: Optional[int] = None
+):
+    """
+    获取聊天历史
+    
+    不带参数时返回全部消息；limit返回最新N条，before_timestamp向前翻页，since_timestamp增量拉取新消息。
+    支持If-None-Match条件请求，消息未变化时返回304。
+    """
+    async def build_body():
+        if FAST_JSON and limit is None:
+            # 不分页时顺序与字段都与响应一致，直接透传PostgREST响应体
+            messages = await db_service.get_chat_messages(
+                chat_id, before_timestamp=before_timestamp, since_timestamp=since_timestamp, raw=True
+            )
+            return {"success": True, "messages": messages, "has_more": False}
+        
+        # 多取一条用于判断是否还有更多消息
+        fetch_limit = limit + 1 if limit is not None else None
+        messages = await db_service.get_chat_messages(
+            chat_id, fetch_limit, before_timestamp=before_timestamp, since_timestamp=since_timestamp
+        )
+        
+        has_more = fetch_limit is not None and len(messages) > limit
+        if has_more:
+            # 增量拉取时多出的是最新一条，向前翻页时多出的是最早一条
+            messages = messages[:limit] if since_timestamp is not None else messages[1:]
         
-        return {"success": True, "messages": formatted_messages}
+        return {"success": True, "messages": messages, "has_more": has_more}
+    
+    try:
+        return await respond_with_etag(
+            request, response, build_body, "history", chat_id, limit, before_timestamp, since_timestamp
+        )
     except Exception as e:
-        logger.error(f"获取聊天历史失败: {e}")
+        logger.error("获取聊天历史失败: %s", e)
         return {"success": False, "message": "获取聊天历史失败", "messages": []}
 
 @app.delete("/api/chat/{chat_id}")
 async def delete_chat(chat_id: str):
     """删除对话及其所有消息"""
     try:
-        logger.info(f"收到删除对话请求: {chat_id}")
-        
-        # 检查对话是否存在
-        chat_exists = await db_service.check_chat_exists(chat_id)
-        if not chat_exists:
-            logger.warning(f"要删除的对话不存在: {chat_id}")
-            return {"success": False, "message": "对话不存在"}
+        logger.info("收到删除对话请求: %s", chat_id)
         
-        # 删除对话
-        success = await db_service.delete_chat(chat_id)
+        # 一次请求完成删除，由返回的行判断对话是否存在
+        deleted = await db_service.delete_chat(chat_id)
         
-        if success:
-            logger.info(f"成功删除对话: {chat_id}")
+        if deleted:
+            logger.info("成功删除对话: %s", chat_id)
+            chat_hub.publish(deleted['user_id'], "chat.deleted", {"chat_id": chat_id})
             return {"success": True, "message": "对话删除成功"}
         else:
-            logger.error(f"删除对话失败: {chat_id}")
+            logger.warning("删除对话失败或对话不存在: %s", chat_id)
+            return {"success": False, "message": "对话不存在或删除失败"}
+    except Exception as e:
+        logger.error("删除对话失败: %s", e, exc_info=True)
+        return {"success": False, "message": "删除对话失败，请稍后重试"}
+
+class BulkChatRequest(BaseModel):
+    user_id: str
+    chat_ids: List[str]
+
+def validate_bulk_request(request_data: BulkChatRequest) -> Tuple[List[str], Optional[str]]:
+    """去重并检查批量大小，返回 (对话ID列表, 错误信息)"""
+    chat_ids = list(dict.fromkeys(request_data.chat_ids))
+    if len(chat_ids) > CHAT_BULK_MAX_SIZE:
+        return chat_ids, f"单次最多操作{CHAT_BULK_MAX_SIZE}个对话"
+    return chat_ids, None
+
+@app.post("/api/chat/bulk-delete")
+async def delete_chats(request_data: BulkChatRequest):
+    """批量删除用户的对话，一次数据库请求完成；返回每个对话ID的结果（deleted/not_found）"""
+    try:
+        chat_ids, error = validate_bulk_request(request_data)
+        if error:
+            return {"success": False, "message": error}
+        if not chat_ids:
+            return {"success": True, "results": [], "deleted": 0}
+        
+        deleted = await db_service.delete_chats(request_data.user_id, chat_ids)
+        if deleted is None:
             return {"success": False, "message": "删除对话失败"}
+        
+        deleted = set(deleted)
+        for chat_id in chat_ids:
+            if chat_id in deleted:
+                chat_hub.publish(request_data.user_id, "chat.deleted", {"chat_id": chat_id})
+        return {
+            "success": True,
+            # 不存在与不属于该用户的对话都返回not_found
+            "results": [{"chat_id": chat_id, "status": "deleted" if chat_id in deleted else "not_found"}
+                        for chat_id in chat_ids],
+            "deleted": len(deleted)
+        }
     except Exception as e:
-        logger.error(f"删除对话失败: {e}", exc_info=True)
+        logger.error("批量删除对话失败: %s", e, exc_info=True)
         return {"success": False, "message": "删除对话失败，请稍后重试"}
 
+@app.post("/api/chat/bulk-get")
+async def get_chats(request_data: BulkChatRequest):
+    """批量获取用户的对话，一次数据库请求完成；按请求顺序返回每个对话ID的结果（found/not_found）"""
+    try:
+        chat_ids, error = validate_bulk_request(request_data)
+        if error:
+            return {"success": False, "message": error}
+        if not chat_ids:
+            return {"success": True, "results": []}
+        
+        chats = await db_service.get_chats_by_ids(request_data.user_id, chat_ids)
+        if chats is None:
+            return {"success": False, "message": "获取对话失败"}
+        
+        found = {chat['id']: chat for chat in chats}
+        return {
+            "success": True,
+            "results": [
+                {"chat_id": chat_id, "status": "found", "chat": chat_summary(found[chat_id])}
+                if chat_id in found else {"chat_id": chat_id, "status": "not_found"}
+                for chat_id in chat_ids
+            ]
+        }
+    except Exception as e:
+        logger.error("批量获取对话失败: %s", e, exc_info=True)
+        return {"success": False, "message": "获取对话失败，请稍后重试"}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
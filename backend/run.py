@@ -1,20 +1,119 @@
 #!/usr/bin/env python3
 """
 DeepSeek Chat API 启动脚本
+
+开发模式（默认）: 单进程 + 自动重载
+生产模式（--mode prod 或 ENVIRONMENT=production）: 多进程 + uvloop/httptools + 优雅停机
 """
 
+import argparse
+import importlib.util
+import os
+
 import uvicorn
 
-if __name__ == "__main__":
+
+def module_available(name: str) -> bool:
+    """检查可选依赖是否已安装"""
+    return importlib.util.find_spec(name) is not None
+
+
+def available_cpus() -> int:
+    """当前进程可用的CPU核数（考虑CPU亲和性限制）"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def worker_count(value: str) -> int:
+    """解析工作进程数：正整数，或auto表示按可用CPU核数"""
+    if value.strip().lower() == "auto":
+        return available_cpus()
+    try:
+        workers = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"工作进程数应为正整数或auto: {value}")
+    if workers < 1:
+        raise argparse.ArgumentTypeError(f"工作进程数应为正整数或auto: {value}")
+    return workers
+
+
+def parse_args() -> argparse.Namespace:
+    default_mode = "prod" if os.getenv("ENVIRONMENT") == "production" else "dev"
+    parser = argparse.ArgumentParser(description="DeepSeek Chat API 启动脚本")
+    parser.add_argument("--mode", choices=["dev", "prod"], default=os.getenv("SERVER_MODE", default_mode),
+                        help="运行模式，默认根据ENVIRONMENT环境变量判断")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=worker_count, default=os.getenv("WEB_CONCURRENCY", "1"), metavar="N|auto",
+                        help="工作进程数（仅生产模式），正整数或auto（按可用CPU核数），默认1。"
+                             "注意：对话缓存、读取合并、智能体并发上限与令牌桶、熔断器、消息写入队列和WebSocket事件分发"
+                             "都是进程内状态，多进程时各进程互不共享：并发上限按进程计（总量随进程数增加），"
+                             "对话缓存TTL自动缩短，WebSocket只能推送本进程内产生的事件")
+    parser.add_argument("--loop", choices=["auto", "asyncio", "uvloop"], default=os.getenv("UVICORN_LOOP", "auto"))
+    parser.add_argument("--http", choices=["auto", "h11", "httptools"], default=os.getenv("UVICORN_HTTP", "auto"))
+    parser.add_argument("--keep-alive", type=int, default=int(os.getenv("KEEP_ALIVE_TIMEOUT", "75")),
+                        help="HTTP keep-alive超时（秒），应大于nginx的keepalive_timeout")
+    parser.add_argument("--backlog", type=int, default=int(os.getenv("BACKLOG", "2048")))
+    parser.add_argument("--limit-concurrency", type=int, default=int(os.getenv("LIMIT_CONCURRENCY", "0")),
+                        help="单进程最大并发连接数，超出时返回503，0表示不限制")
+    parser.add_argument("--graceful-timeout", type=int, default=int(os.getenv("GRACEFUL_TIMEOUT", "30")),
+                        help="收到SIGTERM后等待进行中请求（含智能体调用）完成的最长时间（秒），"
+                             "之后还有AGENT_DRAIN_TIMEOUT和MESSAGE_DRAIN_TIMEOUT的排空时间")
+    parser.add_argument("--log-level", default=os.getenv("UVICORN_LOG_LEVEL", "info"))
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
     print("🚀 启动 DeepSeek Chat API 服务...")
-    print("📡 服务地址: http://localhost:8000")
-    print("📚 API文档: http://localhost:8000/docs")
+    print(f"📡 服务地址: http://localhost:{args.port}")
+    print(f"📚 API文档: http://localhost:{args.port}/docs")
     print("⏹️  按 Ctrl+C 停止服务\n")
-    
+
+    if args.mode == "dev":
+        uvicorn.run(
+            "main:app",
+            host=args.host,
+            port=args.port,
+            reload=True,  # 开发模式下自动重载
+            log_level=args.log_level
+        )
+        return
+
+    # 生产模式：优先使用uvloop和httptools
+    loop = args.loop
+    if loop == "auto":
+        loop = "uvloop" if module_available("uvloop") else "asyncio"
+    http = args.http
+    if http == "auto":
+        http = "httptools" if module_available("httptools") else "h11"
+    workers = args.workers
+    # 工作进程通过环境变量得知进程数，据此调整进程内状态的行为
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+
+    print(f"⚙️  生产模式: workers={workers}, loop={loop}, http={http}, keep-alive={args.keep_alive}s, "
+          f"backlog={args.backlog}, graceful-timeout={args.graceful_timeout}s")
+
     uvicorn.run(
         "main:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,  # 开发模式下自动重载
-        log_level="info"
-    )
\ No newline at end of file
+        host=args.host,
+        port=args.port,
+        workers=workers,
+        loop=loop,
+        http=http,
+        timeout_keep_alive=args.keep_alive,
+        backlog=args.backlog,
+        limit_concurrency=args.limit_concurrency or None,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        # 部署在nginx之后，信任本机转发的客户端地址
+        proxy_headers=True,
+        forwarded_allow_ips=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+        access_log=os.getenv("ACCESS_LOG", "false").lower() == "true",
+        log_level=args.log_level
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+测试公共配置
+
+导入main之前设置必需的环境变量（不会连接真实的Supabase和百炼），
+上游统一使用benchmark中的进程内替身；用例内用asyncio.run运行异步场景。
+"""
+
+import os
+import random
+import sys
+from collections import Counter
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ["STORAGE_BACKEND"] = "supabase"
+os.environ["SUPABASE_URL"] = "http://supabase.test"
+os.environ["SUPABASE_KEY"] = "test-key"
+os.environ["DASHSCOPE_API_KEY"] = "test-key"
+os.environ["DASHSCOPE_APP_ID"] = "test-app"
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+import main  # noqa: E402
+from benchmark.fakes import FakePostgREST, Latency, UpstreamTransport  # noqa: E402
+
+
+class FakeClock:
+    """可手动推进的time.monotonic替身（事件循环也使用time.monotonic，只用于同步用例）"""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    fake = FakeClock()
+    monkeypatch.setattr(main.time, "monotonic", fake)
+    return fake
+
+
+@pytest.fixture
+def postgrest() -> FakePostgREST:
+    return FakePostgREST(Latency(), random.Random(0))
+
+
+@pytest.fixture
+def upstream_calls() -> Counter:
+    """按替身标签统计的上游请求数，如 "supabase GET messages" """
+    return Counter()
+
+
+@pytest.fixture
+def supabase(postgrest, upstream_calls) -> "main.DatabaseService":
+    """挂上PostgREST替身的Supabase存储，需在用例的事件循环中start/close"""
+    db = main.DatabaseService()
+    db.http_transport = UpstreamTransport(postgrest.handle, postgrest.label, 10,
+                                          lambda label, elapsed_ms: upstream_calls.update([label]))
+    return db
@@ -0,0 +1,154 @@
+"""智能体准入控制：用户令牌桶限流、全局名额满时按套餐加权轮转排队"""
+
+import asyncio
+
+import pytest
+
+from main import AgentOverloadedError, AgentScheduler, TokenBucket
+
+
+def make_scheduler(**overrides) -> AgentScheduler:
+    options = dict(enabled=True, max_active=1, queue_size=100, user_queue_size=10,
+                   rate=0.0, burst=1.0, queue_timeout=5.0, plan_weights="专业版:2")
+    options.update(overrides)
+    return AgentScheduler(**options)
+
+
+def test_token_bucket_refills_at_rate(clock):
+    bucket = TokenBucket(rate=2.0, capacity=2.0)
+    assert bucket.take() == 0.0
+    assert bucket.take() == 0.0
+    assert bucket.take() == pytest.approx(0.5)
+
+    clock.advance(0.25)
+    assert bucket.take() == pytest.approx(0.25)
+    clock.advance(0.25)
+    assert bucket.take() == 0.0
+
+    # 闲置再久也最多积累capacity个
+    clock.advance(60)
+    assert bucket.take() == 0.0
+    assert bucket.take() == 0.0
+    assert bucket.take() > 0
+
+
+def test_admit_rate_limits_per_user(clock):
+    scheduler = make_scheduler(rate=1.0, burst=2.0)
+    scheduler.admit("alice")
+    scheduler.admit("alice")
+    with pytest.raises(AgentOverloadedError) as excinfo:
+        scheduler.admit("alice")
+    assert excinfo.value.reason == "rate_limited"
+    assert excinfo.value.retry_after >= 1
+
+    # 其他用户有自己的令牌桶
+    scheduler.admit("bob")
+    clock.advance(1)
+    scheduler.admit("alice")
+
+
+def test_plan_weight_scales_bucket(clock):
+    scheduler = make_scheduler(rate=1.0, burst=1.0)
+    scheduler.set_plan("pro", "专业版")
+    scheduler.admit("pro")
+    scheduler.admit("pro")
+    with pytest.raises(AgentOverloadedError):
+        scheduler.admit("pro")
+
+
+def test_weighted_round_robin_between_queued_users():
+    """名额满时，队首用户按权重连续获得名额后移到队尾"""
+    async def scenario():
+        scheduler = make_scheduler()
+        scheduler.set_plan("pro", "专业版")
+        order = []
+        release_holder = asyncio.Event()
+
+        async def holder():
+            async with scheduler.slot("holder"):
+                await release_holder.wait()
+
+        async def call(user_id: str):
+            async with scheduler.slot(user_id):
+                order.append(user_id)
+                await asyncio.sleep(0)
+
+        holding = asyncio.ensure_future(holder())
+        await asyncio.sleep(0)
+        calls = []
+        for user_id in ["pro"] * 3 + ["free"] * 3:
+            calls.append(asyncio.ensure_future(call(user_id)))
+            await asyncio.sleep(0)
+        assert scheduler.get_stats()["waiting"] == 6
+
+        release_holder.set()
+        await asyncio.gather(holding, *calls)
+        return scheduler, order
+
+    scheduler, order = asyncio.run(scenario())
+    assert order == ["pro", "pro", "free", "pro", "free", "free"]
+    stats = scheduler.get_stats()
+    assert (stats["active"], stats["waiting"], stats["granted"]) == (0, 0, 7)
+
+
+def test_queue_full_and_queue_timeout_are_rejected():
+    async def scenario():
+        scheduler = make_scheduler(user_queue_size=1, queue_timeout=0.05)
+        release_holder = asyncio.Event()
+
+        async def holder():
+            async with scheduler.slot("holder"):
+                await release_holder.wait()
+
+        holding = asyncio.ensure_future(holder())
+        await asyncio.sleep(0)
+
+        async def call():
+            async with scheduler.slot("alice"):
+                pass
+
+        waiting = asyncio.ensure_future(call())
+        await asyncio.sleep(0)
+        # alice已有一个排队请求
+        with pytest.raises(AgentOverloadedError) as full:
+            scheduler.admit("alice")
+        with pytest.raises(AgentOverloadedError) as timeout:
+            await waiting
+        release_holder.set()
+        await holding
+        return scheduler, full.value, timeout.value
+
+    scheduler, full, timeout = asyncio.run(scenario())
+    assert full.reason == "queue_full"
+    assert timeout.reason == "queue_timeout"
+    stats = scheduler.get_stats()
+    assert (stats["active"], stats["waiting"], stats["queued_users"]) == (0, 0, 0)
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    async def scenario():
+        scheduler = make_scheduler()
+        release_holder = asyncio.Event()
+
+        async def holder():
+            async with scheduler.slot("holder"):
+                await release_holder.wait()
+
+        async def call(user_id: str):
+            async with scheduler.slot(user_id):
+                pass
+
+        holding = asyncio.ensure_future(holder())
+        await asyncio.sleep(0)
+        cancelled = asyncio.ensure_future(call("alice"))
+        served = asyncio.ensure_future(call("bob"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        release_holder.set()
+        await asyncio.gather(holding, served)
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    stats = scheduler.get_stats()
+    assert (stats["active"], stats["waiting"], stats["queued_users"]) == (0, 0, 0)
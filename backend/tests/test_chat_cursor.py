@@ -0,0 +1,87 @@
+"""对话列表游标分页：游标编解码，以及created_at相同的对话跨页时不重复、不遗漏"""
+
+import asyncio
+
+import pytest
+
+import main
+from benchmark.fakes import load_sqlite
+
+USER_ID = "u1"
+CREATED_AT = "2024-01-01T00:00:00+00:00"
+
+
+def test_cursor_round_trip():
+    chat = {"id": "c-1", "created_at": CREATED_AT}
+    cursor = main.StorageBackend.encode_chat_cursor(chat)
+    assert "=" not in cursor
+    assert main.StorageBackend.decode_chat_cursor(cursor) == (CREATED_AT, "c-1")
+
+
+@pytest.mark.parametrize("cursor", ["not-base64!", "bm90IGpzb24", "WzFd"])
+def test_invalid_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        main.StorageBackend.decode_chat_cursor(cursor)
+
+
+@pytest.fixture(params=["supabase", "sqlite"])
+def storage(request, postgrest, supabase, tmp_path):
+    """同一组预置数据分别由Supabase替身和SQLite提供：7个对话中5个created_at相同"""
+    postgrest.tables["users"].append({"id": USER_ID, "username": "alice", "email": "alice@test",
+                                      "password_hash": "x"})
+    for index in range(7):
+        created_at = CREATED_AT if index < 5 else f"2024-01-0{index - 3}T00:00:00+00:00"
+        postgrest.tables["chats"].append({"id": f"c{index}", "user_id": USER_ID, "title": f"对话{index}",
+                                          "created_at": created_at, "updated_at": created_at})
+    if request.param == "supabase":
+        return supabase, None
+    return main.SQLiteStorage(str(tmp_path / "chats.db"), readers=1), postgrest.tables
+
+
+def walk_pages(storage, page_size: int):
+    async def scenario():
+        db, seed = storage
+        await db.start()
+        if seed is not None:
+            load_sqlite(db.path, seed)
+        try:
+            pages, cursor = [], None
+            while True:
+                page = await db.get_user_chats_page(USER_ID, page_size, cursor=cursor)
+                pages.append(page)
+                cursor = page["next_cursor"]
+                if not page["has_more"]:
+                    return pages
+        finally:
+            await db.close()
+
+    return asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 3])
+def test_cursor_pages_cover_equal_created_at(storage, page_size):
+    pages = walk_pages(storage, page_size)
+    ids = [chat["id"] for page in pages for chat in page["chats"]]
+    # created_at降序，相同时按id降序
+    assert ids == ["c6", "c5", "c4", "c3", "c2", "c1", "c0"]
+    assert all(len(page["chats"]) == page_size for page in pages[:-1])
+    assert pages[-1]["next_cursor"] is None
+
+
+def test_cursor_from_other_page_size_continues_after_chat(storage):
+    """游标只记录最后一个对话的位置，与页大小无关"""
+    cursor = main.StorageBackend.encode_chat_cursor({"id": "c3", "created_at": CREATED_AT})
+
+    async def scenario():
+        db, seed = storage
+        await db.start()
+        if seed is not None:
+            load_sqlite(db.path, seed)
+        try:
+            return await db.get_user_chats_page(USER_ID, 10, cursor=cursor)
+        finally:
+            await db.close()
+
+    page = asyncio.run(scenario())
+    assert [chat["id"] for chat in page["chats"]] == ["c2", "c1", "c0"]
+    assert page["has_more"] is False
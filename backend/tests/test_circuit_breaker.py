@@ -0,0 +1,117 @@
+"""熔断器状态机：closed -> open -> half_open -> closed，以及流式调用排队超时不计为上游故障"""
+
+import asyncio
+
+import pytest
+
+import main
+from main import CircuitBreaker
+
+
+def make_breaker(**overrides) -> CircuitBreaker:
+    options = dict(failure_rate=0.5, slow_call_seconds=10.0, slow_call_rate=1.0, min_calls=4,
+                   window_size=10, window_seconds=60.0, open_seconds=30.0, half_open_calls=2)
+    options.update(overrides)
+    return CircuitBreaker("test", **options)
+
+
+def test_opens_on_failure_rate(clock):
+    breaker = make_breaker()
+    for success in (True, False, True):
+        assert breaker.allow()
+        breaker.record(success, 0.1)
+    assert breaker.state == "closed"
+
+    assert breaker.allow()
+    breaker.record(False, 0.1)
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.rejected == 1
+
+
+def test_opens_on_slow_call_rate(clock):
+    breaker = make_breaker(slow_call_seconds=1.0, slow_call_rate=0.5)
+    for elapsed in (0.1, 2.0, 0.1, 2.0):
+        breaker.allow()
+        breaker.record(True, elapsed)
+    assert breaker.state == "open"
+
+
+def test_half_open_probes_close_the_breaker(clock):
+    breaker = make_breaker()
+    breaker._transition("open", "test")
+
+    clock.advance(29)
+    assert not breaker.allow()
+    clock.advance(1)
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    # 探测名额用完
+    assert not breaker.allow()
+
+    breaker.record(True, 0.1)
+    assert breaker.state == "half_open"
+    breaker.record(True, 0.1)
+    assert breaker.state == "closed"
+    assert breaker.get_stats()["window_calls"] == 0
+
+
+def test_failed_probe_reopens(clock):
+    breaker = make_breaker()
+    breaker._transition("open", "test")
+    clock.advance(30)
+    assert breaker.allow()
+    breaker.record(False, 0.1)
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_release_returns_probe_slot(clock):
+    breaker = make_breaker(half_open_calls=1)
+    breaker._transition("open", "test")
+    clock.advance(30)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.release()
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+
+
+def test_failures_outside_window_are_forgotten(clock):
+    breaker = make_breaker(window_seconds=10.0)
+    for _ in range(3):
+        breaker.allow()
+        breaker.record(False, 0.1)
+    clock.advance(11)
+    for _ in range(3):
+        breaker.allow()
+        breaker.record(True, 0.1)
+    breaker.allow()
+    breaker.record(False, 0.1)
+    assert breaker.state == "closed"
+
+
+@pytest.mark.parametrize("state", ["closed", "half_open"])
+def test_stream_queue_timeout_is_not_an_upstream_failure(state):
+    """本地并发槽排队超时只归还探测名额，不记录失败"""
+    async def scenario():
+        service = main.DashScopeService()
+        service.transport = "http"
+        service.breaker = make_breaker(min_calls=1, half_open_calls=1, open_seconds=0.0)
+        if state == "half_open":
+            service.breaker._transition("open", "test")
+        service._semaphore = asyncio.Semaphore(0)
+
+        with pytest.raises(asyncio.TimeoutError):
+            async for _ in service.stream_agent("hello", timeout=0.05):
+                pass
+        await service.close()
+        return service
+
+    service = asyncio.run(scenario())
+    assert service.breaker.state == state
+    assert service.breaker.get_stats()["window_calls"] == 0
+    # 探测名额已归还，下一次调用仍可放行
+    assert service.breaker.allow()
+    assert service.in_flight == 0
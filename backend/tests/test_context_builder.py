@@ -0,0 +1,87 @@
+"""上下文组装：token估算、按预算从新到旧保留连续的最近消息"""
+
+import asyncio
+
+import pytest
+
+import main
+from main import ContextBuilder
+
+
+def message(content: str, role: str = "user", timestamp: int = 0) -> dict:
+    return {"role": role, "content": content, "timestamp": timestamp}
+
+
+@pytest.mark.parametrize("text, tokens", [
+    ("", 0),
+    ("abcd", 1),
+    ("abcdefgh", 2),
+    ("abcde", 2),
+    ("你好世界", 4),
+    ("你好ab", 3),
+])
+def test_estimate_tokens(text, tokens):
+    assert ContextBuilder.estimate_tokens(text) == tokens
+
+
+def test_fit_keeps_newest_messages_within_budget():
+    builder = ContextBuilder(mode="history")
+    # 每条 1 + MESSAGE_OVERHEAD 个token
+    history = [message("abcd") for _ in range(4)]
+    cost = 1 + ContextBuilder.MESSAGE_OVERHEAD
+
+    assert builder.fit(history, cost * 4) == 0
+    assert builder.fit(history, cost * 2) == 2
+    assert builder.fit(history, cost * 2 - 1) == 3
+    assert builder.fit(history, 0) == 4
+    assert builder.fit([], 100) == 0
+
+
+def test_fit_stops_at_first_message_over_budget():
+    """保留的是连续的最近消息，不会越过超出预算的长消息去装入更早的短消息"""
+    builder = ContextBuilder(mode="history")
+    history = [message("a"), message("x" * 400), message("b")]
+    assert builder.fit(history, 20) == 2
+
+
+class HistoryStorage:
+    """只实现get_chat_messages的存储替身"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = []
+
+    async def get_chat_messages(self, chat_id, limit=None, before_timestamp=None, since_timestamp=None,
+                                columns=main.MESSAGE_COLUMNS, raw=False, strict=False):
+        self.calls.append({"chat_id": chat_id, "limit": limit, "before_timestamp": before_timestamp})
+        return self.rows
+
+
+def test_build_drops_oldest_messages_over_budget(monkeypatch):
+    rows = [message("x" * 40, "user" if index % 2 == 0 else "assistant", index) for index in range(6)]
+    storage = HistoryStorage(rows)
+    monkeypatch.setattr(main, "db_service", storage)
+    # 每条历史消息 10 + 4 个token，当前消息 1 + 4 个
+    builder = ContextBuilder(mode="history", max_tokens=5 + 14 * 2, max_messages=20, summary=False)
+
+    context = asyncio.run(builder.build("c1", "next", before_timestamp=100))
+
+    assert storage.calls == [{"chat_id": "c1", "limit": 20, "before_timestamp": 100}]
+    assert context["messages"][-1] == {"role": "user", "content": "next"}
+    assert [m["role"] for m in context["messages"][:-1]] == ["user", "assistant"]
+    assert (context["history"], context["dropped"]) == (2, 4)
+    assert context["estimated_tokens"] == builder.max_tokens
+    assert builder.get_stats()["dropped_messages"] == 4
+
+
+def test_build_returns_none_in_session_mode_or_on_history_failure(monkeypatch):
+    monkeypatch.setattr(main, "db_service", HistoryStorage(None))
+    assert asyncio.run(ContextBuilder(mode="session").build("c1", "hi")) is None
+
+    builder = ContextBuilder(mode="history", summary=False)
+    assert asyncio.run(builder.build("c1", "hi")) is None
+    assert builder.get_stats()["history_failures"] == 1
+
+    # 新会话的第一条消息不读取历史
+    context = asyncio.run(builder.build("c1", "hi", fresh_chat=True))
+    assert context["messages"] == [{"role": "user", "content": "hi"}]
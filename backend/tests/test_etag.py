@@ -0,0 +1,129 @@
+"""条件请求：对话列表和聊天历史的ETag在数据不变时返回304，写入后返回200和新的ETag"""
+
+import asyncio
+import random
+import uuid
+from contextlib import asynccontextmanager
+
+import httpx
+import pytest
+
+import main
+from benchmark.fakes import FakeDashScope, Latency, UpstreamTransport
+
+
+@pytest.fixture
+def app_client(monkeypatch, postgrest, upstream_calls):
+    """在应用生命周期内返回ASGI客户端，Supabase与百炼都使用进程内替身"""
+    record = lambda label, elapsed_ms: upstream_calls.update([label])  # noqa: E731
+    dashscope = FakeDashScope(Latency(), Latency(), 1, random.Random(0))
+    monkeypatch.setattr(main.db_service, "http_transport",
+                        UpstreamTransport(postgrest.handle, postgrest.label, 10, record))
+    monkeypatch.setattr(main.agent_service, "http_transport",
+                        UpstreamTransport(dashscope.handle, dashscope.label, 10, record))
+
+    @asynccontextmanager
+    async def client():
+        async with main.lifespan(main.app):
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://app.test") as http:
+                yield http
+
+    return client
+
+
+@pytest.fixture
+def chat(postgrest):
+    """预置一个用户、一个对话和两条消息，ID每个用例不同（进程内缓存不跨用例复用）"""
+    user_id, chat_id = str(uuid.uuid4()), str(uuid.uuid4())
+    postgrest.tables["users"].append({"id": user_id, "username": user_id, "email": f"{user_id}@test",
+                                      "password_hash": "x"})
+    postgrest.tables["chats"].append({"id": chat_id, "user_id": user_id, "title": "对话",
+                                      "created_at": "2024-01-01T00:00:00+00:00",
+                                      "updated_at": "2024-01-01T00:00:00+00:00"})
+    postgrest.tables["messages"].extend(
+        {"id": str(uuid.uuid4()), "chat_id": chat_id, "role": role, "content": role, "timestamp": timestamp}
+        for role, timestamp in (("user", 1), ("assistant", 2))
+    )
+    return user_id, chat_id
+
+
+def test_chat_list_not_modified_until_write(app_client, chat):
+    user_id, _ = chat
+
+    async def scenario():
+        async with app_client() as client:
+            first = await client.get(f"/api/auth/chats/{user_id}")
+            etag = first.headers["etag"]
+            unchanged = await client.get(f"/api/auth/chats/{user_id}", headers={"If-None-Match": etag})
+            await client.post("/api/chat/new", json={"user_id": user_id})
+            changed = await client.get(f"/api/auth/chats/{user_id}", headers={"If-None-Match": etag})
+            return first, unchanged, changed
+
+    first, unchanged, changed = asyncio.run(scenario())
+    assert first.status_code == 200
+    assert first.headers["cache-control"] == main.ETAG_CACHE_CONTROL
+    assert len(first.json()["chats"]) == 1
+    assert unchanged.status_code == 304
+    assert unchanged.content == b""
+    assert unchanged.headers["etag"] == first.headers["etag"]
+    assert changed.status_code == 200
+    assert len(changed.json()["chats"]) == 2
+    assert changed.headers["etag"] != first.headers["etag"]
+
+
+def test_history_not_modified_costs_one_query(app_client, chat, upstream_calls):
+    _, chat_id = chat
+
+    async def scenario():
+        async with app_client() as client:
+            first = await client.get(f"/api/chat/history/{chat_id}")
+            etag = first.headers["etag"]
+            before = upstream_calls["supabase GET messages"]
+            unchanged = await client.get(f"/api/chat/history/{chat_id}", headers={"If-None-Match": etag})
+            queries = upstream_calls["supabase GET messages"] - before
+            await main.db_service.save_message(chat_id, "user", "again", 3)
+            changed = await client.get(f"/api/chat/history/{chat_id}", headers={"If-None-Match": etag})
+            return first, unchanged, queries, changed
+
+    first, unchanged, queries, changed = asyncio.run(scenario())
+    assert first.status_code == 200
+    assert unchanged.status_code == 304
+    assert queries == 1
+    assert changed.status_code == 200
+    assert [message["content"] for message in changed.json()["messages"]] == ["user", "assistant", "again"]
+
+
+def test_history_page_etag_covers_has_more(app_client, chat):
+    """页内消息不变但has_more变化（之后又有新消息）时不能返回304"""
+    _, chat_id = chat
+    url = f"/api/chat/history/{chat_id}?limit=1&since_timestamp=1"
+
+    async def scenario():
+        async with app_client() as client:
+            first = await client.get(url)
+            await main.db_service.save_message(chat_id, "user", "later", 3)
+            changed = await client.get(url, headers={"If-None-Match": first.headers["etag"]})
+            return first, changed
+
+    first, changed = asyncio.run(scenario())
+    assert first.json()["has_more"] is False
+    assert changed.status_code == 200
+    assert changed.json()["messages"] == first.json()["messages"]
+    assert changed.json()["has_more"] is True
+
+
+def test_etag_is_scoped_to_request_params(app_client, chat):
+    _, chat_id = chat
+
+    async def scenario():
+        async with app_client() as client:
+            full = await client.get(f"/api/chat/history/{chat_id}")
+            page = await client.get(f"/api/chat/history/{chat_id}?limit=2",
+                                    headers={"If-None-Match": full.headers["etag"]})
+            return full, page
+
+    full, page = asyncio.run(scenario())
+    assert page.status_code == 200
+    assert page.json()["messages"] == full.json()["messages"]
+    assert page.headers["etag"] != full.headers["etag"]
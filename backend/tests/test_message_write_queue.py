@@ -0,0 +1,134 @@
+"""消息写入队列：批量合并、关闭时排空、不可重试错误拆分为单条写入"""
+
+import asyncio
+from typing import List
+
+import main
+from main import InsertResult, MessageWriteQueue
+
+
+class RecordingStorage:
+    """只实现insert_messages的存储替身，记录每次写入的批次"""
+
+    def __init__(self, rejected=(), transient_failures: int = 0):
+        self.batches: List[List[str]] = []
+        self.written: List[str] = []
+        self.rejected = set(rejected)
+        self.transient_failures = transient_failures
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def insert_messages(self, messages: List[dict]) -> InsertResult:
+        await self.gate.wait()
+        ids = [message['id'] for message in messages]
+        self.batches.append(ids)
+        if self.transient_failures:
+            self.transient_failures -= 1
+            return InsertResult(False, retryable=True, error="HTTP 503")
+        if self.rejected & set(ids):
+            return InsertResult(False, error="HTTP 409")
+        self.written.extend(ids)
+        return InsertResult(True)
+
+
+def message(index: int) -> dict:
+    return {"id": f"m{index}", "chat_id": "c1", "role": "user", "content": str(index), "timestamp": index}
+
+
+def test_batches_messages_and_drains_on_close():
+    async def scenario():
+        storage = RecordingStorage()
+        queue = MessageWriteQueue(storage, batch_size=3, flush_interval=0.01)
+        await queue.start()
+        for index in range(7):
+            assert await queue.enqueue(message(index))
+        await queue.close(timeout=5)
+        return storage, queue
+
+    storage, queue = asyncio.run(scenario())
+    assert storage.written == [f"m{index}" for index in range(7)]
+    assert all(len(batch) <= 3 for batch in storage.batches)
+    assert len(storage.batches) < 7
+    assert queue.get_stats()["flushed"] == 7
+
+
+def test_flushes_messages_blocked_on_full_queue_at_close():
+    """close时在put中等待的生产者（队列已满）入队成功的消息都要写入"""
+    async def scenario():
+        storage = RecordingStorage()
+        storage.gate.clear()
+        queue = MessageWriteQueue(storage, max_size=2, batch_size=2, flush_interval=0)
+        await queue.start()
+        # 第一批被写入阻塞，随后两条占满队列，其余生产者在put中等待
+        producers = [asyncio.ensure_future(queue.enqueue(message(index))) for index in range(6)]
+        await asyncio.sleep(0.01)
+        closing = asyncio.ensure_future(queue.close(timeout=5))
+        await asyncio.sleep(0.01)
+        assert not await queue.enqueue(message(99))
+        storage.gate.set()
+        accepted = await asyncio.gather(*producers)
+        await closing
+        return storage, accepted
+
+    storage, accepted = asyncio.run(scenario())
+    assert all(accepted)
+    assert sorted(storage.written) == sorted(f"m{index}" for index in range(6))
+
+
+def test_flushes_messages_enqueued_after_close_marker():
+    """
+    已通过关闭检查的生产者可能在结束标记之后才入队（被唤醒前名额被结束标记抢先占用），
+    这些消息由_drain_remaining写完
+    """
+    async def scenario():
+        storage = RecordingStorage()
+        storage.gate.clear()
+        queue = MessageWriteQueue(storage, batch_size=1, flush_interval=0)
+        await queue.start()
+        assert await queue.enqueue(message(0))
+        await asyncio.sleep(0.01)
+        closing = asyncio.ensure_future(queue.close(timeout=5))
+        await asyncio.sleep(0.01)
+        await queue._queue.put(message(1))
+        storage.gate.set()
+        await closing
+        return storage
+
+    storage = asyncio.run(scenario())
+    assert storage.written == ["m0", "m1"]
+
+
+def test_splits_batch_on_non_retryable_error():
+    """不可重试的错误只丢弃出错的那条消息，同批其他消息逐条写入"""
+    async def scenario():
+        storage = RecordingStorage(rejected={"m1"})
+        queue = MessageWriteQueue(storage, batch_size=3, flush_interval=0.01)
+        await queue.start()
+        for index in range(3):
+            await queue.enqueue(message(index))
+        await queue.close(timeout=5)
+        return storage, queue
+
+    storage, queue = asyncio.run(scenario())
+    assert storage.batches[0] == ["m0", "m1", "m2"]
+    assert storage.batches[1:] == [["m0"], ["m1"], ["m2"]]
+    assert storage.written == ["m0", "m2"]
+    stats = queue.get_stats()
+    assert (stats["failed"], stats["retries"], stats["dropped"]) == (1, 0, 0)
+
+
+def test_retries_transient_errors_with_same_batch(monkeypatch):
+    async def no_sleep(delay):
+        return None
+
+    async def scenario():
+        storage = RecordingStorage(transient_failures=2)
+        queue = MessageWriteQueue(storage, batch_size=2, flush_interval=0, max_retries=3)
+        await queue._flush([message(0), message(1)])
+        return storage, queue
+
+    monkeypatch.setattr(main.asyncio, "sleep", no_sleep)
+    storage, queue = asyncio.run(scenario())
+    assert storage.batches == [["m0", "m1"]] * 3
+    assert storage.written == ["m0", "m1"]
+    assert queue.get_stats()["retries"] == 2
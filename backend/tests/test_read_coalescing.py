@@ -0,0 +1,114 @@
+"""Supabase读取合并：相同的并发读取共用一次上游调用，写入使对应scope的进行中读取失效"""
+
+import asyncio
+
+import pytest
+
+from benchmark.fakes import UpstreamTransport
+
+
+@pytest.fixture
+def seeded(postgrest):
+    postgrest.tables["chats"].append({"id": "c1", "user_id": "u1", "title": "对话", "created_at": "2024-01-01T00:00:00",
+                                      "updated_at": "2024-01-01T00:00:00"})
+    postgrest.tables["messages"].extend(
+        {"id": f"m{index}", "chat_id": "c1", "role": "user", "content": str(index), "timestamp": index}
+        for index in range(3)
+    )
+    return postgrest
+
+
+def gate_reads(db, postgrest, upstream_calls) -> asyncio.Event:
+    """GET请求在gate打开前挂起，使读取在测试控制下保持进行中"""
+    gate = asyncio.Event()
+
+    async def handler(request):
+        if request.method == "GET":
+            await gate.wait()
+        return await postgrest.handle(request)
+
+    db.http_transport = UpstreamTransport(handler, postgrest.label, 10,
+                                          lambda label, elapsed_ms: upstream_calls.update([label]))
+    return gate
+
+
+def test_concurrent_identical_reads_share_one_request(supabase, seeded, upstream_calls):
+    async def scenario():
+        gate = gate_reads(supabase, seeded, upstream_calls)
+        await supabase.start()
+        try:
+            reads = [asyncio.ensure_future(supabase.get_chat_messages("c1")) for _ in range(10)]
+            reads += [asyncio.ensure_future(supabase.get_user_chats("u1")) for _ in range(5)]
+            await asyncio.sleep(0.01)
+            gate.set()
+            return await asyncio.gather(*reads)
+        finally:
+            await supabase.close()
+
+    results = asyncio.run(scenario())
+    assert upstream_calls["supabase GET messages"] == 1
+    assert upstream_calls["supabase GET chats"] == 1
+    assert all(result == results[0] for result in results[:10])
+    assert [message["id"] for message in results[0]] == ["m0", "m1", "m2"]
+    stats = supabase.get_read_stats()
+    assert (stats["upstream"], stats["coalesced"], stats["in_flight"]) == (2, 13, 0)
+
+
+def test_different_params_are_not_coalesced(supabase, seeded, upstream_calls):
+    async def scenario():
+        await supabase.start()
+        try:
+            await asyncio.gather(supabase.get_chat_messages("c1"), supabase.get_chat_messages("c1", limit=1))
+        finally:
+            await supabase.close()
+
+    asyncio.run(scenario())
+    assert upstream_calls["supabase GET messages"] == 2
+
+
+def test_write_invalidates_inflight_reads_of_its_scope(supabase, seeded, upstream_calls):
+    """写入之后到达的读取重新查询，其他scope的进行中读取仍可复用"""
+    async def scenario():
+        gate = gate_reads(supabase, seeded, upstream_calls)
+        await supabase.start()
+        try:
+            before = asyncio.ensure_future(supabase.get_chat_messages("c1"))
+            chats_before = asyncio.ensure_future(supabase.get_user_chats("u1"))
+            await asyncio.sleep(0.01)
+
+            await supabase.save_message("c1", "assistant", "new", 10)
+
+            after = asyncio.ensure_future(supabase.get_chat_messages("c1"))
+            chats_after = asyncio.ensure_future(supabase.get_user_chats("u1"))
+            await asyncio.sleep(0.01)
+            gate.set()
+            await asyncio.gather(before, chats_before, chats_after)
+            return await after
+        finally:
+            await supabase.close()
+
+    after = asyncio.run(scenario())
+    assert upstream_calls["supabase GET messages"] == 2
+    assert upstream_calls["supabase GET chats"] == 1
+    assert after[-1]["content"] == "new"
+    assert supabase.get_read_stats()["invalidated"] == 1
+
+
+def test_cancelled_waiter_does_not_cancel_shared_read(supabase, seeded, upstream_calls):
+    async def scenario():
+        gate = gate_reads(supabase, seeded, upstream_calls)
+        await supabase.start()
+        try:
+            leader = asyncio.ensure_future(supabase.get_chat_messages("c1"))
+            follower = asyncio.ensure_future(supabase.get_chat_messages("c1"))
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            await asyncio.sleep(0)
+            gate.set()
+            return await follower
+        finally:
+            await supabase.close()
+
+    messages = asyncio.run(scenario())
+    assert len(messages) == 3
+    assert upstream_calls["supabase GET messages"] == 1
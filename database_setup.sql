@@ -36,6 +36,10 @@ CREATE TABLE chats (
 CREATE INDEX idx_chats_user_id ON chats(user_id);
 CREATE INDEX idx_chats_created_at ON chats(created_at DESC);
 CREATE INDEX idx_chats_updated_at ON chats(updated_at DESC);
+-- 对话列表游标分页按(created_at, id)排序定位
+CREATE INDEX idx_chats_user_created_id ON chats(user_id, created_at DESC, id DESC);
+-- 对话列表ETag版本查询取用户最近更新的一条
+CREATE INDEX idx_chats_user_updated ON chats(user_id, updated_at DESC);
 
 -- 4. 创建消息表
 CREATE TABLE messages (
@@ -53,6 +57,8 @@ CREATE TABLE messages (
 -- 为消息表添加索引
 CREATE INDEX idx_messages_chat_id ON messages(chat_id);
 CREATE INDEX idx_messages_timestamp ON messages(timestamp ASC);
+-- 聊天历史按对话分页/增量拉取
+CREATE INDEX idx_messages_chat_timestamp ON messages(chat_id, timestamp);
 CREATE INDEX idx_messages_created_at ON messages(created_at DESC);
 
 -- 5. 创建触发器自动更新updated_at字段
@@ -26,6 +26,10 @@ api.interceptors.request.use(
 // 响应拦截器 - 处理错误
 api.interceptors.response.use(
   (response) => {
+    // 条件请求需要读取状态码和ETag，返回完整响应
+    if (response.config.conditional) {
+      return response;
+    }
     return response.data;
   },
   (error) => {
@@ -42,6 +46,31 @@ api.interceptors.response.use(
   }
 );
 
+// 条件请求缓存：请求标识 -> { etag, data }
+// GET请求由浏览器缓存自动重新验证，POST查询需要手动携带If-None-Match
+const etagCache = new Map();
+
+const conditionalPost = async (url, body) => {
+  const key = `${url}:${JSON.stringify(body)}`;
+  const cached = etagCache.get(key);
+  const response = await api.post(url, body, {
+    conditional: true,
+    headers: cached ? { 'If-None-Match': cached.etag } : {},
+    validateStatus: (status) => (status >= 200 && status < 300) || status === 304,
+  });
+
+  if (response.status === 304 && cached) {
+    return cached.data;
+  }
+  const etag = response.headers.etag;
+  if (etag) {
+    etagCache.set(key, { etag, data: response.data });
+  } else {
+    etagCache.delete(key);
+  }
+  return response.data;
+};
+
 // 认证相关API
 export const authAPI = {
   // 用户登录
@@ -91,8 +120,9 @@ export const chatAPI = {
   },
   
   // 获取特定对话的消息
-  getChatMessages: (chatId) => {
-    return api.get(`/chat/history/${chatId}`);
+  // params可选: { limit, before_timestamp, since_timestamp }，用于分页加载和增量拉取
+  getChatMessages: (chatId, params = {}) => {
+    return api.get(`/chat/history/${chatId}`, { params });
   },
   
   // 创建新对话
@@ -102,6 +132,13 @@ export const chatAPI = {
     return api.post('/chat/new', { user_id: userInfo.id });
   },
   
+  // 登录后的初始数据：用户信息、第一页对话和最新对话的消息（一次请求）
+  bootstrap: (userId, pageSize = 10, messageLimit = 50) => {
+    return api.get(`/auth/bootstrap/${userId}`, {
+      params: { page_size: pageSize, message_limit: messageLimit }
+    });
+  },
+
   // 获取用户的所有对话
   getUserChats: (userId) => {
     return api.get(`/auth/chats/${userId}`);
@@ -109,7 +146,7 @@ export const chatAPI = {
   
   // 获取用户的分页对话列表
   getUserChatsPaginated: (userId, page = 1, pageSize = 10) => {
-    return api.post('/auth/chats', { 
+    return conditionalPost('/auth/chats', { 
       user_id: userId, 
       page: page, 
       page_size: pageSize 
@@ -119,6 +156,11 @@ export const chatAPI = {
   // 删除对话
   deleteChat: (chatId) => {
     return api.delete(`/chat/${chatId}`);
+  },
+
+  // 批量删除对话（一次请求，返回每个对话ID的结果）
+  deleteChats: (userId, chatIds) => {
+    return api.post('/chat/bulk-delete', { user_id: userId, chat_ids: chatIds });
   }
 };
 